@@ -6,13 +6,21 @@ import threading
 import urllib.parse as urllib_parse
 
 from . import backends
+from . import blkhash
+from . import coalesce
+from . import digestcache
 from . import errors
+from . import extent
+from . import groupcommit
 from . import measure
 from . import ops
 from . import util
 
 log = logging.getLogger("auth")
 
+# Operations modifying the image.
+_MODIFYING_OPS = (ops.Write, ops.Zero, ops.Copy)
+
 
 class Ticket:
 
@@ -54,6 +62,19 @@ class Ticket:
         self._filename = _optional(ticket_dict, "filename", str)
         self._sparse = _optional(ticket_dict, "sparse", bool, default=False)
         self._dirty = _optional(ticket_dict, "dirty", bool, default=False)
+        self._detect_zeroes = _optional(
+            ticket_dict, "detect_zeroes", bool,
+            default=cfg.daemon.detect_zeroes)
+
+        # Computes the image checksum from data transferred using this
+        # ticket, if enabled.
+        self._accumulator = None
+        if _optional(ticket_dict, "inline_checksum", bool, default=False):
+            self._accumulator = blkhash.Accumulator(self._size)
+
+        # Drop cached block digests when modifying the image, if enabled.
+        self._digest_cache = bool(
+            cfg.daemon.checksum_cache_dir and "write" in self._ops)
 
         self._operations = []
         self._lock = threading.Lock()
@@ -64,6 +85,10 @@ class Ticket:
         # Ranges transferred by completed operations.
         self._completed = measure.RangeList()
 
+        # Ranges written by write and zero operations, reported to clients
+        # resuming an interrupted upload.
+        self._written = measure.RangeList()
+
         # Set to true when a ticket is canceled. Once canceled, all operations
         # on this ticket will raise errors.AuthorizationError.
         self._canceled = False
@@ -76,6 +101,22 @@ class Ticket:
         # ticket can be removed only when this event is set.
         self._unused = threading.Event()
 
+        # Buffer for merging small writes, shared by all connections writing
+        # to this ticket. Used only by the file backend if enabled.
+        self._write_buffer = None
+        if (cfg.backend_file.coalesce_size and
+                "write" in self._ops and
+                self._url.scheme == "file"):
+            self._write_buffer = coalesce.Buffer(
+                cfg.backend_file.coalesce_size,
+                cfg.backend_file.coalesce_timeout)
+
+        # Merges concurrent flushes from all connections writing to this
+        # ticket, if the backend supports it.
+        self._flush_coordinator = None
+        if "write" in self._ops:
+            self._flush_coordinator = groupcommit.Coordinator()
+
     @property
     def uuid(self):
         return self._uuid
@@ -119,6 +160,38 @@ class Ticket:
         """
         return self._dirty
 
+    @property
+    def detect_zeroes(self):
+        """
+        Return True if uploaded all-zero blocks should be zeroed instead of
+        written to storage.
+        """
+        return self._detect_zeroes
+
+    @property
+    def accumulator(self):
+        """
+        Return the ticket checksum accumulator, or None if inline checksum
+        is disabled.
+        """
+        return self._accumulator
+
+    @property
+    def write_buffer(self):
+        """
+        Return the ticket write buffer, or None if write coalescing is
+        disabled.
+        """
+        return self._write_buffer
+
+    @property
+    def flush_coordinator(self):
+        """
+        Return the ticket flush coordinator, or None if the ticket does not
+        allow writing.
+        """
+        return self._flush_coordinator
+
     @property
     def idle_time(self):
         """
@@ -180,6 +253,33 @@ class Ticket:
         finally:
             self._remove_operation(operation)
 
+    def written_extents(self):
+        """
+        Return list of extent.WrittenExtent objects describing the areas
+        written using this ticket, covering the entire image.
+        """
+        with self._lock:
+            written = list(self._written)
+
+        extents = []
+        offset = 0
+
+        for r in written:
+            start = min(r.start, self._size)
+            end = min(r.end, self._size)
+            if start > offset:
+                extents.append(
+                    extent.WrittenExtent(offset, start - offset, False))
+            if end > start:
+                extents.append(extent.WrittenExtent(start, end - start, True))
+            offset = max(offset, end)
+
+        if offset < self._size:
+            extents.append(
+                extent.WrittenExtent(offset, self._size - offset, False))
+
+        return extents
+
     def touch(self):
         """
         Extend the ticket and update the last access time.
@@ -198,9 +298,30 @@ class Ticket:
 
             self._ongoing.add(op)
 
+        if self._digest_cache and isinstance(op, _MODIFYING_OPS):
+            try:
+                digestcache.start_write(self._url)
+            except OSError:
+                log.exception("Error updating digest cache for %s",
+                              urllib_parse.urlunparse(self._url))
+
     def _remove_operation(self, op):
+        if self._digest_cache and isinstance(op, _MODIFYING_OPS):
+            # The operation may have modified the entire range before
+            # failing.
+            length = max(op.size or 0, op.done)
+            try:
+                digestcache.end_write(self._url, op.offset, length)
+            except OSError:
+                log.exception("Error updating digest cache for %s",
+                              urllib_parse.urlunparse(self._url))
+
         with self._lock:
             self._ongoing.remove(op)
+            if isinstance(op, _MODIFYING_OPS):
+                if op.done:
+                    self._written.add(
+                        measure.Range(op.offset, op.offset + op.done))
 
             if self._canceled:
                 # If this was the last ongoing operation, wake up caller
@@ -224,6 +345,13 @@ class Ticket:
     def active(self):
         return bool(self._ongoing)
 
+    def writing(self):
+        """
+        Return True if operations modifying the image are running.
+        """
+        with self._lock:
+            return any(isinstance(op, _MODIFYING_OPS) for op in self._ongoing)
+
     def transferred(self):
         """
         The number of bytes that were transferred so far using this ticket.
@@ -268,9 +396,19 @@ class Ticket:
             info["transfer_id"] = self._transfer_id
         if self.filename:
             info["filename"] = self.filename
+        if self._detect_zeroes:
+            info["detect_zeroes"] = self._detect_zeroes
+        if self._accumulator:
+            checksum = self._accumulator.result()
+            if checksum:
+                info["checksum"] = checksum
         transferred = self.transferred()
         if transferred is not None:
             info["transferred"] = transferred
+        if self._flush_coordinator:
+            flushes = self._flush_coordinator.stats()
+            if flushes["requests"]:
+                info["flushes"] = flushes
         return info
 
     def extend(self, timeout):
@@ -414,6 +552,14 @@ class Authorizer:
             # Ticket is unused now, so it is safe to remove it.
             del self._tickets[ticket_id]
 
+            cache_dir = self._config.daemon.checksum_cache_dir
+            if cache_dir:
+                try:
+                    digestcache.sync(cache_dir, ticket.url)
+                except OSError:
+                    log.exception("Error updating digest cache for %s",
+                                  urllib_parse.urlunparse(ticket.url))
+
     def clear(self):
         self._tickets.clear()
 
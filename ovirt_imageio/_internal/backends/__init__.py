@@ -4,7 +4,9 @@
 from collections import namedtuple
 from functools import partial
 
+from .. import coalesce
 from .. import errors
+from .. import groupcommit
 from .. import util
 
 from . common import CLOSED
@@ -83,28 +85,7 @@ def get(req, ticket, config):
     try:
         return ticket.get_context(req.connection_id)
     except KeyError:
-        if not supports(ticket.url.scheme):
-            raise Unsupported(
-                "Unsupported backend {!r}".format(ticket.url.scheme))
-
-        mode = "r+" if "write" in ticket.ops else "r"
-        module = _modules[ticket.url.scheme]
-
-        # If HTTP backend has no explict CA file configuration, use CA file
-        # from TLS configuration.
-        ca_file = config.backend_http.ca_file or config.tls.ca_file
-
-        backend = module.open(
-            ticket.url,
-            mode=mode,
-            sparse=ticket.sparse,
-            dirty=ticket.dirty,
-            max_connections=config.daemon.max_connections,
-            cafile=ca_file)
-
-        backend_config = getattr(config, "backend_" + backend.name)
-        buf = util.aligned_buffer(backend_config.buffer_size)
-        ctx = Context(backend, buf)
+        ctx = create_context(ticket, config)
 
         # Keep the context in the ticket so we monitor the number of
         # connections using the ticket.
@@ -124,3 +105,55 @@ def get(req, ticket, config):
             partial(ticket.remove_context, req.connection_id))
 
         return ctx
+
+
+def create_context(ticket, config):
+    """
+    Open a backend for this ticket, returning a new Context. The caller is
+    responsible for closing the context.
+    """
+    if not supports(ticket.url.scheme):
+        raise Unsupported(
+            "Unsupported backend {!r}".format(ticket.url.scheme))
+
+    mode = "r+" if "write" in ticket.ops else "r"
+    module = _modules[ticket.url.scheme]
+
+    # If HTTP backend has no explict CA file configuration, use CA file
+    # from TLS configuration.
+    ca_file = config.backend_http.ca_file or config.tls.ca_file
+
+    backend = module.open(
+        ticket.url,
+        mode=mode,
+        sparse=ticket.sparse,
+        dirty=ticket.dirty,
+        max_connections=config.daemon.max_connections,
+        cafile=ca_file)
+
+    backend_config = getattr(config, "backend_" + backend.name)
+    buf = util.aligned_buffer(backend_config.buffer_size)
+
+    # Merge concurrent flushes from all connections using the ticket.
+    if ticket.flush_coordinator is not None and _can_group_flush(backend):
+        backend = groupcommit.Backend(backend, ticket.flush_coordinator)
+
+    # Merge small writes from all connections using the ticket.
+    if ticket.write_buffer is not None:
+        backend = coalesce.Backend(backend, ticket.write_buffer)
+
+    return Context(backend, buf)
+
+
+def _can_group_flush(backend):
+    """
+    Return True if flushing backend flushes changes written by other
+    connections to the same image.
+    """
+    if backend.name == "file":
+        # fsync() flushes all changes to the file, regardless of the file
+        # descriptor used for writing.
+        return True
+    if backend.name == "nbd":
+        return backend.can_multi_conn
+    return False
@@ -20,7 +20,7 @@ log = logging.getLogger("backends.file")
 
 
 def open(url, mode="r", sparse=False, dirty=False, max_connections=8,
-         **options):
+         holes=False, **options):
     """
     Open a file backend.
 
@@ -32,14 +32,22 @@ def open(url, mode="r", sparse=False, dirty=False, max_connections=8,
         max_connections (int): maximum number of connections per backend
             allowed on this server. Limit backends's max_readers and
             max_writers.
+        holes (bool): report holes in regular files as zero extents using
+            SEEK_DATA and SEEK_HOLE. Otherwise the entire file is reported as
+            data.
         **options: ignored, file backend does not have any options.
     """
     fio = util.open(url.path, mode, direct=True)
     try:
         fio.name = url.path
         mode = os.fstat(fio.fileno()).st_mode
-        backend = BlockBackend if stat.S_ISBLK(mode) else FileBackend
-        return backend(fio, sparse=sparse, max_connections=max_connections)
+        if stat.S_ISBLK(mode):
+            return BlockBackend(
+                fio, sparse=sparse, max_connections=max_connections)
+        else:
+            return FileBackend(
+                fio, sparse=sparse, max_connections=max_connections,
+                holes=holes)
     except:  # noqa: E722
         fio.close()
         raise
@@ -146,14 +154,17 @@ class Backend:
     def block_size(self):
         return self._block_size
 
-    def extents(self, context="zero"):
+    def extents(self, context="zero", offset=0, length=None):
         if context != "zero":
             raise errors.UnsupportedOperation(
                 "Backend {} does not support {} extents"
                 .format(self.name, context))
 
+        if length is None:
+            length = self.size() - offset
+
         # TODO: Use qemu-img map to get extents.
-        yield extent.ZeroExtent(0, self.size(), False, False)
+        yield extent.ZeroExtent(offset, length, False, False)
 
     # Debugging interface
 
@@ -327,7 +338,8 @@ class FileBackend(Backend):
     Regular file backend.
     """
 
-    def __init__(self, fio, sparse=False, max_connections=8, block_size=None):
+    def __init__(self, fio, sparse=False, max_connections=8, block_size=None,
+                 holes=False):
         """
         Initialize a FileBackend.
 
@@ -338,8 +350,11 @@ class FileBackend(Backend):
                 allowed on this server. Limit backends's max_readers.
             block_size (int): If set, use the specified block size. Otherwise
                 the value is detected automatically.
+            holes (bool): report holes as zero extents using SEEK_DATA and
+                SEEK_HOLE.
         """
         super().__init__(fio, sparse=sparse, max_connections=max_connections)
+        self._holes = holes
         # These will be set to False if the first call to fallocate() reveal
         # that it is not supported on the current file system.
         self._can_zero_range = True
@@ -352,6 +367,7 @@ class FileBackend(Backend):
         Return a new backend sharing the same file.
         """
         backend = self._clone()
+        backend._holes = self._holes
         backend._can_zero_range = self._can_zero_range
         backend._can_punch_hole = self._can_punch_hole
         backend._can_fallocate = self._can_fallocate
@@ -363,6 +379,56 @@ class FileBackend(Backend):
         # writer. User that wants best performance should use the nbd backend.
         return 1
 
+    def extents(self, context="zero", offset=0, length=None):
+        if not self._holes or context != "zero":
+            yield from super().extents(context, offset=offset, length=length)
+            return
+
+        if length is None:
+            length = self.size() - offset
+
+        # lseek() modifies the file position, so find all extents before
+        # yielding, and restore the position.
+        old_pos = self._fio.tell()
+        try:
+            extents = self._seek_extents(offset, offset + length)
+        finally:
+            self._fio.seek(old_pos, os.SEEK_SET)
+
+        yield from extents
+
+    def _seek_extents(self, pos, end):
+        """
+        Return list of extents between pos and end using SEEK_DATA and
+        SEEK_HOLE.
+        """
+        fd = self._fio.fileno()
+        extents = []
+
+        while pos < end:
+            try:
+                data = min(os.lseek(fd, pos, os.SEEK_DATA), end)
+            except OSError as e:
+                # ENXIO: no data after pos.
+                if e.errno != errno.ENXIO:
+                    raise
+                data = end
+
+            # Like qemu, report holes as zero but not as holes, since a
+            # raw file has no backing chain.
+            if data > pos:
+                extents.append(
+                    extent.ZeroExtent(pos, data - pos, True, False))
+                pos = data
+                if pos == end:
+                    break
+
+            hole = min(os.lseek(fd, pos, os.SEEK_HOLE), end)
+            extents.append(extent.ZeroExtent(pos, hole - pos, False, False))
+            pos = hole
+
+        return extents
+
     def _detect_block_size(self):
         """
         Detect the unserlying storage block size by checking the minimal block
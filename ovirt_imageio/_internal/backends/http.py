@@ -11,6 +11,7 @@ import logging
 import os
 import socket
 import ssl
+import urllib.parse as urllib_parse
 
 from .. import errors
 from .. import extent
@@ -68,6 +69,7 @@ class Backend:
         self._can_extents = False
         self._can_zero = False
         self._can_flush = False
+        self._can_blockmap = False
         self._max_readers = 1
         self._max_writers = 1
 
@@ -98,6 +100,7 @@ class Backend:
             backend._can_extents = self._can_extents
             backend._can_zero = self._can_zero
             backend._can_flush = self._can_flush
+            backend._can_blockmap = self._can_blockmap
             backend._max_readers = self._max_readers
             backend._max_writers = self._max_writers
 
@@ -121,6 +124,7 @@ class Backend:
             self._can_extents = options.get("extents", False)
             self._can_zero = options.get("zero", False)
             self._can_flush = options.get("flush", False)
+            self._can_blockmap = options.get("blockmap", False)
 
             # In oVirt 4.3 qemu-nbd was configured to allow only single
             # connection, so practicaly we can have only single reader.
@@ -288,20 +292,29 @@ class Backend:
         if self._can_flush:
             self._patch({"op": "flush"})
 
-    def extents(self, context="zero"):
+    def extents(self, context="zero", offset=0, length=None):
         """
         Get image extents, return iterator over received extents.
+
+        Extents are cached by the backend, so they may be stale when
+        requesting a range after the image was modified. Requesting a range
+        is not supported.
         """
-        if context not in ("zero", "dirty"):
+        if context not in ("zero", "dirty", "written"):
             raise RuntimeError("Invalid context: {}".format(context))
 
+        if offset != 0 or length is not None:
+            raise errors.UnsupportedOperation(
+                "Backend {} does not support extents for a range"
+                .format(self.name))
+
         if not self._can_extents:
             if context == "zero":
                 yield extent.ZeroExtent(0, self.size(), False, False)
                 return
             else:
                 raise errors.UnsupportedOperation(
-                    "Server does not support dirty extents")
+                    "Server does not support {} extents".format(context))
 
         if context not in self._extents:
             self._extents[context] = list(self._get_extents(context))
@@ -309,6 +322,28 @@ class Backend:
         for ext in self._extents[context]:
             yield ext
 
+    def block_map(self, block_size, algorithm):
+        """
+        Get the digests of all image blocks, computed by the server.
+
+        Returns the block map as bytes object. See blkhash.BlockMap for more
+        info.
+        """
+        if not self._can_blockmap:
+            raise errors.UnsupportedOperation(
+                "Server does not support block map")
+
+        query = urllib_parse.urlencode(
+            {"block_size": block_size, "algorithm": algorithm})
+        self._con.request("GET", self.url.path + "/blockmap?" + query)
+        res = self._con.getresponse()
+        data = res.read()
+
+        if res.status != http_client.OK:
+            self._reraise(res.status, data)
+
+        return data
+
     def tell(self):
         return self._position
 
@@ -510,7 +545,10 @@ class Backend:
         res = self._con.getresponse()
         data = res.read()
 
-        if res.status == http_client.NOT_FOUND:
+        # Old servers do not know the "written" context.
+        if (res.status == http_client.NOT_FOUND or
+                res.status == http_client.BAD_REQUEST and
+                context == "written"):
             raise errors.UnsupportedOperation(
                 "Server does not support {} extents: {}"
                 .format(context, data[:512]))
@@ -520,7 +558,11 @@ class Backend:
 
         extents = json.loads(data.decode("utf-8"))
 
-        cls = extent.ZeroExtent if context == "zero" else extent.DirtyExtent
+        cls = {
+            "zero": extent.ZeroExtent,
+            "dirty": extent.DirtyExtent,
+            "written": extent.WrittenExtent,
+        }[context]
         for ext in extents:
             yield cls.from_dict(ext)
 
@@ -143,11 +143,13 @@ class Backend:
     def block_size(self):
         return 1
 
-    def extents(self, context="zero"):
+    def extents(self, context="zero", offset=0, length=None):
         self._check_closed()
         # If not configured, report single data extent.
         if not self._extents and context == "zero":
-            yield extent.ZeroExtent(0, self.size(), False, False)
+            if length is None:
+                length = self.size() - offset
+            yield extent.ZeroExtent(offset, length, False, False)
             return
 
         if context not in self._extents:
@@ -155,8 +157,7 @@ class Backend:
                 "Backend {} does not support {} extents"
                 .format(self.name, context))
 
-        for ext in self._extents[context]:
-            yield ext
+        yield from extent.clip(self._extents[context], offset, length)
 
     # Debugging interface
 
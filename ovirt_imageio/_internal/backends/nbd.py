@@ -64,6 +64,8 @@ class Backend:
         self._position = 0
         self._dirty = False
         self._max_connections = max_connections
+        # Use fast zero until the server reports that zeroing is slow.
+        self._fast_zero = client.can_fast_zero
 
     def clone(self):
         """
@@ -120,7 +122,7 @@ class Backend:
     def zero(self, length):
         if not self.writable():
             raise IOError("Unsupported operation: zero")
-        self._client.zero(self._position, length, punch_hole=self._sparse)
+        self._zero(self._position, length)
         self._position += length
         self._dirty = True
         return length
@@ -129,6 +131,23 @@ class Backend:
         self._client.flush()
         self._dirty = False
 
+    def _zero(self, offset, length):
+        if self._fast_zero:
+            try:
+                self._client.zero(
+                    offset, length, punch_hole=self._sparse, fast=True)
+                return
+            except nbd.ReplyError as e:
+                if e.code != nbd.ENOTSUP:
+                    raise
+                # Zeroing is emulated by writing zeroes. We must zero anyway,
+                # but make the slow path visible.
+                log.warning(
+                    "Server cannot zero efficiently, writing zeroes: %s", e)
+                self._fast_zero = False
+
+        self._client.zero(offset, length, punch_hole=self._sparse)
+
     def tell(self):
         return self._position
 
@@ -159,15 +178,18 @@ class Backend:
                 raise
             log.exception("Error closing")
 
-    def extents(self, context="zero"):
+    def extents(self, context="zero", offset=0, length=None):
         if context not in ("zero", "dirty"):
             raise errors.UnsupportedOperation(
                 "Backend nbd does not support {} extents".format(context))
 
         # If server does not support base:allocation, we can safely report one
         # data extent like other backends.
+        if length is None:
+            length = self._client.export_size - offset
+
         if context == "zero" and not self._client.has_base_allocation:
-            yield extent.ZeroExtent(0, self._client.export_size, False, False)
+            yield extent.ZeroExtent(offset, length, False, False)
             return
 
         # If dirty extents are not available, client may be able to use zero
@@ -178,8 +200,9 @@ class Backend:
                 .format(self._client.export_name))
 
         dirty = context == "dirty"
-        start = 0
-        for ext in nbdutil.extents(self._client, dirty=dirty):
+        start = offset
+        for ext in nbdutil.extents(
+                self._client, offset=offset, length=length, dirty=dirty):
             if dirty:
                 yield extent.DirtyExtent(
                     start, ext.length, ext.dirty, ext.zero)
@@ -188,6 +211,10 @@ class Backend:
                     start, ext.length, ext.zero, ext.hole)
             start += ext.length
 
+    @property
+    def can_multi_conn(self):
+        return self._client.can_multi_conn
+
     @property
     def block_size(self):
         # qemu always reports minium_block_size=1, so caller never needs to
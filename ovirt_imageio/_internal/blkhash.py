@@ -1,19 +1,50 @@
 # SPDX-FileCopyrightText: Red Hat, Inc.
 # SPDX-License-Identifier: GPL-2.0-or-later
 
+import collections
+import copy
 import hashlib
+import logging
 import os
+import threading
+from concurrent import futures
+from concurrent.futures import ThreadPoolExecutor
 from functools import partial
 
 from . import ioutil
+from . import measure
+from . import util
 from .units import MiB
 
+log = logging.getLogger("blkhash")
+
 # These settings give best result for Fedora 32 image when using the nbd
 # backend. More testing is needed to determine if this is the best default.
 BLOCK_SIZE = 4 * MiB
 ALGORITHM = "blake2b"
 DIGEST_SIZE = 32
 
+# Default number of blocks hashed in parallel by a pipeline. hashlib and
+# ioutil.is_zero release the GIL when processing large buffers, so blocks are
+# hashed in parallel.
+WORKERS = 4
+
+# Maximum number of threads computing block digests, shared by all pipelines.
+MAX_WORKERS = 8
+
+# Maximum size of the buffers used by all pipelines. When the limit is
+# reached, pipelines reuse their buffers, and a new pipeline waits until
+# other pipelines release their buffers.
+MAX_BUFFERS_SIZE = 256 * MiB
+
+# Maximum size of the buffers used by an accumulator for assembling blocks
+# filled by multiple ranges. If more memory is needed, the accumulator gives
+# up computing the checksum.
+MAX_PARTIAL_SIZE = 256 * MiB
+
+# Used to hash zeroes in partial blocks.
+_ZERO_BUFFER = bytes(1 * MiB)
+
 
 class Hash:
     """
@@ -43,18 +74,62 @@ class Hash:
         self._block_size = block_size
         self._zero_block_digest = self._func(b"\0" * block_size).digest()
 
+    @property
+    def block_size(self):
+        return self._block_size
+
+    @property
+    def digest_size(self):
+        """
+        Return the size of block digest in bytes.
+        """
+        return len(self._zero_block_digest)
+
     def update(self, block):
-        block_digest = self._func(block).digest()
-        self._hash.update(block_digest)
+        self.add_digest(self.block_digest(block))
 
     def zero(self, count):
+        self.add_digest(self.zero_digest(count))
+
+    def block_hash(self):
+        """
+        Return new hash object for computing a block digest incrementally.
+        """
+        return self._func()
+
+    def block_digest(self, block):
+        """
+        Return the digest of a data block. Can be called from multiple
+        threads; the returned digest must be added in the order of the blocks
+        using add_digest().
+        """
+        return self._func(block).digest()
+
+    def zero_digest(self, count):
+        """
+        Return the digest of a zero block of count bytes.
+        """
         if count == self._block_size:
             # Fast path.
-            self._hash.update(self._zero_block_digest)
+            return self._zero_block_digest
         else:
             # Slow path.
-            block_digest = self._func(b"\0" * count).digest()
-            self._hash.update(block_digest)
+            return self._func(b"\0" * count).digest()
+
+    def add_digest(self, block_digest):
+        """
+        Add the digest of the next block.
+        """
+        self._hash.update(block_digest)
+
+    def copy(self):
+        """
+        Return a copy of the hash, for computing the digest of the blocks
+        added so far and more blocks, without modifying this hash.
+        """
+        h = copy.copy(self)
+        h._hash = self._hash.copy()
+        return h
 
     def digest(self):
         return self._hash.digest()
@@ -63,8 +138,268 @@ class Hash:
         return self._hash.hexdigest()
 
 
+class BlockMap(Hash):
+    """
+    Block based hash keeping the digests of all blocks.
+
+    The block map is the concatenation of the block digests, in the order of
+    the blocks. Comparing block maps of two images computed with the same
+    block size and algorithm shows which blocks differ.
+
+    If write is specified, the block digests are written using write()
+    while they are added instead of kept in memory. Digests are written in
+    chunks of up to WRITE_SIZE bytes, at least every WRITE_INTERVAL
+    seconds, so a slow reader does not wait for the entire block map. Call
+    flush() to write the remaining digests after adding the last digest.
+    """
+
+    WRITE_SIZE = 64 * 1024
+    WRITE_INTERVAL = 1.0
+
+    def __init__(self, block_size=BLOCK_SIZE, algorithm=ALGORITHM,
+                 digest_size=DIGEST_SIZE, write=None):
+        super().__init__(
+            block_size=block_size,
+            algorithm=algorithm,
+            digest_size=digest_size)
+        self._digests = bytearray()
+        self._write = write
+        self._last_write = util.monotonic_time()
+
+    def add_digest(self, block_digest):
+        super().add_digest(block_digest)
+        self._digests += block_digest
+        if self._write and (
+                len(self._digests) >= self.WRITE_SIZE or
+                util.monotonic_time() - self._last_write >=
+                self.WRITE_INTERVAL):
+            self.flush()
+
+    def flush(self):
+        """
+        Write the digests added since the last write.
+        """
+        if self._write and self._digests:
+            self._write(bytes(self._digests))
+            self._digests.clear()
+            self._last_write = util.monotonic_time()
+
+    def block_map(self):
+        """
+        Return the block digests added so far, or since the last write if
+        write was specified.
+        """
+        return bytes(self._digests)
+
+
+def changed_blocks(a, b, digest_size):
+    """
+    Generate the indexes of blocks that differ in block maps a and b.
+
+    Block maps must be computed with the same block size and algorithm. If a
+    block map is shorter, missing blocks are considered changed.
+    """
+    if len(a) % digest_size or len(b) % digest_size:
+        raise ValueError(
+            "Invalid block map size: {}, {}, digest size {}"
+            .format(len(a), len(b), digest_size))
+
+    count = max(len(a), len(b)) // digest_size
+    with memoryview(a) as va, memoryview(b) as vb:
+        for index in range(count):
+            start = index * digest_size
+            end = start + digest_size
+            if va[start:end] != vb[start:end]:
+                yield index
+
+
+class Pipeline:
+    """
+    Compute block digests in parallel, adding them to a Hash in the order of
+    the blocks.
+
+    Call buffer() to get a buffer for reading the next data block, read the
+    block into the buffer, and submit it using update(). For zero blocks call
+    zero(), and for blocks with known digest call add_digest(). When all
+    blocks were submitted, call complete() to wait until all block digests
+    were added to the hash.
+
+    The result is the same as hashing the blocks sequentially using the Hash.
+    """
+
+    def __init__(self, h, workers=WORKERS, detect_zeroes=True):
+        """
+        Arguments:
+            h (Hash): hash combining the block digests.
+            workers (int): number of blocks hashed in parallel. The digests
+                are computed by threads shared by all pipelines, limited by
+                MAX_WORKERS.
+            detect_zeroes (bool): If True, detect zeroes in data blocks,
+                using the fast zero block digest.
+        """
+        self._hash = h
+        self._detect_zeroes = detect_zeroes
+        self._executor = _executor()
+        # Allow reading the next blocks while the workers are busy. The
+        # buffers are also limited by MAX_BUFFERS_SIZE.
+        self._max_buffers = workers * 2
+        self._buffers = []
+        self._free = []
+        # Blocks in submission order. Data blocks are (future, buf, done)
+        # tuples, blocks with known digest are (digest, None, None) tuples.
+        self._pending = collections.deque()
+
+    def buffer(self):
+        """
+        Return a buffer for reading the next data block, waiting until a
+        buffer is available.
+        """
+        while not self._free:
+            if len(self._buffers) < self._max_buffers:
+                # If we have pending blocks we can reuse their buffers, so
+                # wait for buffers budget only if we have nothing to reuse.
+                if _buffers_budget.acquire(
+                        self._hash.block_size, blocking=not self._pending):
+                    buf = util.aligned_buffer(self._hash.block_size)
+                    self._buffers.append(buf)
+                    return buf
+            self._complete_next()
+
+        return self._free.pop()
+
+    def update(self, buf, length, done=None):
+        """
+        Submit data block of length bytes in buf, returned by buffer().
+
+        If done is specified, it is called with the block digest when the
+        digest is added to the hash.
+        """
+        future = self._executor.submit(self._block_digest, buf, length)
+        self._pending.append((future, buf, done))
+        self._complete_done()
+
+    def zero(self, length):
+        """
+        Submit zero block of length bytes.
+        """
+        self.add_digest(self._hash.zero_digest(length))
+
+    def add_digest(self, block_digest):
+        """
+        Submit block with known digest.
+        """
+        self._pending.append((block_digest, None, None))
+        self._complete_done()
+
+    def complete(self):
+        """
+        Wait until all submitted blocks were added to the hash.
+        """
+        while self._pending:
+            self._complete_next()
+
+    def close(self):
+        # The executor is shared, so we wait only for our blocks before
+        # releasing the buffers.
+        futures.wait([result for result, buf, _ in self._pending
+                      if buf is not None])
+        self._pending.clear()
+        for buf in self._buffers:
+            buf.close()
+            _buffers_budget.release(self._hash.block_size)
+        self._buffers = []
+        self._free = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _block_digest(self, buf, length):
+        with memoryview(buf)[:length] as view:
+            if self._detect_zeroes and ioutil.is_zero(view):
+                return self._hash.zero_digest(length)
+            return self._hash.block_digest(view)
+
+    def _complete_done(self):
+        while self._pending:
+            result, buf, _ = self._pending[0]
+            if buf is not None and not result.done():
+                break
+            self._complete_next()
+
+    def _complete_next(self):
+        result, buf, done = self._pending.popleft()
+        if buf is None:
+            self._hash.add_digest(result)
+        else:
+            block_digest = result.result()
+            self._hash.add_digest(block_digest)
+            self._free.append(buf)
+            if done:
+                done(block_digest)
+
+
+class _Budget:
+    """
+    Limit the total size of buffers allocated by multiple threads.
+    """
+
+    def __init__(self, size):
+        self._size = size
+        self._available = size
+        self._cond = threading.Condition(threading.Lock())
+
+    @property
+    def available(self):
+        with self._cond:
+            return self._available
+
+    def acquire(self, size, blocking=True):
+        """
+        Acquire size bytes, waiting until enough bytes are available if
+        blocking is True. Return True if the bytes were acquired.
+
+        A buffer bigger than the budget is allowed when no other buffer
+        exists.
+        """
+        size = min(size, self._size)
+        with self._cond:
+            while self._available < size:
+                if not blocking:
+                    return False
+                self._cond.wait()
+            self._available -= size
+            return True
+
+    def release(self, size):
+        size = min(size, self._size)
+        with self._cond:
+            self._available += size
+            self._cond.notify_all()
+
+
+_buffers_budget = _Budget(MAX_BUFFERS_SIZE)
+
+_executor_lock = threading.Lock()
+_shared_executor = None
+
+
+def _executor():
+    """
+    Return the executor shared by all pipelines, creating it on first use.
+    """
+    global _shared_executor
+    with _executor_lock:
+        if _shared_executor is None:
+            _shared_executor = ThreadPoolExecutor(
+                max_workers=MAX_WORKERS, thread_name_prefix="blkhash")
+        return _shared_executor
+
+
 def checksum(path, block_size=BLOCK_SIZE, algorithm=ALGORITHM,
-             digest_size=DIGEST_SIZE, detect_zeroes=True):
+             digest_size=DIGEST_SIZE, detect_zeroes=True, workers=WORKERS):
     """
     Compute file checksum without extents information.
 
@@ -76,27 +411,23 @@ def checksum(path, block_size=BLOCK_SIZE, algorithm=ALGORITHM,
             and blake2s algorithms; specify None for other algorithms.
         detect_zeroes (bool): If True, detect zeroes in the input, speeing up
             the calculation.
+        workers (int): Number of threads computing block digests.
     """
     length = os.path.getsize(path)
-    block = bytearray(block_size)
     h = Hash(
         block_size=block_size, algorithm=algorithm, digest_size=digest_size)
 
-    with open(path, "rb") as f:
-        # Hash full blocks.
-        while length >= block_size:
-            _read_block(f, block_size, block)
-            if detect_zeroes and ioutil.is_zero(block):
-                h.zero(block_size)
-            else:
-                h.update(block)
-            length -= block_size
+    with open(path, "rb") as f, \
+            Pipeline(h, workers=workers, detect_zeroes=detect_zeroes) as p:
+        while length:
+            count = min(length, block_size)
+            buf = p.buffer()
+            with memoryview(buf)[:count] as view:
+                _read_block(f, count, view)
+            p.update(buf, count)
+            length -= count
 
-        # Hash last partial block.
-        if length:
-            with memoryview(block)[:length] as view:
-                _read_block(f, length, view)
-                h.update(view)
+        p.complete()
 
     return {
         "algorithm": algorithm,
@@ -105,6 +436,335 @@ def checksum(path, block_size=BLOCK_SIZE, algorithm=ALGORITHM,
     }
 
 
+class Accumulator:
+    """
+    Compute image checksum from data transferred in any order.
+
+    Data and zero ranges are added while transferring an image, possibly from
+    multiple threads, in any order. A range added again replaces the data
+    added before, like writing to the image, unless the block containing the
+    range was already completed. When all blocks were filled, the checksum
+    is the same as the checksum computed by reading the entire image.
+
+    A block is completed when all its bytes were filled. A range filling an
+    entire block is hashed without copying, otherwise the block is assembled
+    in a buffer. Completed block digests are added to the hash in block
+    order, so only digests of blocks completed before their preceding
+    blocks are kept. If the buffers of incomplete blocks need more than
+    max_partial_size bytes, the checksum cannot be computed.
+
+    Blocks completed only by fill_zeroes() are not added to the hash until
+    the checksum is computed, since they may be filled later with data; a
+    block that was not transferred yet is zero in the image. If another
+    completed block is filled again with different content, the checksum
+    cannot be computed.
+    """
+
+    def __init__(self, size, block_size=BLOCK_SIZE, algorithm=ALGORITHM,
+                 digest_size=DIGEST_SIZE, max_partial_size=MAX_PARTIAL_SIZE):
+        """
+        Arguments:
+            size (int): image size in bytes.
+            block_size (int): Size of block in bytes.
+            algorithm (str): One of the algorithms supported py haslib module.
+            digest_size (int): Size of hash in bytes, supported only for
+                blake2b and blake2s algorithms; specify None for other
+                algorithms.
+            max_partial_size (int): Maximum size of the buffers of incomplete
+                blocks in bytes.
+        """
+        self._size = size
+        self._block_size = block_size
+        self._algorithm = algorithm
+        self._max_partial_size = max_partial_size
+        self._hash = Hash(
+            block_size=block_size,
+            algorithm=algorithm,
+            digest_size=digest_size)
+        self._count = (size + block_size - 1) // block_size
+        self._lock = threading.Lock()
+        # Incomplete blocks, mapping block index to _PartialBlock.
+        self._partial = {}
+        # Size of the buffers of incomplete blocks.
+        self._partial_size = 0
+        # Index of the next block digest to add to the hash.
+        self._next = 0
+        # Digests of complete blocks after the next block, mapping block
+        # index to digest.
+        self._digests = {}
+        # Complete zero blocks, allowing zeroing them again.
+        self._zero_blocks = bytearray(self._count)
+        # Zero blocks completed by fill_zeroes(), which may be filled again.
+        # Their digests are kept until the checksum is computed.
+        self._tentative = bytearray(self._count)
+        self._failed = False
+        self._result = None
+
+    def update(self, offset, data):
+        """
+        Add data at offset.
+        """
+        self._add(offset, len(data), data)
+
+    def zero(self, offset, length):
+        """
+        Add length zero bytes at offset.
+        """
+        self._add(offset, length, None)
+
+    def fill_zeroes(self, extents):
+        """
+        Fill ranges not added yet using zero extents.
+
+        Use when some areas are not transferred because they are known to be
+        zero in the image, for example when uploading only the data extents
+        of an image. Ranges which are being added by other threads are not
+        filled. Blocks filled only by zero extents can be filled again with
+        data later, but a block with data completed by zero extents cannot,
+        so this should be called when no data is being transferred.
+
+        Arguments:
+            extents (iterable): extent.ZeroExtent objects describing the
+                image.
+        """
+        for ext in extents:
+            if not ext.zero:
+                continue
+
+            start = ext.start
+            end = min(ext.start + ext.length, self._size)
+            while start < end:
+                index = start // self._block_size
+                n = min(end, (index + 1) * self._block_size) - start
+                self._fill_block(index, start, n)
+                start += n
+
+    def result(self):
+        """
+        Return checksum dict if all blocks were filled, None otherwise.
+        """
+        with self._lock:
+            if self._failed or self._next + len(self._digests) < self._count:
+                return None
+
+            if self._result is None:
+                # Blocks completed by fill_zeroes() are not added yet.
+                h = self._hash.copy()
+                for index in range(self._next, self._count):
+                    h.add_digest(self._digests[index])
+                self._result = {
+                    "algorithm": self._algorithm,
+                    "block_size": self._block_size,
+                    "checksum": h.hexdigest(),
+                }
+
+            return self._result
+
+    def _add(self, offset, length, data):
+        pos = 0
+        while pos < length:
+            start = offset + pos
+            index = start // self._block_size
+            n = min(length - pos,
+                    (index + 1) * self._block_size - start)
+            if data is None:
+                ok = self._add_block(index, start, n, None)
+            else:
+                with memoryview(data)[pos:pos + n] as view:
+                    ok = self._add_block(index, start, n, view)
+            if not ok:
+                break
+            pos += n
+
+    def _add_block(self, index, start, length, data):
+        block_start = index * self._block_size
+        block_end = min(block_start + self._block_size, self._size)
+
+        with self._lock:
+            if self._failed:
+                return False
+
+            if start + length > block_end:
+                return self._fail(f"range {start}-{start + length} after end "
+                                  f"of image")
+
+            if self._completed(index):
+                if data is None and self._zero_blocks[index]:
+                    # Zeroing a zero block again does not change it.
+                    return True
+                if not self._tentative[index]:
+                    return self._fail(f"block {index} filled after it was "
+                                      f"completed")
+                # A block completed by fill_zeroes() is filled with data. The
+                # rest of the block will be filled again by the next
+                # fill_zeroes().
+                self._reopen(index)
+
+            fast = False
+            block = self._partial.get(index)
+            if block is None:
+                block = self._partial[index] = _PartialBlock(
+                    block_start, block_end)
+                if start == block_start and length == len(block):
+                    # Fast path, hashing the data without copying.
+                    if data is None:
+                        self._add_digest(
+                            index, self._hash.zero_digest(length))
+                        return True
+                    block.hashing = fast = True
+            elif block.hashing:
+                return self._fail(f"block {index} filled while hashing")
+
+            if not fast:
+                if data is not None and block.buffer is None:
+                    if (self._partial_size + len(block) >
+                            self._max_partial_size):
+                        return self._fail("too many incomplete blocks")
+                    block.buffer = bytearray(len(block))
+                    self._partial_size += len(block)
+                block.writers += 1
+
+        if fast:
+            digest = self._hash.block_digest(data)
+            with self._lock:
+                self._add_digest(index, digest)
+            return True
+
+        # Copy without holding the lock, so other blocks can be filled in
+        # parallel.
+        if block.buffer is not None:
+            pos = start - block_start
+            with memoryview(block.buffer)[pos:pos + length] as view:
+                if data is None:
+                    _zero_view(view)
+                else:
+                    view[:] = data
+
+        with self._lock:
+            block.writers -= 1
+            block.filled.add(measure.Range(start, start + length))
+            complete = self._start_hashing(block)
+
+        if complete:
+            self._complete(index, block)
+
+        return True
+
+    def _fill_block(self, index, start, length):
+        block_start = index * self._block_size
+        block_end = min(block_start + self._block_size, self._size)
+
+        with self._lock:
+            if self._failed or self._completed(index):
+                return
+
+            block = self._partial.get(index)
+            if block is None:
+                block = self._partial[index] = _PartialBlock(
+                    block_start, block_end)
+            elif block.writers or block.hashing:
+                # Being filled by other threads.
+                return
+
+            # Ranges not filled yet are zero in the buffer.
+            block.filled.add(measure.Range(start, start + length))
+            complete = self._start_hashing(block)
+
+        if complete:
+            self._complete(index, block, tentative=block.buffer is None)
+
+    def _completed(self, index):
+        # Must be called with self._lock held.
+        return index < self._next or index in self._digests
+
+    def _start_hashing(self, block):
+        # Must be called with self._lock held.
+        if block.writers or not block.complete():
+            return False
+        block.hashing = True
+        return True
+
+    def _complete(self, index, block, tentative=False):
+        # Hash without holding the lock, so other blocks can be hashed in
+        # parallel.
+        if block.buffer is not None:
+            digest = self._hash.block_digest(block.buffer)
+        else:
+            digest = self._hash.zero_digest(len(block))
+
+        with self._lock:
+            self._add_digest(index, digest, tentative=tentative)
+
+    def _add_digest(self, index, digest, tentative=False):
+        # Must be called with self._lock held.
+        if self._failed:
+            return
+        block = self._partial.pop(index)
+        if block.buffer is not None:
+            self._partial_size -= len(block.buffer)
+        block_start = index * self._block_size
+        length = min(self._block_size, self._size - block_start)
+        if digest == self._hash.zero_digest(length):
+            self._zero_blocks[index] = 1
+        self._tentative[index] = tentative
+        self._digests[index] = digest
+        while self._next in self._digests and not self._tentative[self._next]:
+            self._hash.add_digest(self._digests.pop(self._next))
+            self._next += 1
+
+    def _reopen(self, index):
+        # Must be called with self._lock held.
+        del self._digests[index]
+        self._tentative[index] = 0
+        self._zero_blocks[index] = 0
+        self._result = None
+
+    def _fail(self, reason):
+        # Must be called with self._lock held.
+        log.warning("Cannot compute checksum: %s", reason)
+        self._failed = True
+        self._partial.clear()
+        self._partial_size = 0
+        self._digests.clear()
+        return False
+
+
+class _PartialBlock:
+    """
+    A block being filled. Data is copied to the buffer, allocated when the
+    first data range is filled. Ranges without data are zero.
+    """
+
+    __slots__ = ("start", "end", "filled", "buffer", "writers", "hashing")
+
+    def __init__(self, start, end):
+        self.start = start
+        self.end = end
+        self.filled = measure.RangeList()
+        self.buffer = None
+        # Number of threads filling this block.
+        self.writers = 0
+        self.hashing = False
+
+    def complete(self):
+        if len(self.filled) != 1:
+            return False
+        r = next(iter(self.filled))
+        return r.start == self.start and r.end == self.end
+
+    def __len__(self):
+        return self.end - self.start
+
+
+def _zero_view(view):
+    with memoryview(_ZERO_BUFFER) as zero:
+        pos = 0
+        while pos < len(view):
+            n = min(len(view) - pos, len(zero))
+            view[pos:pos + n] = zero[:n]
+            pos += n
+
+
 def _read_block(f, length, buf):
     pos = 0
     while pos < length:
@@ -204,3 +864,25 @@ def split(extents, block_size=BLOCK_SIZE):
 
     if partial:
         yield partial
+
+
+def clip(extents, start, end):
+    """
+    Generate stream of blocks from extents stream, restricted to the range
+    start-end. Used to compute the checksum of part of an image by splitting
+    the clipped extents.
+
+    Extents:  |   data   |     zero     |   data   |
+    Range:          |          |
+    Blocks:         |data| zero|
+    """
+    for extent in extents:
+        extent_end = extent.start + extent.length
+        if extent_end <= start:
+            continue
+        if extent.start >= end:
+            break
+
+        block_start = max(extent.start, start)
+        block_end = min(extent_end, end)
+        yield Block(block_start, block_end - block_start, extent.zero)
@@ -0,0 +1,298 @@
+# SPDX-FileCopyrightText: Red Hat, Inc.
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+"""
+coalesce - merge small adjacent writes into large writes.
+
+Some clients upload an image using many small PUT requests. With the file
+backend, every write shorter than the block size, or starting at unaligned
+offset, is performed using a read-modify-write cycle. Uploading an image 4 KiB
+at a time to storage with 4096 bytes block size is slow; with unaligned
+requests it is much slower.
+
+The Buffer object is shared by all connections writing to the same ticket. It
+keeps small adjacent writes in memory, and writes them to storage in one large
+write when:
+
+- the next write is not adjacent to the buffered data
+- the buffer is full
+- the buffered data is older than the timeout
+- the client reads, zeroes, flushes, or queries the image
+- the connection is closed
+
+Since the buffer is drained before any other operation, clients always read
+their own writes, regardless of the connection used for reading.
+"""
+
+import logging
+import os
+import threading
+
+from . import util
+
+log = logging.getLogger("coalesce")
+
+# The buffered data is stored at the same offset within a page as the data in
+# the image, so after writing the first partial block the rest of the buffer is
+# aligned for direct I/O. Must be a multiple of any backend block size.
+ALIGNMENT = 4096
+
+
+class Buffer:
+    """
+    Write buffer shared by all connections of a ticket.
+
+    The lock protects only the buffer state; storage I/O is done without
+    holding the lock, so connections of the same ticket write concurrently.
+    When buffered data must be written, the buffer is swapped with a spare
+    buffer, and new writes are buffered while the swapped data is written.
+    Only one swapped buffer is written at a time.
+    """
+
+    def __init__(self, size, timeout):
+        """
+        Arguments:
+            size (int): maximum number of bytes to buffer. Writes of size or
+                more bytes are not buffered.
+            timeout (float): maximum time in seconds to keep data in the
+                buffer. The timeout is checked when writing to the buffer.
+        """
+        self._size = size
+        self._timeout = timeout
+        self._cond = threading.Condition(threading.Lock())
+        # Allocated on the first buffered write.
+        self._buf = None
+        self._start = 0
+        self._length = 0
+        self._time = None
+        # Swapped buffer waiting to be written, (buf, start, length).
+        self._flushing = None
+        # True while a thread is writing the swapped buffer.
+        self._busy = False
+        # Returned after writing the swapped buffer.
+        self._spare = None
+        # Number of buffers swapped and written, used to wait until buffered
+        # data is written.
+        self._swaps = 0
+        self._written = 0
+
+    @property
+    def pending(self):
+        """
+        Return the number of buffered bytes not written yet to storage.
+        """
+        flushing = self._flushing
+        return self._length + (flushing[2] if flushing else 0)
+
+    def write(self, backend, offset, buf):
+        """
+        Write buf at offset, using backend if data must be written now.
+
+        Returns the number of bytes written or buffered.
+        """
+        length = len(buf)
+
+        if length >= self._size:
+            # Large write, nothing to merge. Buffered data overlapping this
+            # write must be written first, so it does not overwrite this
+            # write later.
+            with self._cond:
+                if self._overlaps(offset, length):
+                    self._drain(backend)
+            backend.seek(offset)
+            return backend.write(buf)
+
+        with self._cond:
+            while not (self._length and
+                       offset == self._start + self._length and
+                       self._length + length <= self._size):
+                if not self._length:
+                    self._start = offset
+                    self._time = util.monotonic_time()
+                    if self._buf is None:
+                        self._buf = util.aligned_buffer(
+                            self._size + ALIGNMENT)
+                    break
+                # Waiting for the swapped buffer releases the lock, so other
+                # writes may be buffered meanwhile.
+                self._swap(backend)
+
+            pos = self._start % ALIGNMENT + self._length
+            self._buf[pos:pos + length] = buf
+            self._length += length
+
+            if (self._length == self._size or
+                    util.monotonic_time() - self._time >= self._timeout):
+                self._swap(backend)
+
+            if self._flushing and not self._busy:
+                self._write_flushing(backend)
+
+            return length
+
+    def drain(self, backend):
+        """
+        Write buffered data to storage using backend. Returns when all data
+        buffered before this call was written.
+        """
+        with self._cond:
+            self._drain(backend)
+
+    def _drain(self, backend):
+        # Must be called with the lock held.
+        if self._length:
+            self._swap(backend)
+
+        target = self._swaps
+        while self._written < target:
+            if self._busy:
+                self._cond.wait()
+            else:
+                self._write_flushing(backend)
+
+    def _overlaps(self, offset, length):
+        # Must be called with the lock held.
+        end = offset + length
+        if self._length and (offset < self._start + self._length and
+                             self._start < end):
+            return True
+        if self._flushing:
+            _, start, n = self._flushing
+            if offset < start + n and start < end:
+                return True
+        return False
+
+    def _swap(self, backend):
+        """
+        Move buffered data to the flushing slot, writing previously swapped
+        data first. Must be called with the lock held.
+        """
+        while self._flushing:
+            if self._busy:
+                self._cond.wait()
+            else:
+                self._write_flushing(backend)
+
+        if not self._length:
+            # Written by another thread while we waited.
+            return
+
+        self._flushing = (self._buf, self._start, self._length)
+        self._buf = self._spare
+        self._spare = None
+        self._length = 0
+        self._time = None
+        self._swaps += 1
+
+    def _write_flushing(self, backend):
+        """
+        Write swapped data using backend. Must be called with the lock held;
+        the lock is released during I/O.
+        """
+        buf, start, length = self._flushing
+        self._busy = True
+        self._cond.release()
+        try:
+            log.debug("Draining write buffer start=%s length=%s",
+                      start, length)
+
+            skip = start % ALIGNMENT
+            backend.seek(start)
+            with memoryview(buf)[skip:skip + length] as view:
+                pos = 0
+                while pos < length:
+                    with view[pos:] as v:
+                        pos += backend.write(v)
+        finally:
+            self._cond.acquire()
+            self._busy = False
+            self._cond.notify_all()
+
+        # Cleared only after a successful write, so the next drain will retry
+        # if writing failed.
+        self._flushing = None
+        self._spare = buf
+        self._written += 1
+
+
+class Backend:
+    """
+    Backend wrapper coalescing small writes using a shared buffer.
+    """
+
+    def __init__(self, backend, buffer):
+        self._backend = backend
+        self._buffer = buffer
+        self._position = backend.tell()
+
+    # io.FileIO interface
+
+    def readinto(self, buf):
+        self._buffer.drain(self._backend)
+        self._backend.seek(self._position)
+        n = self._backend.readinto(buf)
+        self._position += n
+        return n
+
+    def write(self, buf):
+        n = self._buffer.write(self._backend, self._position, buf)
+        self._position += n
+        return n
+
+    def tell(self):
+        return self._position
+
+    def seek(self, pos, how=os.SEEK_SET):
+        if how == os.SEEK_SET:
+            self._position = pos
+        elif how == os.SEEK_CUR:
+            self._position += pos
+        elif how == os.SEEK_END:
+            self._position = self.size() + pos
+        return self._position
+
+    def close(self):
+        try:
+            self._buffer.drain(self._backend)
+        finally:
+            self._backend.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, t, v, tb):
+        try:
+            self.close()
+        except Exception:
+            # Do not hide the original error.
+            if t is None:
+                raise
+            log.exception("Error closing")
+
+    # Backend interface.
+
+    def zero(self, count):
+        self._buffer.drain(self._backend)
+        self._backend.seek(self._position)
+        n = self._backend.zero(count)
+        self._position += n
+        return n
+
+    def flush(self):
+        self._buffer.drain(self._backend)
+        self._backend.flush()
+
+    def extents(self, context="zero", offset=0, length=None):
+        self._buffer.drain(self._backend)
+        return self._backend.extents(context, offset=offset, length=length)
+
+    def size(self):
+        self._buffer.drain(self._backend)
+        return self._backend.size()
+
+    @property
+    def dirty(self):
+        return self._backend.dirty or self._buffer.pending > 0
+
+    def __getattr__(self, name):
+        return getattr(self._backend, name)
@@ -21,6 +21,21 @@ class daemon:
     # creating an image transfer.
     inactivity_timeout = 60
 
+    # Detect all-zero blocks in uploaded data, and zero them instead of
+    # writing zeroes to storage. When the ticket is sparse, zeroing
+    # deallocates space. Clients can override this value when creating a
+    # ticket.
+    detect_zeroes = False
+
+    # Number of threads computing block digests for a checksum request.
+    # The checksum does not depend on the number of threads.
+    checksum_workers = 4
+
+    # Directory for caching image block digests, speeding up computing the
+    # checksum of the same image again. Only regular files accessed using a
+    # file url are cached. Empty value disables the cache.
+    checksum_cache_dir = ""
+
     # Daemon run directory. Runtime stuff like socket or profile information
     # will be stored in this directory.
     # This is configurable only for development purposes and is not expected to
@@ -86,6 +101,18 @@ class backend_file:
     # TODO: Tested with single writer, needs testing with multiple readers.
     buffer_size = 8 * MiB
 
+    # Maximum number of bytes of small adjacent writes to merge in memory
+    # before writing them to storage. The buffer is shared by all connections
+    # writing to the same ticket. This speeds up uploads from clients sending
+    # many small or unaligned requests. Writes of this size or larger are not
+    # buffered. Use 0 to disable write coalescing.
+    coalesce_size = 0
+
+    # Maximum number of seconds to keep merged writes in memory. The timeout
+    # is checked when writing; buffered data is always written to storage
+    # before reading, zeroing, flushing, or closing the connection.
+    coalesce_timeout = 1.0
+
 
 class backend_http:
 
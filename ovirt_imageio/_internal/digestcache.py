@@ -0,0 +1,389 @@
+# SPDX-FileCopyrightText: Red Hat, Inc.
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+"""
+digestcache - persistent cache of image block digests.
+
+Computing a checksum reads the entire image, but the checksum is computed
+from independent block digests (see blkhash). When verifying the same image
+again, only blocks modified since the last checksum must be read and hashed.
+
+The cache keeps the block digests of an image in a file in the cache
+directory. The file name is derived from the image identity (device and
+inode), the algorithm and the block size. Only regular files accessed using
+a file url have a stable identity. Other images are not cached:
+
+- Block devices: writes by other programs do not change the modification
+  time of the device node, and the device and inode of a device node may be
+  reused for another logical volume.
+- Images accessed using nbd url, including incremental backups: the
+  underlying image is not known, and changes made by the guest are not
+  tracked. Invalidating blocks using dirty extents is not implemented.
+
+The cache is stamped with the image size and modification time. Every write
+or zero operation on this host drops the digests of the modified blocks and
+records the new modification time. If the image was modified outside of
+imageio, its modification time does not match the stamp, and the entire
+cache is dropped.
+
+File format (integers are little endian):
+
+    magic         8 bytes         b"IMGIODC2"
+    image size    8 bytes
+    image mtime   8 bytes         nanoseconds
+    block size    8 bytes
+    digest size   4 bytes
+    algorithm     32 bytes        ascii, padded with zeroes
+    bitmap        count bytes     1 if the block digest is valid
+    digests       count * digest size bytes
+"""
+
+import logging
+import os
+import stat
+import struct
+import threading
+from collections import namedtuple
+
+from . import measure
+
+log = logging.getLogger("digestcache")
+
+MAGIC = b"IMGIODC2"
+HEADER = struct.Struct("<8sQQQI32s")
+
+# Merge modified ranges of an image when there are too many, to limit memory
+# usage. Dropping more digests is always safe.
+MAX_MODIFIED_RANGES = 1024
+
+# Stable identity of an image. key is derived from the device and inode of
+# the image, mtime is the image modification time in nanoseconds.
+Image = namedtuple("Image", "key,size,mtime")
+
+# Protects cache files, _generations, and _modified.
+_lock = threading.Lock()
+
+# Incremented when an image is modified, so digests computed before the image
+# was modified are not saved.
+_generations = {}
+
+# Image modifications not applied to the cache files yet, keyed by image key.
+_modified = {}
+
+
+class _Modified:
+
+    def __init__(self, mtime):
+        # Image modification time before the first modification.
+        self.base_mtime = mtime
+        # Image modification time after the last modification.
+        self.mtime = mtime
+        self.ranges = measure.RangeList()
+
+
+def image(url):
+    """
+    Return the identity of image url, or None if the image does not have a
+    stable identity.
+
+    Arguments:
+        url (urllib.parse.ParseResult): image url.
+    """
+    if url.scheme != "file":
+        return None
+
+    st = os.stat(url.path)
+    if not stat.S_ISREG(st.st_mode):
+        return None
+
+    return Image(f"{st.st_dev:x}-{st.st_ino:x}", st.st_size, st.st_mtime_ns)
+
+
+def start_write(url):
+    """
+    Must be called before modifying image url.
+
+    Records the modification time of the image before the first
+    modification, so changes made outside of imageio are detected.
+    """
+    img = image(url)
+    if img is None:
+        return
+
+    with _lock:
+        if img.key not in _modified:
+            _modified[img.key] = _Modified(img.mtime)
+
+
+def end_write(url, start, length):
+    """
+    Must be called after modifying length bytes at start in image url,
+    even if the operation failed.
+
+    Drops the digests of the modified blocks. Digests computed while the
+    image was modified are not saved.
+    """
+    img = image(url)
+    if img is None:
+        return
+
+    with _lock:
+        _generations[img.key] = _generations.get(img.key, 0) + 1
+
+        mod = _modified.get(img.key)
+        if mod is None:
+            # start_write() was not called, or the modifications were applied
+            # by load() while this operation was running. The cache will be
+            # stamped again only if the image was not modified since.
+            mod = _modified[img.key] = _Modified(None)
+
+        mod.mtime = img.mtime
+        mod.ranges.add(measure.Range(start, start + length))
+        if len(mod.ranges) > MAX_MODIFIED_RANGES:
+            first = next(iter(mod.ranges))
+            end = max(r.end for r in mod.ranges)
+            mod.ranges = measure.RangeList()
+            mod.ranges.add(measure.Range(first.start, end))
+
+
+def sync(cache_dir, url):
+    """
+    Apply image url modifications to the cache files. Should be called when
+    the image is not used by imageio, to release memory.
+    """
+    img = image(url)
+    if img is None:
+        return
+
+    with _lock:
+        _apply(cache_dir, img.key)
+
+
+class Cache:
+    """
+    Block digests of an image.
+    """
+
+    def __init__(self, path, size, mtime, block_size, algorithm, digest_size,
+                 key=None, generation=None):
+        self._path = path
+        self._size = size
+        self._mtime = mtime
+        self._block_size = block_size
+        self._algorithm = algorithm
+        self._digest_size = digest_size
+        self._key = key
+        self._generation = generation
+        self._count = (size + block_size - 1) // block_size
+        self._valid = bytearray(self._count)
+        self._digests = bytearray(self._count * digest_size)
+        self._modified = False
+
+    @classmethod
+    def load(cls, cache_dir, url, size, block_size, algorithm, digest_size):
+        """
+        Load the cache of image url from the cache directory. If the cache
+        does not exist or does not match the image, return an empty cache.
+        If the image does not have a stable identity, return None.
+
+        Arguments:
+            cache_dir (str): cache directory.
+            url (urllib.parse.ParseResult): image url.
+            size (int): image size in bytes.
+            block_size (int): checksum block size in bytes.
+            algorithm (str): checksum algorithm.
+            digest_size (int): size of block digest in bytes.
+        """
+        with _lock:
+            # Apply modifications before looking up the image, so the cache
+            # is stamped with the modification time after the last write.
+            img = image(url)
+            if img is None:
+                log.debug("Image %s has no stable identity, not using "
+                          "digest cache", url.geturl())
+                return None
+
+            _apply(cache_dir, img.key)
+            img = image(url)
+
+            path = os.path.join(
+                cache_dir, f"{img.key}-{algorithm}-{block_size}")
+            generation = _generations.get(img.key, 0)
+            try:
+                cache = cls.open(path)
+            except FileNotFoundError:
+                cache = None
+            except (OSError, ValueError) as e:
+                log.warning("Ignoring invalid digest cache %s: %s", path, e)
+                cache = None
+
+        params = (size, img.mtime, block_size, algorithm, digest_size)
+        if cache and cache._params() != params:
+            log.info("Ignoring digest cache %s for modified image %s",
+                     path, cache._params())
+            cache = None
+
+        if cache is None:
+            cache = cls(path, *params)
+
+        cache._key = img.key
+        cache._generation = generation
+        return cache
+
+    @classmethod
+    def open(cls, path):
+        """
+        Open existing cache file.
+
+        Raises ValueError if the file is invalid.
+        """
+        with open(path, "rb") as f:
+            data = f.read()
+
+        if len(data) < HEADER.size:
+            raise ValueError("File too short")
+
+        (magic, size, mtime, block_size, digest_size,
+         algorithm) = HEADER.unpack_from(data)
+        if magic != MAGIC:
+            raise ValueError(f"Invalid magic: {magic!r}")
+
+        algorithm = algorithm.rstrip(b"\0").decode("ascii")
+        cache = cls(path, size, mtime, block_size, algorithm, digest_size)
+
+        expected = HEADER.size + cache._count * (1 + digest_size)
+        if len(data) != expected:
+            raise ValueError(
+                f"Invalid file size: {len(data)}, expected {expected}")
+
+        pos = HEADER.size
+        cache._valid[:] = data[pos:pos + cache._count]
+        pos += cache._count
+        cache._digests[:] = data[pos:]
+
+        return cache
+
+    def get(self, index):
+        """
+        Return the digest of block index, or None if not cached.
+        """
+        if not self._valid[index]:
+            return None
+        start = index * self._digest_size
+        return bytes(self._digests[start:start + self._digest_size])
+
+    def set(self, index, digest):
+        """
+        Set the digest of block index.
+        """
+        if len(digest) != self._digest_size:
+            raise ValueError(f"Invalid digest size: {len(digest)}")
+        start = index * self._digest_size
+        self._digests[start:start + self._digest_size] = digest
+        self._valid[index] = 1
+        self._modified = True
+
+    def invalidate(self, start, length):
+        """
+        Drop digests of blocks overlapping byte range.
+        """
+        if length <= 0 or start >= self._size:
+            return
+        first = start // self._block_size
+        last = min((start + length - 1) // self._block_size, self._count - 1)
+        for index in range(first, last + 1):
+            if self._valid[index]:
+                self._valid[index] = 0
+                self._modified = True
+
+    def save(self):
+        """
+        Save the cache if modified, unless the image was modified since the
+        cache was loaded.
+        """
+        if not self._modified:
+            return
+
+        with _lock:
+            if _generations.get(self._key, 0) != self._generation:
+                log.debug("Image modified since loading %s, not saving",
+                          self._path)
+                return
+
+            self._write()
+
+    def _params(self):
+        return (self._size, self._mtime, self._block_size, self._algorithm,
+                self._digest_size)
+
+    def _write(self):
+        # Must be called with _lock held.
+        if not self._modified:
+            return
+
+        header = HEADER.pack(
+            MAGIC,
+            self._size,
+            self._mtime,
+            self._block_size,
+            self._digest_size,
+            self._algorithm.encode("ascii"))
+
+        tmp = self._path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(header)
+            f.write(self._valid)
+            f.write(self._digests)
+        os.replace(tmp, self._path)
+
+        self._modified = False
+
+
+def _apply(cache_dir, key):
+    """
+    Drop digests of modified blocks from all cache files of image key, and
+    stamp the cache files with the modification time after the last
+    modification. Cache files stamped with another time than the time
+    before the first modification are removed, since the image was also
+    modified outside of imageio.
+
+    Must be called with _lock held.
+    """
+    mod = _modified.pop(key, None)
+    if mod is None:
+        return
+
+    try:
+        names = os.listdir(cache_dir)
+    except FileNotFoundError:
+        return
+
+    for name in names:
+        if not name.startswith(key + "-") or name.endswith(".tmp"):
+            continue
+
+        path = os.path.join(cache_dir, name)
+        try:
+            cache = Cache.open(path)
+        except (OSError, ValueError) as e:
+            log.warning("Removing invalid digest cache %s: %s", path, e)
+            _silent_remove(path)
+            continue
+
+        if cache._mtime != mod.base_mtime:
+            log.info("Removing digest cache %s for modified image", path)
+            _silent_remove(path)
+            continue
+
+        for r in mod.ranges:
+            cache.invalidate(r.start, len(r))
+        cache._mtime = mod.mtime
+        cache._modified = True
+        cache._write()
+
+
+def _silent_remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
@@ -92,3 +92,52 @@ class DirtyExtent(namedtuple("DirtyExtent", "start,length,dirty,zero")):
             "dirty": self.dirty,
             "zero": self.zero,
         }
+
+
+class WrittenExtent(namedtuple("WrittenExtent", "start,length,written")):
+    """
+    An image extent describing areas written using a ticket. This information
+    is tracked by the server for tickets allowing writes, and can be used to
+    resume an interrupted upload.
+
+    Fields:
+        start (int): offset in bytes.
+        length (int): lenth in bytes.
+        written (bool): if True, this area was written using the ticket.
+    """
+    __slots__ = ()
+
+    @classmethod
+    def from_dict(cls, d):
+        """
+        Create instance from dict generated by to_dict().
+        """
+        return cls(d["start"], d["length"], d["written"])
+
+    def to_dict(self):
+        """
+        Crate dict representation.
+        """
+        return {
+            "start": self.start,
+            "length": self.length,
+            "written": self.written,
+        }
+
+
+def clip(extents, offset, length=None):
+    """
+    Generate extents overlapping the range starting at offset with length
+    bytes, clipped to the range. If length is None, the range extends to the
+    end of the image.
+    """
+    end = None if length is None else offset + length
+    for ext in extents:
+        ext_end = ext.start + ext.length
+        if ext_end <= offset:
+            continue
+        if end is not None and ext.start >= end:
+            break
+        start = max(ext.start, offset)
+        stop = ext_end if end is None else min(ext_end, end)
+        yield ext._replace(start=start, length=stop - start)
@@ -0,0 +1,123 @@
+# SPDX-FileCopyrightText: Red Hat, Inc.
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+"""
+groupcommit - merge concurrent flushes of the same image.
+
+By default every PUT request flushes data to storage before returning a
+response. When uploading with multiple connections, every connection flushes
+after every request, so the storage sees many back-to-back flushes for the
+same image.
+
+When flushing on one connection flushes changes written by all connections
+(e.g. fsync() on a file, or NBD server supporting multiple connections), we
+can merge flushes. A flush request arriving while another flush is in flight
+waits until the current flush completes, and then is satisfied by the next
+flush, flushing changes from all waiting requests at once.
+
+A request is completed only by a flush started after the request arrived, so
+all changes written before the request are flushed.
+"""
+
+import logging
+import threading
+
+log = logging.getLogger("groupcommit")
+
+
+class Coordinator:
+    """
+    Flush coordinator shared by all connections of a ticket.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        # Number of flush requests, used as the request sequence number.
+        self._requests = 0
+        # Sequence number of last request completed by a successful flush.
+        self._completed = 0
+        # True when a flush is in flight.
+        self._running = False
+        # Number of flushes sent to storage.
+        self._flushes = 0
+        # Number of requests completed by another request flush.
+        self._coalesced = 0
+
+    def flush(self, backend):
+        """
+        Flush changes written before this call, using backend if there is no
+        flush in flight that can complete this request.
+        """
+        with self._cond:
+            self._requests += 1
+            seq = self._requests
+
+            while self._running:
+                self._cond.wait()
+
+            # Flush started after this request was completed while we waited.
+            if self._completed >= seq:
+                self._coalesced += 1
+                return
+
+            # Flush all requests received until now.
+            self._running = True
+            last = self._requests
+
+        try:
+            backend.flush()
+        except BaseException:
+            with self._cond:
+                self._running = False
+                # Wake up waiters so one of them can try again.
+                self._cond.notify_all()
+            raise
+
+        with self._cond:
+            self._running = False
+            self._completed = last
+            self._flushes += 1
+            self._cond.notify_all()
+
+    def stats(self):
+        """
+        Return dict with number of flush requests, flushes sent to storage,
+        and requests completed by another request flush.
+        """
+        with self._cond:
+            return {
+                "requests": self._requests,
+                "flushes": self._flushes,
+                "coalesced": self._coalesced,
+            }
+
+
+class Backend:
+    """
+    Backend wrapper flushing using a shared coordinator.
+    """
+
+    def __init__(self, backend, coordinator):
+        self._backend = backend
+        self._coordinator = coordinator
+
+    def flush(self):
+        self._coordinator.flush(self._backend)
+
+    def close(self):
+        self._backend.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, t, v, tb):
+        try:
+            self.close()
+        except Exception:
+            # Do not hide the original error.
+            if t is None:
+                raise
+            log.exception("Error closing")
+
+    def __getattr__(self, name):
+        return getattr(self._backend, name)
@@ -3,12 +3,13 @@
 
 import hashlib
 import logging
+from functools import partial
 
 from .. import backends
 from .. import blkhash
+from .. import digestcache
 from .. import errors
 from .. import http
-from .. import ioutil
 from .. import ops
 from .. import util
 from .. import validate
@@ -27,6 +28,8 @@ class Checksum:
     Handle requests for the /images/ticket-id/checksum resource.
     """
 
+    name = "checksum"
+
     def __init__(self, config, auth):
         self.config = config
         self.auth = auth
@@ -58,27 +61,127 @@ class Checksum:
             raise http.Error(
                 http.BAD_REQUEST, "Block size is not aligned to 4096")
 
+        # Optional range, for verifying part of the image.
+        ranged = "offset" in req.query or "length" in req.query
+        offset = _query_int(req, "offset", 0)
+        length = _query_int(req, "length", None)
+
         try:
             ticket = self.auth.authorize(ticket_id, "read")
             ctx = backends.get(req, ticket, self.config)
         except errors.AuthorizationError as e:
             raise http.Error(http.FORBIDDEN, str(e))
 
-        log.info("[%s] CHECKSUM transfer=%s algorithm=%s block_size=%s",
-                 req.client_addr, ticket.transfer_id, algorithm, block_size)
-
-        # For simplicity we create a new buffer even if block_size is same as
-        # ctx.buffer length.
+        if length is None:
+            length = max(ctx.backend.size() - offset, 0)
+        if ranged:
+            validate.available_range(offset, length, ticket, ctx.backend)
+
+        log.info("[%s] %s transfer=%s algorithm=%s block_size=%s "
+                 "offset=%s length=%s",
+                 req.client_addr, self.name.upper(),
+                 ticket.transfer_id, algorithm, block_size, offset, length)
+
+        cache = None
+        if self.config.daemon.checksum_cache_dir:
+            cache = self._load_cache(
+                ticket, ctx.backend, algorithm, block_size)
+
+        op = self._operation(
+            resp,
+            ctx.backend,
+            block_size,
+            algorithm,
+            workers=self.config.daemon.checksum_workers,
+            cache=cache,
+            offset=offset,
+            length=length,
+            clock=req.clock)
+        try:
+            result = ticket.run(op)
+        except errors.AuthorizationError as e:
+            resp.close_connection()
+            raise http.Error(http.FORBIDDEN, str(e)) from None
 
-        with util.aligned_buffer(block_size) as buf:
-            op = Operation(ctx.backend, buf, algorithm, clock=req.clock)
+        if cache:
             try:
-                checksum = ticket.run(op)
-            except errors.AuthorizationError as e:
-                resp.close_connection()
-                raise http.Error(http.FORBIDDEN, str(e)) from None
+                cache.save()
+            except OSError:
+                log.exception("Error saving digest cache")
 
-        resp.send_json(checksum)
+        if ranged:
+            result["offset"] = offset
+            result["length"] = length
+
+        self._send(resp, result)
+
+    def _operation(self, resp, *args, **kwargs):
+        return Operation(*args, **kwargs)
+
+    def _send(self, resp, result):
+        resp.send_json(result)
+
+    def _load_cache(self, ticket, backend, algorithm, block_size):
+        """
+        Load the image digest cache. Returns None if the image cannot be
+        cached.
+        """
+        cache_dir = self.config.daemon.checksum_cache_dir
+        try:
+            return digestcache.Cache.load(
+                cache_dir,
+                ticket.url,
+                backend.size(),
+                block_size,
+                algorithm,
+                _digest_size(algorithm))
+        except OSError:
+            log.exception("Error loading digest cache for %s",
+                          ticket.url.geturl())
+            return None
+
+
+class BlockMap(Checksum):
+    """
+    Handle requests for the /images/ticket-id/blockmap resource.
+
+    Returns the digests of all image blocks, computed like the checksum of
+    the image. The response body is the concatenation of the block digests,
+    in the order of the blocks. Zero blocks are not read from storage.
+    """
+
+    name = "blockmap"
+
+    def _operation(self, resp, backend, block_size, algorithm, offset=0,
+                   length=None, **kwargs):
+        # Computing the block map of a large image can take more time than
+        # the client timeout, so we send the headers before computing the
+        # block map, and the block digests while computing it.
+        digest_size = _digest_size(algorithm)
+        count = (length + block_size - 1) // block_size
+        resp.headers["content-length"] = count * digest_size
+        resp.headers["content-type"] = "application/octet-stream"
+        resp.headers["x-algorithm"] = algorithm
+        resp.headers["x-block-size"] = block_size
+        resp.headers["x-digest-size"] = digest_size
+        if offset or length != backend.size():
+            resp.headers["x-offset"] = offset
+            resp.headers["x-length"] = length
+
+        return BlockMapOperation(
+            backend,
+            block_size,
+            algorithm,
+            offset=offset,
+            length=length,
+            dst=resp,
+            **kwargs)
+
+    def _send(self, resp, result):
+        # The block map was sent by the operation.
+        if not resp.started:
+            # Empty block map.
+            resp.write(b"")
 
 
 class Algorithms:
@@ -101,55 +204,228 @@ class Operation(ops.Operation):
     """
 
     name = "checksum"
+    hash_class = blkhash.Hash
 
-    def __init__(self, backend, buf, algorithm, detect_zeroes=True,
+    def __init__(self, backend, block_size, algorithm, detect_zeroes=True,
+                 workers=blkhash.WORKERS, cache=None, offset=0, length=None,
                  clock=None):
-        super().__init__(size=backend.size(), buf=buf, clock=clock)
+        """
+        If cache is specified, cached block digests are used instead of
+        reading the blocks, and computed block digests are added to the
+        cache.
+
+        If offset or length are specified, compute the checksum of length
+        bytes starting at offset, as if this range was the entire image.
+        """
+        self._image_size = backend.size()
+        if length is None:
+            length = self._image_size - offset
+        if offset + length > self._image_size:
+            raise ValueError(
+                "Range {}-{} out of image size {}".format(
+                    offset, offset + length, self._image_size))
+        super().__init__(size=length, offset=offset, clock=clock)
         self._backend = backend
+        self._block_size = block_size
         self._algorithm = algorithm
         self._detect_zeroes = detect_zeroes
+        self._workers = workers
+        self._cache = cache
 
     def _run(self):
-        block_size = len(self._buf)
-        # Only blakse2b and blake2s support variable digest size, and 32 works
-        # with both and is large enough.
-        if self._algorithm.startswith("blake2"):
-            digest_size = blkhash.DIGEST_SIZE
-        else:
-            digest_size = None
+        h = self._hash()
 
-        h = blkhash.Hash(
-            block_size=block_size,
-            algorithm=self._algorithm,
-            digest_size=digest_size)
+        # Data blocks are read in this thread, and hashed by the pipeline
+        # workers.
+        with blkhash.Pipeline(
+                h,
+                workers=self._workers,
+                detect_zeroes=self._detect_zeroes) as pipeline:
+            extents = self._backend.extents("zero")
+            if self._offset or self._size < self._image_size:
+                extents = blkhash.clip(
+                    extents, self._offset, self._offset + self._size)
+
+            for block in blkhash.split(extents, self._block_size):
+                self._hash_block(pipeline, block)
+                self._done += block.length
 
-        for block in blkhash.split(self._backend.extents("zero"), block_size):
-            if block.zero:
-                h.zero(block.length)
-            else:
-                with memoryview(self._buf)[:block.length] as view:
-                    self._backend.seek(block.start)
-                    self._backend.readinto(view)
-                    if self._detect_zeroes and ioutil.is_zero(view):
-                        h.zero(block.length)
-                    else:
-                        h.update(view)
+                if self._canceled:
+                    raise ops.Canceled
 
-            self._done += block.length
+            pipeline.complete()
 
-            if self._canceled:
-                raise ops.Canceled
+        return self._result(h)
 
+    def _hash(self):
+        return self.hash_class(
+            block_size=self._block_size,
+            algorithm=self._algorithm,
+            digest_size=_hash_digest_size(self._algorithm))
+
+    def _result(self, h):
         return {
             "algorithm": self._algorithm,
-            "block_size": block_size,
+            "block_size": self._block_size,
             "checksum": h.hexdigest(),
         }
 
+    def _hash_block(self, pipeline, block):
+        if block.zero:
+            pipeline.zero(block.length)
+            return
+
+        done = None
+        if self._cache and self._cacheable(block):
+            index = block.start // self._block_size
+            block_digest = self._cache.get(index)
+            if block_digest:
+                pipeline.add_digest(block_digest)
+                return
+            done = partial(self._cache.set, index)
+
+        buf = pipeline.buffer()
+        with memoryview(buf)[:block.length] as view:
+            self._read_block(block, view)
+        pipeline.update(buf, block.length, done=done)
+
+    def _read_block(self, block, view):
+        align = self._backend.block_size
+        end = block.start + block.length
+        if (block.start % align == 0 and
+                (end % align == 0 or end == self._image_size)):
+            self._backend.seek(block.start)
+            self._backend.readinto(view)
+            return
+
+        # Block at the edge of unaligned range. Read complete backend blocks
+        # since the backend may use direct I/O.
+        start = util.round_down(block.start, align)
+        length = util.round_up(end, align) - start
+        with util.aligned_buffer(length) as tmp:
+            self._backend.seek(start)
+            self._backend.readinto(tmp)
+            skip = block.start - start
+            view[:] = tmp[skip:skip + block.length]
+
+    def _cacheable(self, block):
+        """
+        Return True if block is an image block, so its digest can be shared
+        with checksums of other ranges. When using an unaligned range, blocks
+        are not aligned to image blocks, and the last block may be shorter.
+        """
+        if block.start % self._block_size:
+            return False
+        end = block.start + block.length
+        return (block.length == self._block_size or
+                end == self._image_size)
+
+
+class BlockMapOperation(Operation):
+    """
+    Block map operation.
+    """
+
+    name = "blockmap"
+    hash_class = blkhash.BlockMap
+
+    def __init__(self, *args, dst=None, **kwargs):
+        """
+        If dst is specified, the block digests are written to dst while
+        computing the block map, and the result does not include the block
+        map.
+        """
+        super().__init__(*args, **kwargs)
+        self._dst = dst
+
+    def _hash(self):
+        return self.hash_class(
+            block_size=self._block_size,
+            algorithm=self._algorithm,
+            digest_size=_hash_digest_size(self._algorithm),
+            write=self._write if self._dst else None)
+
+    def _write(self, data):
+        # Response.write() is replaced on the first call, so we must not
+        # keep a reference to it.
+        self._dst.write(data)
+
+    def _result(self, h):
+        result = {
+            "algorithm": self._algorithm,
+            "block_size": self._block_size,
+            "digest_size": h.digest_size,
+        }
+        if self._dst:
+            h.flush()
+        else:
+            result["block_map"] = h.block_map()
+        return result
+
+
+def compute(backend, block_size=blkhash.BLOCK_SIZE,
+            algorithm=blkhash.ALGORITHM, detect_zeroes=True,
+            workers=blkhash.WORKERS, offset=0, length=None):
+    """
+    Compute image checksum, or checksum of length bytes starting at offset.
+    """
+    op = Operation(
+        backend,
+        block_size,
+        algorithm,
+        detect_zeroes=detect_zeroes,
+        workers=workers,
+        offset=offset,
+        length=length)
+    return op.run()
+
+
+def _query_int(req, name, default):
+    value = req.query.get(name)
+    if value is None:
+        return default
+
+    try:
+        value = int(value)
+    except ValueError:
+        raise http.Error(
+            http.BAD_REQUEST, "Invalid {}: {!r}".format(name, value))
+
+    if value < 0:
+        raise http.Error(
+            http.BAD_REQUEST, "Negative {}: {}".format(name, value))
+
+    return value
+
+
+def _hash_digest_size(algorithm):
+    # Only blakse2b and blake2s support variable digest size, and 32 works
+    # with both and is large enough.
+    if algorithm.startswith("blake2"):
+        return blkhash.DIGEST_SIZE
+    return None
+
+
+def _digest_size(algorithm):
+    """
+    Return the size of block digest computed using algorithm.
+    """
+    return (_hash_digest_size(algorithm) or
+            hashlib.new(algorithm).digest_size)
+
 
-def compute(backend, buf, algorithm=blkhash.ALGORITHM, detect_zeroes=True):
+def block_map(backend, block_size=blkhash.BLOCK_SIZE,
+              algorithm=blkhash.ALGORITHM, detect_zeroes=True,
+              workers=blkhash.WORKERS, offset=0, length=None):
     """
-    Compute image checksum.
+    Compute image block map, or block map of length bytes starting at offset.
     """
-    op = Operation(backend, buf, algorithm, detect_zeroes=detect_zeroes)
+    op = BlockMapOperation(
+        backend,
+        block_size,
+        algorithm,
+        detect_zeroes=detect_zeroes,
+        workers=workers,
+        offset=offset,
+        length=length)
     return op.run()
@@ -0,0 +1,142 @@
+# SPDX-FileCopyrightText: Red Hat, Inc.
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import json
+import logging
+
+from .. import backends
+from .. import errors
+from .. import http
+from .. import ops
+
+log = logging.getLogger("copy")
+
+
+class Handler:
+    """
+    Handle requests for the /tickets/ticket-id/copy resource.
+
+    Copy the image of the source ticket to the image of the destination
+    ticket, without moving the data through a client. The request completes
+    when the copy is done. Progress is reported in both tickets "transferred"
+    value, and canceling either ticket cancels the copy.
+    """
+
+    def __init__(self, config, auth):
+        self.config = config
+        self.auth = auth
+
+    def post(self, req, resp, ticket_id):
+        if not ticket_id:
+            raise http.Error(http.BAD_REQUEST, "Ticket id is required")
+
+        # TODO: Reject requests with too big payload.
+        try:
+            msg = json.loads(req.read())
+        except ValueError as e:
+            raise http.Error(
+                http.BAD_REQUEST, "Invalid copy request: {}".format(e))
+
+        src_id = msg.get("src") if isinstance(msg, dict) else None
+        if not isinstance(src_id, str) or not src_id:
+            raise http.Error(
+                http.BAD_REQUEST, "Source ticket id is required")
+
+        if src_id == ticket_id:
+            raise http.Error(
+                http.BAD_REQUEST, "Cannot copy image to itself")
+
+        try:
+            src_ticket = self.auth.authorize(src_id, "read")
+            dst_ticket = self.auth.authorize(ticket_id, "write")
+        except errors.AuthorizationError as e:
+            raise http.Error(http.FORBIDDEN, str(e))
+
+        log.info("[%s] COPY src=%s dst=%s",
+                 req.client_addr, src_ticket.transfer_id,
+                 dst_ticket.transfer_id)
+
+        con_id = "copy/{}".format(req.connection_id)
+        src_ctx = self._add_context(src_ticket, con_id)
+        try:
+            dst_ctx = self._add_context(dst_ticket, con_id)
+            try:
+                self._copy(req, src_ticket, src_ctx, dst_ticket, dst_ctx)
+            finally:
+                dst_ticket.remove_context(con_id)
+        finally:
+            src_ticket.remove_context(con_id)
+
+    def _add_context(self, ticket, con_id):
+        ctx = backends.create_context(ticket, self.config)
+        try:
+            ticket.add_context(con_id, ctx)
+        except errors.AuthorizationError as e:
+            ctx.close()
+            raise http.Error(http.FORBIDDEN, str(e))
+        return ctx
+
+    def _copy(self, req, src_ticket, src_ctx, dst_ticket, dst_ctx):
+        size = min(src_ticket.size, src_ctx.backend.size())
+        available = min(dst_ticket.size, dst_ctx.backend.size())
+        if size > available:
+            raise http.Error(
+                http.BAD_REQUEST,
+                "Destination image is too small: {} < {}"
+                .format(available, size))
+
+        try:
+            extents = list(src_ctx.backend.extents("zero"))
+        except errors.UnsupportedOperation:
+            extents = None
+
+        op = ops.Copy(
+            src_ctx.backend,
+            dst_ctx.backend,
+            dst_ctx.buffer,
+            size,
+            extents=extents,
+            clock=req.clock)
+
+        try:
+            src_ticket.run(_Source(op, dst_ticket))
+        except errors.AuthorizationError as e:
+            raise http.Error(http.FORBIDDEN, str(e)) from None
+
+        if op.done < size:
+            # The copy was canceled.
+            raise http.Error(
+                http.FORBIDDEN,
+                "Copy was canceled after {} bytes".format(op.done))
+
+
+class _Source:
+    """
+    Bind a copy operation to the source ticket, while running the operation
+    using the destination ticket. The source ticket sees a read operation,
+    so it does not consider the image as modified.
+    """
+
+    name = "copy"
+
+    def __init__(self, op, dst_ticket):
+        self._op = op
+        self._dst_ticket = dst_ticket
+
+    @property
+    def size(self):
+        return self._op.size
+
+    @property
+    def offset(self):
+        return self._op.offset
+
+    @property
+    def done(self):
+        return self._op.done
+
+    def run(self):
+        return self._dst_ticket.run(self._op)
+
+    def cancel(self):
+        self._op.cancel()
@@ -32,19 +32,27 @@ class Handler:
             raise http.Error(http.FORBIDDEN, str(e))
 
         context = validate.enum(
-            req.query, "context", ("zero", "dirty"), default="zero")
+            req.query, "context", ("zero", "dirty", "written"),
+            default="zero")
 
         if context == "dirty" and not ticket.dirty:
             raise http.Error(
                 http.NOT_FOUND, "Ticket does not support dirty extents")
 
+        if context == "written" and not ticket.may("write"):
+            raise http.Error(
+                http.NOT_FOUND, "Ticket does not support written extents")
+
         log.info("[%s] EXTENTS transfer=%s context=%s",
                  req.client_addr, ticket.transfer_id, context)
 
         with req.clock.run("extents"):
             try:
-                extents = [ext.to_dict()
-                           for ext in ctx.backend.extents(context=context)]
+                if context == "written":
+                    extents = ticket.written_extents()
+                else:
+                    extents = ctx.backend.extents(context=context)
+                extents = [ext.to_dict() for ext in extents]
             except errors.UnsupportedOperation as e:
                 raise http.Error(http.NOT_FOUND, str(e))
 
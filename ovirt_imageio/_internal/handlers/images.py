@@ -13,7 +13,7 @@ from .. import validate
 
 log = logging.getLogger("images")
 
-BASE_FEATURES = ("checksum", "extents")
+BASE_FEATURES = ("blockmap", "checksum", "extents")
 ALL_FEATURES = BASE_FEATURES + ("flush", "zero")
 
 
@@ -67,6 +67,8 @@ class Handler:
             size,
             offset=offset,
             flush=flush,
+            detect_zeroes=ticket.detect_zeroes,
+            accumulator=ticket.accumulator,
             clock=req.clock)
         try:
             ticket.run(op)
@@ -132,12 +134,24 @@ class Handler:
             resp.headers["content-range"] = "bytes %d-%d/%d" % (
                 offset, offset + size - 1, ticket.size)
 
+        # Send zero areas without reading from storage. The extents must be
+        # current, since the image may be modified by other tickets, so we
+        # get the extents for the requested range on every request.
+        try:
+            with req.clock.run("extents"):
+                extents = list(ctx.backend.extents(
+                    "zero", offset=offset, length=size))
+        except errors.UnsupportedOperation:
+            extents = None
+
         op = ops.Read(
             ctx.backend,
             resp,
             ctx.buffer,
             size,
             offset=offset,
+            extents=extents,
+            accumulator=ticket.accumulator,
             clock=req.clock)
         try:
             ticket.run(op)
@@ -190,6 +204,7 @@ class Handler:
             size,
             offset=offset,
             flush=flush,
+            accumulator=ticket.accumulator,
             clock=req.clock)
 
         try:
@@ -219,6 +234,16 @@ class Handler:
             resp.close_connection()
             raise http.Error(http.FORBIDDEN, str(e)) from None
 
+        # Clients skip zero areas when uploading to a new image, so the
+        # checksum can be completed only using the image zero extents. Areas
+        # being written by other connections read as zero, so wait for the
+        # last flush.
+        accumulator = ticket.accumulator
+        if (accumulator and not ticket.writing() and
+                accumulator.result() is None):
+            with req.clock.run("extents"):
+                accumulator.fill_zeroes(ctx.backend.extents("zero"))
+
     @cors.allow(allow_methods="OPTIONS,GET,PUT")
     def options(self, req, resp, ticket_id):
         if not ticket_id:
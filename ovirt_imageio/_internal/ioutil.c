@@ -80,10 +80,56 @@ blksszget(PyObject *self, PyObject *args)
     return PyLong_FromLong(res);
 }
 
+/*
+ * Checking smaller buffers is faster than releasing and acquiring the GIL,
+ * and releasing the GIL for short time may delay this thread if other
+ * threads are waiting for the GIL.
+ */
+#define RELEASE_GIL_SIZE (1024 * 1024)
+
+/*
+ * Return 1 if buffer is full of zeros.
+ *
+ * Based on Rusty Russell's memeqzero.
+ *
+ * dd is using a fancier version, optimized for very small bufferes.
+ * In the context of imageio, we care only about big buffers, so we
+ * use the origianl simpler and elegant version.
+ *
+ * After checking the first 16 bytes, memcmp compares the buffer with
+ * itself, using the vectorized memcmp implementation of the C library.
+ *
+ * See http://rusty.ozlabs.org/?p=560 for more info.
+ */
+static int
+buf_is_zero(const unsigned char *buf, size_t len)
+{
+    const unsigned char *p = buf;
+    size_t i;
+
+    /* Check first 16 bytes manually. */
+    for (i = 0; i < 16; i++) {
+        if (len == 0)
+            return 1;
+
+        if (*p)
+            return 0;
+
+        p++;
+        len--;
+    }
+
+    /* Now we know that's zero, memcmp with self. */
+    return memcmp(buf, p, len) == 0;
+}
+
 PyDoc_STRVAR(is_zero_doc, "\
 is_zero(buf)\n\
 Return True if buf is full of zeros.\n\
 \n\
+The GIL is released when checking large buffers, so other threads can\n\
+run while checking the buffer.\n\
+\n\
 Arguments\n\
   buf (buffer):  buffer to check\n\
 ");
@@ -92,48 +138,99 @@ static PyObject *
 is_zero(PyObject *self, PyObject *args)
 {
     Py_buffer b;
-    const unsigned char *p;
-    size_t i;
     int res;
 
     if (!PyArg_ParseTuple(args, "s*:is_zero", &b))
         return NULL;
 
-    /*
-     * Based on Rusty Russell's memeqzero.
-     *
-     * dd is using a fancier version, optimized for very small bufferes.
-     * In the context of imageio, we care only about big buffers, so we
-     * use the origianl simpler and elegant version.
-     *
-     * See http://rusty.ozlabs.org/?p=560 for more info.
-     */
+    if (b.len >= RELEASE_GIL_SIZE) {
+        Py_BEGIN_ALLOW_THREADS
+        res = buf_is_zero(b.buf, b.len);
+        Py_END_ALLOW_THREADS
+    } else {
+        res = buf_is_zero(b.buf, b.len);
+    }
 
-    p = b.buf;
+    PyBuffer_Release(&b);
 
-    /* Check first 16 bytes manually. */
-    for (i = 0; i < 16; i++) {
-        if (b.len == 0) {
-            res = 1;
-            goto out;
-        }
+    return PyBool_FromLong(res);
+}
 
-        if (*p) {
-            res = 0;
-            goto out;
-        }
+/*
+ * Set bitmap[i] to 1 if block i is full of zeros, 0 otherwise. The last
+ * block may be shorter.
+ */
+static void
+check_blocks(const unsigned char *buf, Py_ssize_t len, Py_ssize_t block_size,
+             char *bitmap)
+{
+    Py_ssize_t start;
 
-        p++;
-        b.len--;
+    for (start = 0; start < len; start += block_size) {
+        *bitmap++ = buf_is_zero(buf + start, Py_MIN(block_size, len - start));
+    }
+}
+
+PyDoc_STRVAR(zero_blocks_doc, "\
+zero_blocks(buf, block_size)\n\
+Check which blocks in buf are full of zeros.\n\
+\n\
+The buffer is split to blocks of block_size bytes. The last block may be\n\
+shorter if the buffer length is not aligned to block_size.\n\
+\n\
+The GIL is released when checking large buffers, so other threads can\n\
+run while checking the buffer.\n\
+\n\
+Arguments\n\
+  buf (buffer):       buffer to check\n\
+  block_size (int):   size of block in bytes\n\
+\n\
+Raises\n\
+  ValueError if block_size is not positive.\n\
+\n\
+Returns\n\
+  bytes object with one item per block; 1 if the block is full of zeros,\n\
+  0 otherwise.\n\
+");
+
+static PyObject *
+zero_blocks(PyObject *self, PyObject *args)
+{
+    Py_buffer b;
+    Py_ssize_t block_size;
+    Py_ssize_t count;
+    PyObject *res = NULL;
+    char *bitmap;
+
+    if (!PyArg_ParseTuple(args, "s*n:zero_blocks", &b, &block_size))
+        return NULL;
+
+    if (block_size <= 0) {
+        PyErr_Format(PyExc_ValueError,
+                     "Invalid block_size: %zd", block_size);
+        goto out;
     }
 
-    /* Now we know that's zero, memcmp with self. */
-    res = memcmp(b.buf, p, b.len) == 0;
+    count = b.len / block_size + (b.len % block_size != 0);
+
+    res = PyBytes_FromStringAndSize(NULL, count);
+    if (res == NULL)
+        goto out;
+
+    bitmap = PyBytes_AS_STRING(res);
+
+    if (b.len >= RELEASE_GIL_SIZE) {
+        Py_BEGIN_ALLOW_THREADS
+        check_blocks(b.buf, b.len, block_size, bitmap);
+        Py_END_ALLOW_THREADS
+    } else {
+        check_blocks(b.buf, b.len, block_size, bitmap);
+    }
 
 out:
     PyBuffer_Release(&b);
 
-    return PyBool_FromLong(res);
+    return res;
 }
 
 PyDoc_STRVAR(py_fallocate_doc, "\
@@ -190,6 +287,7 @@ static PyMethodDef module_methods[] = {
         blkzeroout_doc},
     {"blksszget", (PyCFunction) blksszget, METH_VARARGS, blksszget_doc},
     {"is_zero", (PyCFunction) is_zero, METH_VARARGS, is_zero_doc},
+    {"zero_blocks", (PyCFunction) zero_blocks, METH_VARARGS, zero_blocks_doc},
     {"fallocate", (PyCFunction) py_fallocate, METH_VARARGS, py_fallocate_doc},
     {NULL}  /* Sentinel */
 };
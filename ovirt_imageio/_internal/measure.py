@@ -57,6 +57,12 @@ class RangeList:
     def sum(self):
         return sum(len(r) for r in self._ranges)
 
+    def __iter__(self):
+        return iter(self._ranges)
+
+    def __len__(self):
+        return len(self._ranges)
+
 
 def _merged(ranges):
     """
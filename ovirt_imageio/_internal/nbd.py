@@ -53,6 +53,7 @@ FLAG_SEND_DF = (1 << 7)
 FLAG_CAN_MULTI_CONN = (1 << 8)
 FLAG_SEND_RESIZE = (1 << 9)
 FLAG_SEND_CACHE = (1 << 10)
+FLAG_SEND_FAST_ZERO = (1 << 11)
 
 # Options
 OPT_ABORT = 2
@@ -91,6 +92,7 @@ EXTENT_BACKING = (1 << 3)
 
 # Command flags
 CMD_FLAG_NO_HOLE = (1 << 1)
+CMD_FLAG_FAST_ZERO = (1 << 4)
 
 # Structured reply types
 REPLY_TYPE_NONE = 0
@@ -152,6 +154,10 @@ ERROR_REPLY = {
     REP_ERR_TOO_BIG: "The request or the reply is too large to process",
 }
 
+# Returned when using CMD_FLAG_FAST_ZERO and the server cannot zero
+# efficiently.
+ENOTSUP = 95
+
 # Mapping from NBD error code in simple or structured reply to system errno.
 # https://github.com/NetworkBlockDevice/nbd/blob/master/doc/proto.md
 # #error-values
@@ -162,6 +168,7 @@ REPLY_ERRORS = {
     22: errno.EINVAL,
     28: errno.ENOSPC,
     75: errno.EOVERFLOW,
+    ENOTSUP: errno.ENOTSUP,
     108: errno.ESHUTDOWN,
 }
 
@@ -411,6 +418,13 @@ class Client:
 
         log.debug("Ready for transmission")
 
+    def clone(self):
+        """
+        Return new client connected to the same export.
+        """
+        return self.__class__(
+            self.address, export_name=self.export_name, dirty=self.dirty)
+
     @property
     def has_base_allocation(self):
         return BASE_ALLOCATION in self._meta_context
@@ -419,6 +433,22 @@ class Client:
     def has_allocation_depth(self):
         return QEMU_ALLOCATION_DEPTH in self._meta_context
 
+    @property
+    def can_multi_conn(self):
+        """
+        Return True if the server guarantees that flush on one connection
+        flushes changes completed by all connections.
+        """
+        return bool(self.transmission_flags & FLAG_CAN_MULTI_CONN)
+
+    @property
+    def can_fast_zero(self):
+        """
+        Return True if the server supports failing zero requests that cannot
+        be performed efficiently.
+        """
+        return bool(self.transmission_flags & FLAG_SEND_FAST_ZERO)
+
     def read(self, offset, length):
         buf = bytearray(length)
         self.readinto(offset, buf)
@@ -440,11 +470,23 @@ class Client:
         self._send(data)
         self._recv_reply(cmd)
 
-    def zero(self, offset, length, punch_hole=True):
+    def zero(self, offset, length, punch_hole=True, fast=False):
+        """
+        Zero range using NBD_CMD_WRITE_ZEROES.
+
+        If fast is True, the server must fail the request with ENOTSUP
+        instead of writing zeroes if it cannot zero the range efficiently.
+        Check can_fast_zero before using this flag.
+        """
         if self.transmission_flags & FLAG_SEND_WRITE_ZEROES == 0:
             raise UnsupportedRequest(
                 "Server does not support CMD_WRITE_ZEROES")
         flags = 0 if punch_hole else CMD_FLAG_NO_HOLE
+        if fast:
+            if not self.can_fast_zero:
+                raise UnsupportedRequest(
+                    "Server does not support CMD_FLAG_FAST_ZERO")
+            flags |= CMD_FLAG_FAST_ZERO
         cmd = WriteZeroes(self._next_handle(), offset, length, flags=flags)
         self._send_command(cmd)
         self._recv_reply(cmd)
@@ -82,6 +82,7 @@ Result:   [xxxxxxxxxxxxx|0000000000000|xxxxxx]
 import logging
 import queue
 import sys
+import threading
 
 from collections import namedtuple
 
@@ -202,20 +203,104 @@ def merged(extents_a, extents_b):
 
 
 def copy(src_client, dst_client, block_size=4 * MiB, queue_depth=4,
-         progress=None):
+         progress=None, workers=1):
     """
     Copy export from src_client to dst_client.
 
     Both exports must have identical size, but can have different format.
+
+    If workers is more than 1, the export is split to workers shards, and
+    every shard is copied concurrently by a reader and a writer using their
+    own connections. The first shard is copied using src_client and
+    dst_client, and the other shards use clones of the clients. The
+    destination is flushed after all shards were copied.
     """
+    size = src_client.export_size
 
     # Consider both requested block size and clients limits.
     buf_size = min(
         block_size,
         min(src_client.maximum_block_size, dst_client.maximum_block_size))
 
-    # Leave extra room for None buffer signaling that the writer failed.
-    buffers = queue.Queue(queue_depth + 1)
+    # Shards are aligned to block size, so shards never share a block.
+    shard_size = util.round_up(-(-size // workers), block_size) or block_size
+    shards = [(offset, min(shard_size, size - offset))
+              for offset in range(0, size, shard_size)]
+
+    if len(shards) > 1 and progress:
+        progress = _LockedProgress(progress)
+
+    error = [None]
+    pairs = [(src_client, dst_client)]
+    threads = []
+
+    try:
+        for offset, length in shards[1:]:
+            src = src_client.clone()
+            try:
+                dst = dst_client.clone()
+            except Exception:
+                src.close()
+                raise
+            pairs.append((src, dst))
+
+        log.debug("copying %s shards", len(shards))
+
+        for (src, dst), (offset, length) in zip(pairs[1:], shards[1:]):
+            t = util.start_thread(
+                _copy_shard,
+                args=(src, dst, offset, length, buf_size, queue_depth, error,
+                      progress),
+                name="copy/{}".format(len(threads) + 1))
+            threads.append(t)
+
+        if shards:
+            offset, length = shards[0]
+            _copy_shard(
+                src_client, dst_client, offset, length, buf_size,
+                queue_depth, error, progress)
+    finally:
+        for t in threads:
+            t.join()
+        for src, dst in pairs[1:]:
+            _close(dst)
+            _close(src)
+
+    if error[0]:
+        raise error[0][1]
+
+    # Flushing one connection is enough if the server flushes changes from
+    # all connections.
+    if dst_client.can_multi_conn:
+        dst_client.flush()
+    else:
+        for _, dst in pairs:
+            dst.flush()
+
+
+class _LockedProgress:
+    """
+    Serialize progress updates from multiple writers.
+    """
+
+    def __init__(self, progress):
+        self._progress = progress
+        self._lock = threading.Lock()
+
+    def update(self, n):
+        with self._lock:
+            self._progress.update(n)
+
+
+def _copy_shard(src_client, dst_client, offset, length, buf_size,
+                queue_depth, error, progress=None):
+    """
+    Copy length bytes starting at offset using a reader on the calling
+    thread and a writer thread. Errors are reported in error.
+    """
+    # Buffers are returned by the writer also after failures, so the reader
+    # can never block on buffers.
+    buffers = queue.Queue(queue_depth)
 
     # Allocate buffers for write requests.
     for _ in range(queue_depth):
@@ -225,27 +310,41 @@ def copy(src_client, dst_client, block_size=4 * MiB, queue_depth=4,
     # queue_depth zero requests (have no buffer).
     requests = queue.Queue(queue_depth * 2)
 
-    error = [None]
-
     log.debug("starting writer thread")
     writer = util.start_thread(
         _write,
         args=(dst_client, requests, buffers, error, progress),
         name="writer")
 
-    _read(src_client, requests, buffers, error)
+    try:
+        _read(src_client, offset, length, requests, buffers, error)
+    except Exception:
+        log.debug("reader failed")
+        _set_error(error)
+    finally:
+        # The writer consumes all requests until it gets None, so this
+        # cannot block forever.
+        requests.put(None)
+        log.debug("waiting for writer thread")
+        writer.join()
+
+
+def _set_error(error):
+    # Keep the first error.
+    if error[0] is None:
+        error[0] = sys.exc_info()
 
-    log.debug("waiting for writer thread")
-    writer.join()
 
-    if error[0]:
-        raise error[0][1]
+def _close(client):
+    try:
+        client.close()
+    except Exception:
+        log.exception("Error closing %s", client)
 
 
 # Request ops.
 WRITE = "write"
 ZERO = "zero"
-FLUSH = "flush"
 
 
 class Request(namedtuple("Request", "op,offset,length,buf")):
@@ -255,13 +354,17 @@ class Request(namedtuple("Request", "op,offset,length,buf")):
         return tuple.__new__(cls, (op, offset, length, buf))
 
 
-def _read(client, requests, buffers, error):
-    log.debug("reader started")
+def _read(client, offset, length, requests, buffers, error):
+    log.debug("reader started offset=%s length=%s", offset, length)
 
-    offset = 0
-    for ext in extents(client):
+    if not length:
+        return
+
+    for ext in extents(client, offset=offset, length=length):
         todo = ext.length
         if ext.zero:
+            # Zero requests do not need a buffer, and are queued without
+            # waiting for the writer to complete data requests.
             while todo:
                 if error[0]:
                     log.debug("reader stopped")
@@ -285,37 +388,36 @@ def _read(client, requests, buffers, error):
                 offset += step
                 todo -= step
 
-    requests.put(Request(FLUSH))
-    requests.put(None)
     log.debug("reader finished")
 
 
 def _write(client, requests, buffers, error, progress=None):
-    try:
-        log.debug("writer started")
+    log.debug("writer started")
 
-        while True:
-            req = requests.get()
-            if req is None:
-                log.debug("writer stopped")
-                break
+    while True:
+        req = requests.get()
+        if req is None:
+            break
 
-            if req.op is ZERO:
-                client.zero(req.offset, req.length)
-            elif req.op is WRITE:
-                view = memoryview(req.buf)[:req.length]
-                client.write(req.offset, view)
+        try:
+            # After a failure, consume requests without writing, so the
+            # reader can stop.
+            if not error[0]:
+                if req.op is ZERO:
+                    client.zero(req.offset, req.length)
+                elif req.op is WRITE:
+                    view = memoryview(req.buf)[:req.length]
+                    client.write(req.offset, view)
+                else:
+                    raise RuntimeError("Unknown request: {}".format(req))
+
+                if progress:
+                    progress.update(req.length)
+        except Exception:
+            log.debug("writer failed")
+            _set_error(error)
+        finally:
+            if req.buf is not None:
                 buffers.put(req.buf)
-            elif req.op is FLUSH:
-                client.flush()
-            else:
-                raise RuntimeError("Unknown request: {}".format(req))
-
-            if progress:
-                progress.update(req.length)
 
-        log.debug("writer finished")
-    except Exception:
-        log.debug("writer failed")
-        error[0] = sys.exc_info()
-        buffers.put(None)
+    log.debug("writer finished")
@@ -4,12 +4,16 @@
 import logging
 
 from . import errors
+from . import ioutil
 from . import stats
 from . import util
-from .units import MiB
+from .units import KiB, MiB
 
 log = logging.getLogger("ops")
 
+# Used to send zeroes without reading from storage.
+ZERO_BUFFER = bytes(1 * MiB)
+
 
 class EOF(Exception):
     """ Raised when no more data is available and size was not specifed """
@@ -82,26 +86,97 @@ class Read(Operation):
 
     name = "read"
 
-    def __init__(self, src, dst, buf, size, offset=0, clock=None):
+    def __init__(self, src, dst, buf, size, offset=0, extents=None,
+                 accumulator=None, clock=None):
+        """
+        If zero extents are specified, areas that read as zeroes are sent
+        from memory without reading from the source backend.
+
+        If accumulator (blkhash.Accumulator) is specified, data sent is added
+        to the accumulator.
+        """
         super().__init__(size=size, offset=offset, buf=buf, clock=clock)
         self._src = src
         self._dst = dst
+        self._extents = extents
+        self._accumulator = accumulator
 
     def _run(self):
-        skip = self._offset % self._src.block_size
-        self._src.seek(self._offset - skip)
+        if self._extents is None:
+            self._read_data(self._offset, self._size)
+            return
+
+        for start, length, zero in self._segments():
+            if zero:
+                self._write_zeroes(length)
+            else:
+                self._read_data(start, length)
+
+    def _segments(self):
+        """
+        Merge extents in the requested range, yielding (start, length, zero)
+        tuples.
+        """
+        cur = None
+        for seg in self._split():
+            if cur is None:
+                cur = list(seg)
+            elif cur[2] == seg[2]:
+                cur[1] += seg[1]
+            else:
+                yield tuple(cur)
+                cur = list(seg)
+        if cur:
+            yield tuple(cur)
+
+    def _split(self):
+        """
+        Split the requested range using the extents. Areas not described by
+        the extents are considered as data.
+        """
+        pos = self._offset
+        end = self._offset + self._size
+
+        for ext in self._extents:
+            if pos == end:
+                return
+
+            ext_end = ext.start + ext.length
+            if ext_end <= pos:
+                continue
+
+            if ext.start > pos:
+                gap_end = min(ext.start, end)
+                yield pos, gap_end - pos, False
+                pos = gap_end
+                if pos == end:
+                    return
+
+            seg_end = min(ext_end, end)
+            yield pos, seg_end - pos, ext.zero
+            pos = seg_end
+
+        if pos < end:
+            yield pos, end - pos, False
+
+    def _read_data(self, offset, length):
+        end = self._done + length
+        skip = offset % self._src.block_size
+        self._src.seek(offset - skip)
         if skip:
-            self._read_chunk(skip)
-        while self._todo:
-            self._read_chunk()
+            self._read_chunk(end, skip)
+        while self._done < end:
+            self._read_chunk(end)
 
-    def _read_chunk(self, skip=0):
+    def _read_chunk(self, end, skip=0):
         if self._src.tell() % self._src.block_size:
             raise errors.PartialContent(self.size, self.done)
 
-        # If self._todo is not aligned to backend block_size we read complete
-        # block and drop up to block_size - 1 bytes.
-        aligned_todo = util.round_up(self._todo, self._src.block_size)
+        todo = end - self._done
+
+        # If todo is not aligned to backend block_size we read complete block
+        # and drop up to block_size - 1 bytes.
+        aligned_todo = util.round_up(todo, self._src.block_size)
 
         with memoryview(self._buf)[:aligned_todo] as view:
             with self._record("read") as s:
@@ -110,16 +185,90 @@ class Read(Operation):
             if count == 0:
                 raise errors.PartialContent(self.size, self.done)
 
-        size = min(count - skip, self._todo)
+        size = min(count - skip, todo)
         with memoryview(self._buf)[skip:skip + size] as view:
             with self._record("write") as s:
                 self._dst.write(view)
                 s.bytes += size
+            if self._accumulator:
+                self._accumulator.update(self._offset + self._done, view)
         self._done += size
 
         if self._canceled:
             raise Canceled
 
+    def _write_zeroes(self, length):
+        while length:
+            size = min(length, len(ZERO_BUFFER))
+            with memoryview(ZERO_BUFFER)[:size] as view:
+                with self._record("zero") as s:
+                    self._dst.write(view)
+                    s.bytes += size
+            if self._accumulator:
+                self._accumulator.zero(self._offset + self._done, size)
+            self._done += size
+            length -= size
+
+            if self._canceled:
+                raise Canceled
+
+
+class Copy(Read):
+    """
+    Copy data from source backend to destination backend.
+    """
+
+    name = "copy"
+
+    def __init__(self, src, dst, buf, size, offset=0, extents=None,
+                 flush=True, clock=None):
+        """
+        If zero extents are specified, areas that read as zeroes are zeroed
+        in the destination backend without reading from the source backend.
+        """
+        super().__init__(
+            src, _BackendWriter(dst), buf, size, offset=offset,
+            extents=extents, clock=clock)
+        self._dst_backend = dst
+        self._flush = flush
+
+    def _run(self):
+        self._dst_backend.seek(self._offset)
+        super()._run()
+
+        if self._flush:
+            with self._record("flush"):
+                self._dst_backend.flush()
+
+    def _write_zeroes(self, length):
+        while length:
+            step = min(length, Zero.MAX_STEP)
+            with self._record("zero") as s:
+                n = self._dst_backend.zero(step)
+                s.bytes += n
+            self._done += n
+            length -= n
+
+            if self._canceled:
+                raise Canceled
+
+
+class _BackendWriter:
+    """
+    Write complete buffers to a backend, which may write less than requested.
+    """
+
+    def __init__(self, backend):
+        self._backend = backend
+
+    def write(self, buf):
+        with memoryview(buf) as view:
+            pos = 0
+            while pos < len(view):
+                with view[pos:] as v:
+                    pos += self._backend.write(v)
+        return pos
+
 
 class Write(Operation):
     """
@@ -128,12 +277,22 @@ class Write(Operation):
 
     name = "write"
 
+    # When detecting zeroes, data is checked in blocks of this size, aligned to
+    # this size in the image. Must be a multiple of the backend block size.
+    ZERO_BLOCK_SIZE = 64 * KiB
+
     def __init__(self, dst, src, buf, size=None, offset=0, flush=True,
-                 clock=None):
+                 detect_zeroes=False, accumulator=None, clock=None):
+        """
+        If accumulator (blkhash.Accumulator) is specified, data received is
+        added to the accumulator.
+        """
         super().__init__(size=size, offset=offset, buf=buf, clock=clock)
         self._src = src
         self._dst = dst
         self._flush = flush
+        self._detect_zeroes = detect_zeroes
+        self._accumulator = accumulator
 
     @property
     def _todo(self):
@@ -177,13 +336,13 @@ class Write(Operation):
                     break
                 read += n
 
-            pos = 0
-            while pos < read:
-                with view[pos:read] as v:
-                    with self._record("write") as s:
-                        n = self._dst.write(v)
-                        s.bytes += n
-                pos += n
+            with view[:read] as v:
+                if self._detect_zeroes:
+                    self._write_sparse(v)
+                else:
+                    self._write_data(v)
+                if self._accumulator:
+                    self._accumulator.update(self._offset + self._done, v)
 
         self._done += read
         if read < count:
@@ -194,6 +353,67 @@ class Write(Operation):
         if self._canceled:
             raise Canceled
 
+    def _write_data(self, view):
+        pos = 0
+        while pos < len(view):
+            with view[pos:] as v:
+                with self._record("write") as s:
+                    n = self._dst.write(v)
+                    s.bytes += n
+            pos += n
+
+    def _write_sparse(self, view):
+        """
+        Write data segments and zero the all-zero segments in view.
+        """
+        for start, end, zero in self._segments(view):
+            if zero:
+                self._zero_data(end - start)
+            else:
+                with view[start:end] as v:
+                    self._write_data(v)
+
+    def _zero_data(self, length):
+        while length:
+            with self._record("zero") as s:
+                n = self._dst.zero(length)
+                s.bytes += n
+            length -= n
+
+    def _segments(self, view):
+        """
+        Split view to data and zero segments, yielding (start, end, zero)
+        tuples. Only complete zero blocks are considered as zero, so zeroing
+        is always aligned to backend block size.
+        """
+        offset = self._dst.tell()
+        size = len(view)
+        step = self.ZERO_BLOCK_SIZE
+
+        # Data before the first aligned block is never zeroed.
+        head = min(-offset % step, size)
+        cur = [0, head, False] if head else None
+
+        with view[head:] as v:
+            zero_blocks = ioutil.zero_blocks(v, step)
+
+        for i, zero in enumerate(zero_blocks):
+            start = head + i * step
+            end = min(start + step, size)
+            # Partial last block is never zeroed.
+            zero = zero and end - start == step
+
+            if cur is None:
+                cur = [start, end, zero]
+            elif cur[2] == zero:
+                cur[1] = end
+            else:
+                yield tuple(cur)
+                cur = [start, end, zero]
+
+        if cur:
+            yield tuple(cur)
+
 
 class Zero(Operation):
     """
@@ -216,10 +436,16 @@ class Zero(Operation):
     # extremely fast so the difference is tiny.
     MAX_STEP = 128 * MiB
 
-    def __init__(self, dst, size, offset=0, flush=False, clock=None):
+    def __init__(self, dst, size, offset=0, flush=False, accumulator=None,
+                 clock=None):
+        """
+        If accumulator (blkhash.Accumulator) is specified, zeroed range is
+        added to the accumulator.
+        """
         super().__init__(size=size, offset=offset, clock=clock)
         self._dst = dst
         self._flush = flush
+        self._accumulator = accumulator
 
     def _run(self):
         self._dst.seek(self._offset)
@@ -229,6 +455,8 @@ class Zero(Operation):
             with self._record("zero") as s:
                 n = self._dst.zero(step)
                 s.bytes += n
+            if self._accumulator:
+                self._accumulator.zero(self._offset + self._done, n)
             self._done += n
             if self._canceled:
                 raise Canceled
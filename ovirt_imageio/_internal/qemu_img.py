@@ -57,8 +57,16 @@ def info(path):
     return json.loads(out.decode("utf-8"))
 
 
-def measure(path, out_fmt):
-    cmd = ["qemu-img", "measure", "--output", "json", "-O", out_fmt, path]
+def measure(path, out_fmt, size=None):
+    """
+    Measure required size for converting path to out_fmt. If path is None,
+    measure a new image of size bytes.
+    """
+    cmd = ["qemu-img", "measure", "--output", "json", "-O", out_fmt]
+    if path is None:
+        cmd.extend(("--size", str(size)))
+    else:
+        cmd.append(path)
     out = subprocess.check_output(cmd)
     return json.loads(out.decode("utf-8"))
 
@@ -26,7 +26,7 @@ class Server:
             self, image, fmt, sock, export_name="", read_only=False, shared=8,
             cache=None, aio=None, discard="unmap", detect_zeroes="unmap",
             bitmap=None, backing_chain=True, offset=None, size=None,
-            timeout=10.0, block_signals=None):
+            timeout=10.0, block_signals=None, compress=False):
         """
         Initialize qemu-nbd Server.
 
@@ -60,6 +60,10 @@ class Server:
             size (int): Expose a range of size bytes in a raw image.
                 See BlockdevOptionsRaw type in qemu source.
             block_signals (Set[int]): Signals to block in the child process.
+            compress (bool): Compress data written to qcow2 image, using the
+                qemu compress filter. Writes must be aligned to the image
+                cluster size, and every cluster can be written only once.
+                Requires qemu-nbd >= 5.0.0.
 
         See qemu-nbd(8) for more info on these options.
         """
@@ -79,6 +83,7 @@ class Server:
         self.size = size
         self.timeout = timeout
         self.block_signals = block_signals
+        self.compress = compress
         self.proc = None
 
     @property
@@ -168,6 +173,13 @@ class Server:
             if self.fmt == "qcow2" and not self.backing_chain:
                 image["backing"] = None
 
+        if self.compress:
+            if self.fmt != "qcow2":
+                raise RuntimeError(
+                    "compress=True requires qcow2 format: {}".format(
+                        self.fmt))
+            image = {"driver": "compress", "file": image}
+
         cmd.append("json:" + json.dumps(image))
 
         log.debug("Starting qemu-nbd %s", cmd)
@@ -250,7 +262,7 @@ class Server:
 def run(image, fmt, sock, export_name="", read_only=False, shared=8,
         cache=None, aio=None, discard="unmap", detect_zeroes="unmap",
         bitmap=None, backing_chain=True, offset=None, size=None, timeout=10.0,
-        block_signals=None):
+        block_signals=None, compress=False):
     server = Server(
         image, fmt, sock,
         export_name=export_name,
@@ -265,7 +277,8 @@ def run(image, fmt, sock, export_name="", read_only=False, shared=8,
         offset=offset,
         size=size,
         timeout=timeout,
-        block_signals=block_signals)
+        block_signals=block_signals,
+        compress=compress)
     server.start()
     try:
         yield server
@@ -275,7 +288,8 @@ def run(image, fmt, sock, export_name="", read_only=False, shared=8,
 
 @contextmanager
 def open(image, fmt, read_only=False, bitmap=None, discard="unmap",
-         detect_zeroes="unmap", backing_chain=True, offset=None, size=None):
+         detect_zeroes="unmap", backing_chain=True, offset=None, size=None,
+         compress=False):
     """
     Open nbd client for accessing image using qemu-nbd.
     """
@@ -288,7 +302,8 @@ def open(image, fmt, read_only=False, bitmap=None, discard="unmap",
             detect_zeroes=detect_zeroes,
             backing_chain=backing_chain,
             offset=offset,
-            size=size):
+            size=size,
+            compress=compress):
         with nbd.Client(sock, dirty=bitmap is not None) as c:
             yield c
 
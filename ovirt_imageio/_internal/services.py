@@ -13,6 +13,7 @@ from . import util
 
 from .handlers import (
     checksum,
+    copy,
     extents,
     images,
     info,
@@ -80,6 +81,7 @@ class RemoteService(Service):
             (r"/images/(.*)/checksum/algorithms",
                 checksum.Algorithms(config, auth)),
             (r"/images/(.*)/checksum", checksum.Checksum(config, auth)),
+            (r"/images/(.*)/blockmap", checksum.BlockMap(config, auth)),
             (r"/images/(.*)", images.Handler(config, auth)),
             (r"/info/", info.Handler(config, auth)),
         ])
@@ -125,6 +127,7 @@ class LocalService(Service):
             (r"/images/(.*)/checksum/algorithms",
                 checksum.Algorithms(config, auth)),
             (r"/images/(.*)/checksum", checksum.Checksum(config, auth)),
+            (r"/images/(.*)/blockmap", checksum.BlockMap(config, auth)),
             (r"/images/(.*)", images.Handler(config, auth)),
         ])
         log.info("%s listening on %r", self.name, self.address)
@@ -168,6 +171,7 @@ class ControlService(Service):
         self._server.clock_class = stats.Clock
 
         self._server.app = http.Router([
+            (r"/tickets/(.*)/copy", copy.Handler(config, auth)),
             (r"/tickets/(.*)", tickets.Handler(config, auth)),
             (r"/profile/", profile.Handler(config, auth)),
         ])
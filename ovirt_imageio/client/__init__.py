@@ -17,7 +17,9 @@ from . _api import (
     BUFFER_SIZE,
     MAX_WORKERS,
     upload,
+    upload_stream,
     download,
+    download_stream,
     info,
     measure,
     checksum,
@@ -25,20 +27,33 @@ from . _api import (
     ImageioClient,
 )
 
+from . _aio import AsyncImageioClient
+from . _io import RateLimiter
+from . _ova import OvaDisk, export_ova, import_ova
+from . _session import Session
+
 # For better user experience.
 from . _ui import ProgressBar
 
 __all__ = (
+    "AsyncImageioClient",
     "BUFFER_SIZE",
     "MAX_WORKERS",
     "ImageioClient",
+    "OvaDisk",
     "ProgressBar",
+    "RateLimiter",
+    "Session",
     "checksum",
     "download",
+    "download_stream",
+    "export_ova",
     "extents",
+    "import_ova",
     "info",
     "measure",
     "upload",
+    "upload_stream",
 )
 
 __version__ = version.string
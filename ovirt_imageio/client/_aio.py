@@ -0,0 +1,588 @@
+# SPDX-FileCopyrightText: Red Hat, Inc.
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+"""
+aio - asyncio client for imageio server.
+"""
+
+import asyncio
+import json
+import logging
+import ssl
+import urllib.parse as urllib_parse
+
+from .. _internal import extent
+from .. _internal import http
+from .. _internal.units import KiB
+
+from . import _io
+
+# Maximum number of connections to the server.
+MAX_CONNECTIONS = _io.MAX_WORKERS
+
+# Chunk size for reading response body.
+READ_SIZE = 128 * KiB
+
+# Maximum request size when emulating zero on old servers.
+ZERO_SIZE = 1024 * KiB
+
+log = logging.getLogger("aio")
+
+
+class AsyncImageioClient:
+    """
+    Asyncio client for imageio server.
+
+    Requests are sent using a pool of keep-alive connections, so concurrent
+    requests are processed in parallel by the server. The number of
+    connections is limited by max_connections and by the number of readers
+    published by the server. The number of concurrent write and zero requests
+    is limited by the number of writers published by the server.
+
+    If the server runs on the local host and supports unix socket, the client
+    connects to the server unix socket for better performance.
+
+    Example:
+
+        async with AsyncImageioClient(url, cafile="ca.pem") as client:
+            await asyncio.gather(
+                client.read(0, buf1),
+                client.read(len(buf1), buf2))
+    """
+
+    def __init__(self, transfer_url, cafile=None, secure=True, proxy_url=None,
+                 max_connections=MAX_CONNECTIONS, connect_timeout=10,
+                 read_timeout=60):
+        """
+        Arguments:
+            transfer_url (str): Transfer url on the host running imageio server
+                e.g. https://{imageio.server}:{port}/images/{ticket-id}.
+            cafile (str): Certificate file name, for example "ca.pem"
+            secure (bool): True for verifying server certificate and hostname.
+                Default is True.
+            proxy_url (str): Proxy url on the host running imageio as proxy,
+                used if transfer_url is not accessible.  e.g.
+                https://{proxy.server}:{port}/images/{ticket-id}.
+            max_connections (int): Maximum number of connections to the
+                server.
+            connect_timeout (float): Time to wait for connection to server.
+            read_timeout (float): Time to wait when reading from server.
+        """
+        self._transfer_url = transfer_url
+        self._cafile = cafile
+        self._secure = secure
+        self._proxy_url = proxy_url
+        self._max_connections = max_connections
+        self._connect_timeout = connect_timeout
+        self._read_timeout = read_timeout
+
+        # Initialized during connection.
+        self._url = None
+        self._context = None
+        self._unix_socket = None
+        self._can_extents = False
+        self._can_zero = False
+        self._can_flush = False
+        self._max_readers = 1
+        self._max_writers = 1
+        self._size = None
+
+        self._idle = []
+        self._connections = None
+        self._writers = None
+        self._closed = False
+
+    async def connect(self):
+        """
+        Connect to the server and get server options. Called automatically
+        when using the client as an async context manager.
+        """
+        try:
+            con = await self._connect_url(self._transfer_url)
+        except (OSError, asyncio.TimeoutError) as e:
+            if self._proxy_url is None:
+                raise
+
+            log.debug("Cannot connect to %s (%s), trying %s",
+                      self._transfer_url, e, self._proxy_url)
+            con = await self._connect_url(self._proxy_url)
+
+        try:
+            options = await self._options(con)
+            log.debug("Server options: %s", options)
+            self._can_extents = options.get("extents", False)
+            self._can_zero = options.get("zero", False)
+            self._can_flush = options.get("flush", False)
+            self._max_readers = options.get("max_readers", 1)
+            self._max_writers = options.get("max_writers", 1)
+
+            con = await self._optimize_connection(
+                con, options.get("unix_socket"))
+
+            self._connections = asyncio.Semaphore(
+                max(1, min(self._max_connections, self._max_readers)))
+            self._writers = asyncio.Semaphore(self._max_writers)
+            self._idle.append(con)
+
+            self._size = await self._get_size()
+        except BaseException:
+            await self.close()
+            raise
+
+    @property
+    def max_readers(self):
+        """
+        Maximum number of concurrent clients reading data from same resource
+        on imageio server.
+        """
+        return self._max_readers
+
+    @property
+    def max_writers(self):
+        """
+        Maximum number of concurrent clients writing data to same resource on
+        imageio server.
+        """
+        return self._max_writers
+
+    def size(self):
+        """
+        Return image virtual size in bytes.
+        """
+        return self._size
+
+    async def extents(self, context="zero"):
+        """
+        Send extents request and return list of extents.
+
+        Arguments:
+            context (str): "zero" to get zero extents, "dirty" to get dirty
+                extents. Dirty extents are available only during incremental
+                backup.
+
+        Returns:
+            List of ZeroExtent if context="zero" or DirtyExtent if
+            context="dirty".
+        """
+        if context not in ("zero", "dirty"):
+            raise RuntimeError("Invalid context: {}".format(context))
+
+        if not self._can_extents:
+            if context == "zero":
+                return [extent.ZeroExtent(0, self._size, False, False)]
+            raise RuntimeError(
+                "Server does not support {} extents".format(context))
+
+        cls = {"zero": extent.ZeroExtent, "dirty": extent.DirtyExtent}[context]
+        data = await self._request(
+            "GET", self._url.path + "/extents?context=" + context)
+        return [cls.from_dict(d) for d in json.loads(data.decode("utf-8"))]
+
+    async def read(self, offset, buffer):
+        """
+        Send GET request, reading bytes at offset into buffer.
+
+        Always read entire buffer. Raises if offset + len(buffer) is after the
+        end of the image.
+
+        Arguments:
+            offset (int): offset in the image to read from.
+            buffer (object): object implementing the buffer interface
+                (bytearray, mmap).
+        """
+        length = len(buffer)
+        if offset + length > self._size:
+            raise RuntimeError("Read out of image bounds")
+
+        if length == 0:
+            # Zero length Range (first > last) is invalid.
+            # https://tools.ietf.org/html/rfc7233#section-2.1
+            return 0
+
+        headers = {
+            "range": "bytes={}-{}".format(offset, offset + length - 1),
+        }
+        await self._request(
+            "GET", self._url.path, headers=headers, buffer=buffer,
+            status=http.PARTIAL_CONTENT)
+        return length
+
+    async def write(self, offset, buffer):
+        """
+        Send PUT request, writing buffer contents at offset.
+
+        Always write entire buffer. Raises if offset + len(buffer) is after
+        the end of the image.
+
+        Arguments:
+            offset (int): offset in the image to write to.
+            buffer (object): object implementing the buffer interface (bytes,
+                bytearray, mmap).
+        """
+        length = len(buffer)
+        if offset + length > self._size:
+            raise RuntimeError("Write out of image bounds")
+
+        async with self._writers:
+            await self._put(offset, length, buffer)
+
+    async def zero(self, offset, length):
+        """
+        Zero length bytes at offset.
+        """
+        async with self._writers:
+            if self._can_zero:
+                await self._patch({
+                    "op": "zero",
+                    "offset": offset,
+                    "size": length,
+                    "flush": not self._can_flush,
+                }, dirty=self._can_flush)
+            else:
+                # Emulate zero with PUT for old server without zero support.
+                buf = bytes(min(length, ZERO_SIZE))
+                end = offset + length
+                while offset < end:
+                    n = min(end - offset, len(buf))
+                    await self._put(offset, n, memoryview(buf)[:n])
+                    offset += n
+
+    async def flush(self):
+        """
+        Flush image data to storage. Running write and zero requests must be
+        completed before flushing.
+
+        The server uses a backend per connection, so data written using a
+        connection is flushed using the same connection.
+        """
+        if not self._can_flush:
+            return
+
+        dirty = [con for con in self._idle if con.dirty]
+        if not dirty:
+            # Data may have been written using a connection closed by the
+            # server. Flushing any connection is the best we can do.
+            await self._patch({"op": "flush"})
+            return
+
+        self._idle = [con for con in self._idle if not con.dirty]
+        await asyncio.gather(
+            *(self._patch({"op": "flush"}, con=con, dirty=False)
+              for con in dirty))
+
+    async def close(self):
+        """
+        Close the client. Running requests must be completed before closing.
+        """
+        self._closed = True
+        idle = self._idle
+        self._idle = []
+        for con in idle:
+            con.close()
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, t, v, tb):
+        try:
+            await self.close()
+        except Exception:
+            # Do not hide the original error.
+            if t is None:
+                raise
+            log.exception("Error closing client")
+
+    # Private
+
+    async def _put(self, offset, length, buffer):
+        path = self._url.path
+        if self._can_flush:
+            path += "?flush=n"
+        headers = {
+            "content-type": "application/octet-stream",
+            "content-range": "bytes {}-{}/*".format(
+                offset, offset + length - 1),
+        }
+        await self._request(
+            "PUT", path, headers=headers, body=buffer, dirty=self._can_flush)
+
+    async def _patch(self, msg, con=None, dirty=None):
+        body = json.dumps(msg).encode("utf-8")
+        headers = {"content-type": "application/json"}
+        await self._request(
+            "PATCH", self._url.path, headers=headers, body=body, con=con,
+            dirty=dirty)
+
+    async def _request(self, method, path, headers=None, body=None,
+                       buffer=None, status=http.OK, con=None, dirty=None):
+        """
+        Send request using a pooled connection and return the response body,
+        or read the response body into buffer.
+
+        If con is specified, send the request using this connection instead
+        of a pooled connection. If dirty is not None, mark the connection as
+        dirty or clean if the request was successful.
+        """
+        if self._closed:
+            if con:
+                con.close()
+            raise RuntimeError("Client is closed")
+
+        async with self._connections:
+            if con is None:
+                con = await self._acquire()
+            try:
+                res = await con.request(
+                    method, path, headers=headers, body=body)
+                if res.status != status:
+                    data = await con.read_body(res)
+                    self._reraise(res.status, data)
+                if buffer is None:
+                    data = await con.read_body(res)
+                else:
+                    await con.readinto(res, buffer)
+                    data = None
+            except BaseException:
+                con.close()
+                raise
+
+            if dirty is not None:
+                con.dirty = dirty
+
+            if res.keep_alive and not self._closed:
+                self._idle.append(con)
+            else:
+                con.close()
+
+            return data
+
+    async def _acquire(self):
+        if self._idle:
+            return self._idle.pop()
+        if self._unix_socket:
+            return await _Connection.open_unix(
+                self._unix_socket, self._connect_timeout, self._read_timeout)
+        return await _Connection.open_tcp(
+            self._url, self._context, self._connect_timeout,
+            self._read_timeout)
+
+    async def _connect_url(self, transfer_url):
+        log.debug("Trying %s", transfer_url)
+        url = urllib_parse.urlparse(transfer_url)
+        context = None
+        if url.scheme == "https":
+            context = self._create_ssl_context()
+        con = await _Connection.open_tcp(
+            url, context, self._connect_timeout, self._read_timeout)
+        self._url = url
+        self._context = context
+        return con
+
+    def _create_ssl_context(self):
+        context = ssl.create_default_context(
+            purpose=ssl.Purpose.SERVER_AUTH, cafile=self._cafile)
+
+        if not self._secure:
+            context.check_hostname = False
+            context.verify_mode = ssl.CERT_NONE
+
+        return context
+
+    async def _options(self, con):
+        res = await con.request("OPTIONS", self._url.path)
+        body = await con.read_body(res)
+
+        options = {}
+
+        if res.status in (http.METHOD_NOT_ALLOWED, http.NO_CONTENT):
+            # Older daemon or proxy not providing options.
+            return options
+        elif res.status != http.OK:
+            self._reraise(res.status, body)
+
+        try:
+            options = json.loads(body.decode("utf-8"))
+        except ValueError:
+            return options
+
+        for feature in options.pop("features", []):
+            options[feature] = True
+
+        return options
+
+    async def _optimize_connection(self, con, unix_socket):
+        """
+        Try to switch to Unix socket for improved performane. If we fail to
+        switch continue to use HTTPS.
+        """
+        if not (unix_socket and con.is_local()):
+            return con
+
+        try:
+            unix_con = await _Connection.open_unix(
+                unix_socket, self._connect_timeout, self._read_timeout)
+        except (OSError, asyncio.TimeoutError) as e:
+            log.warning("Cannot use unix socket: %s", e)
+            return con
+
+        con.close()
+        self._unix_socket = unix_socket
+        return unix_con
+
+    async def _get_size(self):
+        if self._can_extents:
+            extents = await self.extents()
+            last = extents[-1]
+            return last.start + last.length
+
+        # Emulate HEAD request by sending GET and closing the connection
+        # without reading the body.
+        async with self._connections:
+            con = await self._acquire()
+            try:
+                res = await con.request("GET", self._url.path)
+                if res.status != http.OK:
+                    data = await con.read_body(res)
+                    self._reraise(res.status, data)
+                return res.content_length
+            finally:
+                con.close()
+
+    def _reraise(self, status, body):
+        """
+        Reconstruct http.Error from daemon response and raise it.
+        """
+        msg = body[:512].decode("utf-8", errors="replace").rstrip()
+        raise http.Error(status, msg)
+
+
+class _Response:
+
+    def __init__(self, status, headers):
+        self.status = status
+        self.headers = headers
+
+    @property
+    def content_length(self):
+        return int(self.headers.get("content-length", "0"))
+
+    @property
+    def keep_alive(self):
+        return self.headers.get("connection", "").lower() != "close"
+
+
+class _Connection:
+    """
+    HTTP/1.1 connection using asyncio streams.
+    """
+
+    def __init__(self, reader, writer, host, read_timeout):
+        self._reader = reader
+        self._writer = writer
+        self._host = host
+        self._read_timeout = read_timeout
+        # True if data was written using this connection and not flushed.
+        self.dirty = False
+
+    @classmethod
+    async def open_tcp(cls, url, context, connect_timeout, read_timeout):
+        log.debug("Connecting to tcp socket %r", url.netloc)
+        port = url.port or (443 if url.scheme == "https" else 80)
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(url.hostname, port, ssl=context),
+            connect_timeout)
+        return cls(reader, writer, url.netloc, read_timeout)
+
+    @classmethod
+    async def open_unix(cls, path, connect_timeout, read_timeout):
+        log.debug("Connecting to unix socket %r", path)
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_unix_connection(path), connect_timeout)
+        return cls(reader, writer, "localhost", read_timeout)
+
+    def is_local(self):
+        """
+        Return True if connected to the local host.
+        """
+        sockname = self._writer.get_extra_info("sockname")
+        peername = self._writer.get_extra_info("peername")
+        return sockname[0] == peername[0]
+
+    async def request(self, method, path, headers=None, body=None):
+        """
+        Send request and return the response. The caller must read the
+        response body before sending the next request.
+        """
+        lines = [
+            "{} {} HTTP/1.1".format(method, path),
+            "host: {}".format(self._host),
+        ]
+        if headers:
+            lines.extend("{}: {}".format(k, v) for k, v in headers.items())
+        if body is not None:
+            lines.append("content-length: {}".format(len(body)))
+        lines.append("\r\n")
+
+        self._writer.write("\r\n".join(lines).encode("ascii"))
+        if body is not None:
+            self._writer.write(body)
+        try:
+            await self._writer.drain()
+        except ConnectionError as e:
+            # The server may reject the request and close the connection
+            # before reading the body. Return the error response if the server
+            # sent one, otherwise raise the original error.
+            log.debug("Sending request failed: %s", e)
+            try:
+                return await self._read_response()
+            except Exception:
+                raise e from None
+
+        return await self._read_response()
+
+    async def read_body(self, res):
+        length = res.content_length
+        if length == 0:
+            return b""
+        return await self._read(self._reader.readexactly(length))
+
+    async def readinto(self, res, buffer):
+        length = res.content_length
+        with memoryview(buffer) as view:
+            if length != len(view):
+                raise RuntimeError(
+                    "Unexpected content_length={} expected={}"
+                    .format(length, len(view)))
+            pos = 0
+            while pos < length:
+                n = min(length - pos, READ_SIZE)
+                data = await self._read(self._reader.readexactly(n))
+                view[pos:pos + n] = data
+                pos += n
+
+    def close(self):
+        self._writer.close()
+
+    async def _read_response(self):
+        line = await self._read(self._reader.readline())
+        if not line:
+            raise ConnectionResetError("Server closed the connection")
+
+        try:
+            status = int(line.decode("latin-1").split(None, 2)[1])
+        except (IndexError, ValueError):
+            raise RuntimeError("Invalid status line: {!r}".format(line))
+
+        headers = {}
+        while True:
+            line = await self._read(self._reader.readline())
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+        return _Response(status, headers)
+
+    async def _read(self, coro):
+        return await asyncio.wait_for(coro, self._read_timeout)
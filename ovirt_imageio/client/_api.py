@@ -5,36 +5,71 @@
 api - imageio public client API.
 """
 
+import errno
 import json
 import logging
 import os
+import queue
 import signal
+import stat
+import struct
 import tarfile
 
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
 from contextlib import contextmanager
-from urllib.parse import urlparse
+from urllib.parse import ParseResult, urlparse
 
 from .. _internal import blkhash
+from .. _internal import ioutil
+from .. _internal import measure as _measure
 from .. _internal import qemu_img
 from .. _internal import qemu_nbd
 from .. _internal import util
-from .. _internal.backends import http, nbd
+from .. _internal.backends import file, http, nbd
 from .. _internal.handlers import checksum as _checksum
 from .. _internal.nbd import UnixAddress
 
 from . import _app
 from . import _io
+from . import _journal
 
 # API constants.
 BUFFER_SIZE = _io.BUFFER_SIZE
 MAX_WORKERS = _io.MAX_WORKERS
 
+# Block size for finding changed blocks in delta transfers. Use the minimal
+# block size supported by the server to minimize the data transferred.
+DELTA_BLOCK_SIZE = _checksum.MIN_BLOCK_SIZE
+
+# Signatures of image formats probed by qemu-img, as (offset, magic). A file
+# starting with none of these is probed as raw. Note that qemu-img also
+# probes vmdk descriptors and dmg images using other rules.
+_FORMAT_SIGNATURES = [
+    (0, b"QFI\xfb"),                    # qcow, qcow2
+    (0, b"QED\x00"),                    # qed
+    (0, b"KDMV"),                       # vmdk
+    (0, b"COWD"),                       # vmdk
+    (0, b"vhdxfile"),                   # vhdx
+    (0, b"conectix"),                   # vpc
+    (0, b"LUKS\xba\xbe"),               # luks
+    (0, b"WithoutFreeSpace"),           # parallels
+    (0, b"WithouFreSpacExt"),           # parallels
+    (0, b"Bochs Virtual HD Image"),     # bochs
+    (0, b"#!/bin/sh\n#V2.0 Format\n"),  # cloop
+    (64, struct.pack("<I", 0xbeda107f)),  # vdi
+]
+
+# Size of the header read when probing raw images.
+_PROBE_SIZE = 4096
+
 log = logging.getLogger("client")
 
 
 def upload(filename, url, cafile, buffer_size=BUFFER_SIZE, secure=True,
            progress=None, proxy_url=None, max_workers=MAX_WORKERS,
-           member=None, backing_chain=True, disk_is_zero=False):
+           member=None, backing_chain=True, disk_is_zero=False,
+           delta=False, journal=None, session=None, limiter=None):
     """
     Upload filename to url
 
@@ -67,11 +102,79 @@ def upload(filename, url, cafile, buffer_size=BUFFER_SIZE, secure=True,
         disk_is_zero (bool): If set, skip zero extents in the source image
             instead of zeroing the extent in the destination disk. Should be
             used only when uploading to new disk on file based storage or new
-            qcow2 disk on block based storage.
+            qcow2 disk on block based storage. Usually not needed, since areas
+            reported as zero by the disk extents are not zeroed.
+        delta (bool): If set, upload only blocks that differ between the
+            image and the disk, found by comparing the image block map with
+            the disk block map computed by the server. Should be used when
+            uploading a modified image to a disk containing an older version
+            of the image.
+        journal (str): Path to journal file recording the ranges completed
+            by this upload. If the journal exists, resume an interrupted upload
+            to the same url, skipping ranges recorded in the journal and
+            reported as written by the server. The journal is removed when the
+            upload completes.
+        session (client.Session): If specified, reuse qemu-nbd servers kept
+            by the session instead of starting qemu-nbd for this upload.
+        limiter (client.RateLimiter): If specified, limit the upload rate.
+            Share a limiter between concurrent uploads to limit their
+            combined rate.
     """
+    if delta and not backing_chain:
+        raise ValueError(
+            "delta={} is incompatible with backing_chain={}"
+            .format(delta, backing_chain))
+
+    if delta and disk_is_zero:
+        raise ValueError(
+            "delta={} is incompatible with disk_is_zero={}"
+            .format(delta, disk_is_zero))
+
+    if delta and journal:
+        raise ValueError(
+            "delta={} is incompatible with journal={}"
+            .format(delta, journal))
+
     if callable(progress):
         progress = ProgressWrapper(progress)
 
+    if journal:
+        journal = _journal.Journal(journal)
+
+    # Get image format and if member specified, its offset and size.
+    image_info = _source_info(filename, member=member)
+
+    _upload_image(
+        filename,
+        image_info,
+        url,
+        cafile,
+        buffer_size=buffer_size,
+        secure=secure,
+        progress=progress,
+        proxy_url=proxy_url,
+        max_workers=max_workers,
+        backing_chain=backing_chain,
+        disk_is_zero=disk_is_zero,
+        delta=delta,
+        journal=journal,
+        session=session,
+        limiter=limiter)
+
+    # The upload completed, the journal is not needed now.
+    if journal:
+        journal.remove()
+
+
+def _upload_image(filename, image_info, url, cafile, buffer_size=BUFFER_SIZE,
+                  secure=True, progress=None, proxy_url=None,
+                  max_workers=MAX_WORKERS, backing_chain=True,
+                  disk_is_zero=False, delta=False, journal=None, session=None,
+                  limiter=None):
+    """
+    Upload image described by image_info to url. See upload() for the
+    arguments.
+    """
     # Open the destination backend to get number of workers.
     with _open_http(
             url,
@@ -82,43 +185,48 @@ def upload(filename, url, cafile, buffer_size=BUFFER_SIZE, secure=True,
 
         max_workers = min(dst.max_writers, max_workers)
 
-        # Get image format and if member specified, its offset and size.
-        image_info = info(filename, member=member)
-
         # Open the source backend using avialable workers + extra worker used
         # for getting image extents.
-        with _open_nbd(
+        with _open_source(
                 filename,
-                image_info["format"],
-                read_only=True,
+                image_info,
                 shared=max_workers + 1,
-                offset=image_info.get("member-offset"),
-                size=image_info.get("member-size"),
-                backing_chain=backing_chain) as src:
+                backing_chain=backing_chain,
+                session=session) as src:
+
+            changed = _changed_ranges(src, dst) if delta else None
 
             # Upload the image to the server.
-            _io.copy(
-                src,
-                dst,
-                max_workers=max_workers,
-                buffer_size=buffer_size,
-                # If the disk is zero and we upload the entire chain, we can
-                # skip zero extents instead of zeroing the area on the
-                # destination.  When uploading without a backing chain we must
-                # zero extents which are zero but not holes.
-                zero=not (disk_is_zero and backing_chain),
-                # When uploading without a backing chain, the destination image
-                # has a backing chain. We must keep holes unallocated on the so
-                # they expose data from the backing chain.
-                hole=backing_chain,
-                progress=progress,
-                name="upload")
+            try:
+                _io.copy(
+                    src,
+                    dst,
+                    max_workers=max_workers,
+                    buffer_size=buffer_size,
+                    # If the disk is zero and we upload the entire chain, we
+                    # can skip zero extents instead of zeroing the area on the
+                    # destination.  When uploading without a backing chain we
+                    # must zero extents which are zero but not holes.
+                    zero=not (disk_is_zero and backing_chain),
+                    # When uploading without a backing chain, the destination
+                    # image has a backing chain. We must keep holes unallocated
+                    # on the so they expose data from the backing chain.
+                    hole=backing_chain,
+                    progress=progress,
+                    name="upload",
+                    changed=changed,
+                    journal=journal,
+                    limiter=limiter)
+            finally:
+                if journal:
+                    journal.close()
 
 
 def download(url, filename, cafile, fmt="qcow2", incremental=False,
              buffer_size=BUFFER_SIZE, secure=True, progress=None,
              proxy_url=None, max_workers=MAX_WORKERS,
-             backing_file=None, backing_format=None):
+             backing_file=None, backing_format=None, delta=False,
+             limiter=None, compressed=False):
     """
     Download url to filename.
 
@@ -147,12 +255,40 @@ def download(url, filename, cafile, fmt="qcow2", incremental=False,
         backing_file (str): Set the backing file when creating qcow2 image. The
             backing file must exist.
         backing_format (str): Set the backing file format.
+        delta (bool): If set, filename must be an existing image with the
+            same virtual size as the remote disk. Download only blocks that
+            differ between the disk and the image, found by comparing the
+            disk block map computed by the server with the image block map.
+            The image format is detected and fmt is ignored.
+        limiter (client.RateLimiter): If specified, limit the download rate.
+            Share a limiter between concurrent downloads to limit their
+            combined rate.
+        compressed (bool): If set, write compressed qcow2 clusters. Data is
+            compressed by qemu-nbd while downloading, using multiple threads
+            when using multiple workers, so the image does not need to be
+            compressed later with "qemu-img convert -c". Requires
+            format="qcow2", and qemu-nbd >= 5.0.0.
     """
+    if compressed and fmt != "qcow2":
+        raise ValueError(
+            "compressed={} is incompatible with fmt={}"
+            .format(compressed, fmt))
+
+    if compressed and (incremental or delta):
+        raise ValueError(
+            "compressed={} is incompatible with incremental={} and delta={}"
+            .format(compressed, incremental, delta))
+
     if incremental and fmt != "qcow2":
         raise ValueError(
             "incremental={} is incompatible with fmt={}"
             .format(incremental, fmt))
 
+    if delta and (incremental or backing_file):
+        raise ValueError(
+            "delta={} is incompatible with incremental={} and backing_file={}"
+            .format(delta, incremental, backing_file))
+
     # Open the source backend to get number of workers and image size.
     with _open_http(
             url,
@@ -161,19 +297,39 @@ def download(url, filename, cafile, fmt="qcow2", incremental=False,
             secure=secure,
             proxy_url=proxy_url) as src:
 
-        # Create a new empty image.
-        qemu_img.create(
-            filename,
-            fmt,
-            size=src.size(),
-            backing_file=backing_file,
-            backing_format=backing_format,
-            quiet=True)
+        if delta:
+            # Update the existing image.
+            image_info = info(filename)
+            fmt = image_info["format"]
+            if image_info["virtual-size"] != src.size():
+                raise RuntimeError(
+                    "Image {} virtual size {} does not match disk size {}"
+                    .format(filename, image_info["virtual-size"], src.size()))
+        else:
+            # Create a new empty image.
+            qemu_img.create(
+                filename,
+                fmt,
+                size=src.size(),
+                backing_file=backing_file,
+                backing_format=backing_format,
+                quiet=True)
 
         max_workers = min(src.max_readers, max_workers)
 
-        # Open the destination backend.
-        with _open_nbd(filename, fmt, shared=max_workers) as dst:
+        # Compressed clusters must be written once using one aligned write.
+        if compressed:
+            alignment = qemu_img.info(filename)["cluster-size"]
+        else:
+            alignment = None
+
+        # Open the destination backend, using extra connection for computing
+        # the image block map.
+        shared = max_workers + 1 if delta else max_workers
+        with _open_nbd(
+                filename, fmt, shared=shared, compress=compressed) as dst:
+
+            changed = _changed_ranges(dst, src) if delta else None
 
             # Download the image from the server to the local image.
             _io.copy(
@@ -190,7 +346,164 @@ def download(url, filename, cafile, fmt="qcow2", incremental=False,
                 # zero holes.
                 hole=False,
                 progress=progress,
-                name="download")
+                name="download",
+                changed=changed,
+                limiter=limiter,
+                alignment=alignment)
+
+
+def upload_stream(reader, url, cafile, buffer_size=BUFFER_SIZE, secure=True,
+                  progress=None, proxy_url=None, disk_is_zero=False):
+    """
+    Upload raw image data read from reader to url.
+
+    The data is read sequentially, so reader can be a pipe, for example
+    sys.stdin.buffer. Blocks containing only zeroes are zeroed on the server
+    instead of sending the zeroes. If the stream is shorter than the disk, the
+    rest of the disk is zeroed.
+
+    Args:
+        reader (object): object implementing readinto(buf), returning 0 at end
+            of stream.
+        url (str): Transfer url on the host running imageio server
+            e.g. https://{imageio.server}:{port}/images/{ticket-id}.
+        cafile (str): Certificate file name, for example "ca.pem"
+        buffer_size (int): Buffer size in bytes for reading from the stream.
+            Every block of buffer_size bytes is sent in one request.
+        secure (bool): True for verifying server certificate and hostname.
+            Default is True.
+        progress (client.ProgressBar): an object implementing
+            client.ProgressBar() interface.
+        proxy_url (str): Proxy url on the host running imageio as proxy, used
+            if url is not accessible.
+        disk_is_zero (bool): If set, skip zero blocks instead of zeroing them
+            in the destination disk.
+
+    Returns:
+        Number of bytes read from reader.
+
+    Raises:
+        RuntimeError if the stream is larger than the disk.
+    """
+    if callable(progress):
+        progress = ProgressWrapper(progress)
+
+    with ImageioClient(
+            url,
+            cafile=cafile,
+            secure=secure,
+            proxy_url=proxy_url,
+            buffer_size=buffer_size) as client:
+
+        size = client.size()
+        if progress:
+            progress.size = size
+
+        buf = bytearray(buffer_size)
+        offset = 0
+        # Start of zero blocks not zeroed yet.
+        zero_start = None
+
+        with memoryview(buf) as view:
+            while offset < size:
+                step = min(len(view), size - offset)
+                n = _readinto_full(reader, view[:step])
+                if n == 0:
+                    break
+
+                with view[:n] as block:
+                    if ioutil.is_zero(block):
+                        if zero_start is None:
+                            zero_start = offset
+                    else:
+                        if zero_start is not None:
+                            _zero_range(
+                                client, zero_start, offset, disk_is_zero)
+                            zero_start = None
+                        client.write(offset, block)
+
+                offset += n
+                if progress:
+                    progress.update(n)
+
+            # The disk is full, but the stream may have more data.
+            if offset == size and _readinto_full(reader, view[:1]):
+                raise RuntimeError(
+                    "Stream is larger than disk size {}".format(size))
+
+        # Zero the rest of the disk.
+        if zero_start is None:
+            zero_start = offset
+        _zero_range(client, zero_start, size, disk_is_zero)
+        if progress:
+            progress.update(size - offset)
+
+        client.flush()
+
+    return offset
+
+
+def download_stream(url, writer, cafile, buffer_size=BUFFER_SIZE, secure=True,
+                    progress=None, proxy_url=None, sparse=False):
+    """
+    Download url, writing raw image data to writer.
+
+    The data is written sequentially, so writer can be a pipe, for example
+    sys.stdout.buffer. Data extents are streamed from the server, and zero
+    extents are written as zeroes without reading them from the server.
+
+    Args:
+        url (str): Transfer url on the host running imageio server
+            e.g. https://{imageio.server}:{port}/images/{ticket-id}.
+        writer (object): object implementing write(buf).
+        cafile (str): Certificate file name, for example "ca.pem"
+        buffer_size (int): Buffer size in bytes for streaming data.
+        secure (bool): True for verifying server certificate and hostname.
+            Default is True.
+        progress (client.ProgressBar): an object implementing
+            client.ProgressBar() interface.
+        proxy_url (str): Proxy url on the host running imageio as proxy, used
+            if url is not accessible.
+        sparse (bool): If set, writer must be a new empty file implementing
+            seek() and truncate(). Zero extents are skipped by seeking,
+            creating a sparse file.
+
+    Returns:
+        Number of bytes written.
+    """
+    if callable(progress):
+        progress = ProgressWrapper(progress)
+
+    with ImageioClient(
+            url,
+            cafile=cafile,
+            secure=secure,
+            proxy_url=proxy_url,
+            buffer_size=buffer_size) as client:
+
+        size = client.size()
+        if progress:
+            progress.size = size
+
+        zeroes = None
+
+        for ext in client.extents("zero"):
+            if ext.data:
+                client.write_to(writer, ext.start, ext.length)
+            elif sparse:
+                writer.seek(ext.length, os.SEEK_CUR)
+            else:
+                if zeroes is None:
+                    zeroes = bytearray(buffer_size)
+                _write_zeroes(writer, ext.length, zeroes)
+
+            if progress:
+                progress.update(ext.length)
+
+        if sparse:
+            writer.truncate()
+
+    return size
 
 
 def info(filename, member=None):
@@ -203,11 +516,7 @@ def info(filename, member=None):
     """
     if member:
         offset, size = _find_member(filename, member)
-        uri = _json_uri(filename, offset, size)
-        info = qemu_img.info(uri)
-        info["member-offset"] = offset
-        info["member-size"] = size
-        return info
+        return _member_info(filename, offset, size)
     else:
         return qemu_img.info(filename)
 
@@ -231,7 +540,8 @@ def measure(filename, dst_fmt, member=None):
 
 
 def checksum(filename, member=None, block_size=blkhash.BLOCK_SIZE,
-             algorithm=blkhash.ALGORITHM, detect_zeroes=True):
+             algorithm=blkhash.ALGORITHM, detect_zeroes=True,
+             workers=blkhash.WORKERS, offset=0, length=None, session=None):
     """
     Compute image checksum.
 
@@ -247,22 +557,31 @@ def checksum(filename, member=None, block_size=blkhash.BLOCK_SIZE,
         detect_zeroes (bool): Detect zeroes in data extents, speeding up
             checksum calculation of preallocated images or sparse images on
             storage that does not report sparseness information.
+        workers (int): Number of threads computing block digests. The result
+            does not depend on the number of workers.
+        offset (int): If specified, compute the checksum of the range
+            starting at offset. Use with the offset parameter of the remote
+            server checksum API to verify part of an image.
+        length (int): If specified, compute the checksum of length bytes.
+            If not specified, compute the checksum until the end of the image.
+        session (client.Session): If specified, reuse qemu-nbd servers kept
+            by the session.
     """
     # Get image format and if member specified, its offset and size.
-    image_info = info(filename, member=member)
-
-    with _open_nbd(
-            filename,
-            image_info["format"],
-            read_only=True,
-            offset=image_info.get("member-offset"),
-            size=image_info.get("member-size")) as backend:
-        buf = bytearray(block_size)
+    image_info = _source_info(filename, member=member)
+
+    with _open_source(filename, image_info, session=session) as backend:
         return _checksum.compute(
-            backend, buf, algorithm=algorithm, detect_zeroes=detect_zeroes)
+            backend,
+            block_size=block_size,
+            algorithm=algorithm,
+            detect_zeroes=detect_zeroes,
+            workers=workers,
+            offset=offset,
+            length=length)
 
 
-def extents(filename, member=None, bitmap=None):
+def extents(filename, member=None, bitmap=None, session=None):
     """
     Iterate over image extents, similiar to /extents API.
 
@@ -272,19 +591,16 @@ def extents(filename, member=None, bitmap=None):
             returns checksum for image named member inside the tar file.
         bitmap (str): Report dirty extents using specified bitmap. Extents are
             not reported from the backing chain.
+        session (client.Session): If specified, reuse qemu-nbd servers kept
+            by the session.
     Yields:
         Zero or dirty extents in filename.
     """
     # Get image format and if member specified, its offset and size.
-    image_info = info(filename, member=member)
-
-    with _open_nbd(
-            filename,
-            image_info["format"],
-            read_only=True,
-            bitmap=bitmap,
-            offset=image_info.get("member-offset"),
-            size=image_info.get("member-size")) as backend:
+    image_info = _source_info(filename, member=member)
+
+    with _open_source(
+            filename, image_info, bitmap=bitmap, session=session) as backend:
         for extent in backend.extents("dirty" if bitmap else "zero"):
             yield extent
 
@@ -295,7 +611,7 @@ class ImageioClient:
     """
 
     def __init__(self, transfer_url, cafile=None, secure=True, proxy_url=None,
-                 buffer_size=BUFFER_SIZE):
+                 buffer_size=BUFFER_SIZE, max_workers=1):
         """
         Arguments:
             transfer_url (str): Transfer url on the host running imageio server
@@ -307,6 +623,10 @@ class ImageioClient:
                 used if transfer_url is not accessible.  e.g.
                 https://{proxy.server}:{port}/images/{ticket-id}.
             buffer_size (int): Buffer size in bytes for I/O operations.
+            max_workers (int): Maximum number of connections used by
+                read_from() and write_to(). If larger than 1, ranges larger
+                than buffer_size are split to buffer_size requests sent in
+                parallel using up to max_readers or max_writers connections.
         """
         self._backend = _open_http(
             transfer_url,
@@ -315,6 +635,12 @@ class ImageioClient:
             secure=secure,
             proxy_url=proxy_url)
         self._buf = bytearray(buffer_size)
+        self._max_workers = max_workers
+
+        # Initialized on the first parallel operation.
+        self._clones = []
+        self._bufs = []
+        self._executor = None
 
     @property
     def max_writers(self):
@@ -364,8 +690,12 @@ class ImageioClient:
             offset (int): offset in the image to write to.
             length (int): number of bytes you want to send.
         """
-        self._backend.seek(offset)
-        self._backend.read_from(reader, length, self._buf)
+        workers = self._workers(self._backend.max_writers, length)
+        if workers > 1:
+            self._parallel_read_from(reader, offset, length, workers)
+        else:
+            self._backend.seek(offset)
+            self._backend.read_from(reader, length, self._buf)
 
     def write_to(self, writer, offset, length):
         """
@@ -378,8 +708,12 @@ class ImageioClient:
             offset (int): offset in the image to read from.
             length (int): number of bytes to get.
         """
-        self._backend.seek(offset)
-        self._backend.write_to(writer, length, self._buf)
+        workers = self._workers(self._backend.max_readers, length)
+        if workers > 1:
+            self._parallel_write_to(writer, offset, length, workers)
+        else:
+            self._backend.seek(offset)
+            self._backend.write_to(writer, length, self._buf)
 
     def read(self, offset, buffer):
         """
@@ -427,14 +761,27 @@ class ImageioClient:
     def flush(self):
         """
         Flush image data to storage.
+
+        The server uses a backend per connection, so every connection used
+        by parallel writes must be flushed.
         """
         self._backend.flush()
+        for backend in self._clones:
+            backend.flush()
 
     def close(self):
         """
         Close the client.
         """
-        self._backend.close()
+        if self._executor:
+            self._executor.shutdown()
+            self._executor = None
+        try:
+            for backend in self._clones:
+                backend.close()
+        finally:
+            self._clones = []
+            self._backend.close()
 
     def __enter__(self):
         return self
@@ -448,6 +795,130 @@ class ImageioClient:
                 raise
             log.exception("Error closing client")
 
+    def _workers(self, max_connections, length):
+        """
+        Return number of workers for transferring length bytes.
+        """
+        count = -(-length // len(self._buf))
+        return max(1, min(self._max_workers, max_connections, count))
+
+    def _prepare(self, workers):
+        """
+        Return queue of workers backends, creating missing backends, buffers
+        and executor.
+        """
+        while len(self._clones) < workers - 1:
+            self._clones.append(self._backend.clone())
+
+        while len(self._bufs) < workers:
+            self._bufs.append(bytearray(len(self._buf)))
+
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                self._max_workers, thread_name_prefix="client")
+
+        backends = queue.Queue()
+        for backend in [self._backend] + self._clones[:workers - 1]:
+            backends.put(backend)
+
+        return backends
+
+    def _parallel_read_from(self, reader, offset, length, workers):
+        """
+        Read chunks from reader and send them using multiple connections.
+        """
+        backends = self._prepare(workers)
+        pending = deque()
+        free = deque(self._bufs[:workers])
+        end = offset + length
+
+        try:
+            while offset < end:
+                if not free:
+                    future, buf = pending.popleft()
+                    future.result()
+                    free.append(buf)
+
+                buf = free.popleft()
+                n = min(end - offset, len(buf))
+                with memoryview(buf)[:n] as view:
+                    got = _readinto_full(reader, view)
+                if got < n:
+                    raise RuntimeError(
+                        "Expected {} bytes, got {} bytes"
+                        .format(length, length - (end - offset) + got))
+                future = self._executor.submit(
+                    self._put, backends, offset, buf, n)
+                pending.append((future, buf))
+                offset += n
+
+            while pending:
+                future, _ = pending.popleft()
+                future.result()
+        except BaseException:
+            self._cancel(pending)
+            raise
+
+    def _parallel_write_to(self, writer, offset, length, workers):
+        """
+        Get chunks using multiple connections and write them to writer in
+        order.
+        """
+        backends = self._prepare(workers)
+        pending = deque()
+        free = deque(self._bufs[:workers])
+        end = offset + length
+
+        try:
+            while offset < end or pending:
+                while free and offset < end:
+                    buf = free.popleft()
+                    n = min(end - offset, len(buf))
+                    future = self._executor.submit(
+                        self._get, backends, offset, buf, n)
+                    pending.append((future, buf))
+                    offset += n
+
+                future, buf = pending.popleft()
+                n = future.result()
+                with memoryview(buf)[:n] as view:
+                    writer.write(view)
+                free.append(buf)
+        except BaseException:
+            self._cancel(pending)
+            raise
+
+    def _put(self, backends, offset, buf, length):
+        backend = backends.get()
+        try:
+            backend.seek(offset)
+            with memoryview(buf)[:length] as view:
+                backend.write(view)
+        finally:
+            backends.put(backend)
+
+    def _get(self, backends, offset, buf, length):
+        backend = backends.get()
+        try:
+            backend.seek(offset)
+            with memoryview(buf)[:length] as view:
+                backend.readinto(view)
+            return length
+        finally:
+            backends.put(backend)
+
+    def _cancel(self, pending):
+        """
+        Cancel pending requests and wait for running requests.
+        """
+        for future, _ in pending:
+            future.cancel()
+        for future, _ in pending:
+            try:
+                future.result()
+            except BaseException:
+                pass
+
 
 class ProgressWrapper:
     """
@@ -459,12 +930,128 @@ class ProgressWrapper:
         self.update = update
 
 
+def _changed_ranges(local, remote, block_size=DELTA_BLOCK_SIZE,
+                    algorithm=blkhash.ALGORITHM):
+    """
+    Compare the block map of the local image with the block map of the
+    remote disk, and return list of measure.Range objects that differ.
+
+    The remote block map is computed by the server while we compute the
+    local block map.
+    """
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        remote_map = executor.submit(remote.block_map, block_size, algorithm)
+        local_map = _checksum.block_map(
+            local, block_size=block_size, algorithm=algorithm)
+        remote_map = remote_map.result()
+
+    size = local.size()
+    blocks = []
+    for index in blkhash.changed_blocks(
+            local_map["block_map"], remote_map, local_map["digest_size"]):
+        start = index * block_size
+        if start >= size:
+            break
+        blocks.append(_measure.Range(start, min(start + block_size, size)))
+
+    changed = _measure.RangeList()
+    changed.update(blocks)
+
+    log.debug("Found %s changed ranges, %s bytes",
+              len(changed), changed.sum())
+
+    return changed
+
+
+def _readinto_full(reader, buf):
+    """
+    Read until buf is full or end of stream, since reading from a pipe may
+    return less data than requested.
+    """
+    pos = 0
+    with memoryview(buf) as view:
+        while pos < len(view):
+            n = reader.readinto(view[pos:])
+            if not n:
+                break
+            pos += n
+    return pos
+
+
+def _zero_range(client, start, end, disk_is_zero):
+    if end > start and not disk_is_zero:
+        client.zero(start, end - start)
+
+
+def _write_zeroes(writer, length, zeroes):
+    with memoryview(zeroes) as view:
+        while length:
+            n = min(length, len(view))
+            writer.write(view[:n])
+            length -= n
+
+
 def _find_member(tarname, name):
     with tarfile.open(tarname) as tar:
         member = tar.getmember(name)
         return member.offset_data, member.size
 
 
+def _source_info(filename, member=None):
+    """
+    Return the image information needed for reading the image. Raw files
+    and block devices are detected without running qemu-img.
+    """
+    if member is None:
+        image_info = _raw_info(filename)
+        if image_info:
+            return image_info
+    return info(filename, member=member)
+
+
+def _raw_info(filename):
+    """
+    Return image information if filename is a raw file or block device
+    probed as raw by qemu-img, or None if it may be another format.
+    """
+    if filename.endswith(".dmg"):
+        # qemu-img probes dmg images using the file name and trailer.
+        return None
+
+    with open(filename, "rb") as f:
+        mode = os.fstat(f.fileno()).st_mode
+        if not (stat.S_ISREG(mode) or stat.S_ISBLK(mode)):
+            return None
+        header = f.read(_PROBE_SIZE)
+        size = f.seek(0, os.SEEK_END)
+
+    for offset, magic in _FORMAT_SIGNATURES:
+        if header[offset:offset + len(magic)] == magic:
+            return None
+
+    # qemu-img probes text files with a "version=" line as vmdk descriptors.
+    if b"version=" in header:
+        return None
+
+    log.debug("Detected raw image %s without qemu-img", filename)
+    return {
+        "filename": filename,
+        "format": "raw",
+        "virtual-size": size,
+    }
+
+
+def _member_info(filename, offset, size):
+    """
+    Return image information for tar member at offset and size.
+    """
+    uri = _json_uri(filename, offset, size)
+    info = qemu_img.info(uri)
+    info["member-offset"] = offset
+    info["member-size"] = size
+    return info
+
+
 def _json_uri(filename, offset, size):
     # Leave the top driver to enable format probing.
     # https://lists.nongnu.org/archive/html/qemu-discuss/2020-06/msg00094.html
@@ -482,9 +1069,86 @@ def _json_uri(filename, offset, size):
     return "json:" + json.dumps(nodes)
 
 
+@contextmanager
+def _open_source(filename, image_info, shared=1, bitmap=None,
+                 backing_chain=True, session=None):
+    """
+    Open image for reading.
+
+    Raw images are read directly using the file backend. Other formats, tar
+    members and bitmaps are read using qemu-nbd, using the session servers
+    if session is specified.
+    """
+    backend = None
+    if (image_info["format"] == "raw" and
+            "member-offset" not in image_info and
+            bitmap is None):
+        backend = _open_file(filename, max_connections=shared)
+
+    if backend:
+        with backend:
+            yield backend
+    elif session:
+        with session.open(
+                filename,
+                image_info["format"],
+                shared=shared,
+                bitmap=bitmap,
+                offset=image_info.get("member-offset"),
+                size=image_info.get("member-size"),
+                backing_chain=backing_chain) as backend:
+            yield backend
+    else:
+        with _open_nbd(
+                filename,
+                image_info["format"],
+                read_only=True,
+                shared=shared,
+                bitmap=bitmap,
+                offset=image_info.get("member-offset"),
+                size=image_info.get("member-size"),
+                backing_chain=backing_chain) as backend:
+            yield backend
+
+
+def _open_file(filename, max_connections=1):
+    """
+    Open raw file or block device using the file backend, or return None if
+    the file cannot be used with direct I/O.
+    """
+    url = ParseResult(
+        scheme="file",
+        netloc="",
+        path=os.path.abspath(filename),
+        params="",
+        query="",
+        fragment="")
+    try:
+        backend = file.open(
+            url, "r", max_connections=max_connections, holes=True)
+    except OSError as e:
+        # File system does not support direct I/O (e.g. tmpfs).
+        if e.errno != errno.EINVAL:
+            raise
+        log.debug("Cannot open %s with direct I/O: %s", filename, e)
+        return None
+
+    # Direct I/O requires aligned reads, but the last block of unaligned
+    # image is shorter.
+    if backend.size() % backend.block_size:
+        log.debug("Cannot open %s with direct I/O: size %s not aligned to "
+                  "block size %s",
+                  filename, backend.size(), backend.block_size)
+        backend.close()
+        return None
+
+    log.debug("Using direct I/O for %s", filename)
+    return backend
+
+
 @contextmanager
 def _open_nbd(filename, fmt, read_only=False, shared=1, bitmap=None,
-              offset=None, size=None, backing_chain=True):
+              offset=None, size=None, backing_chain=True, compress=False):
     """
     Open nbd backend.
     """
@@ -505,7 +1169,8 @@ def _open_nbd(filename, fmt, read_only=False, shared=1, bitmap=None,
                 offset=offset,
                 size=size,
                 backing_chain=backing_chain,
-                block_signals=signals):
+                block_signals=signals,
+                compress=compress):
             url = urlparse(sock.url())
             mode = "r" if read_only else "r+"
             yield nbd.open(url, mode=mode, dirty=bitmap is not None)
@@ -5,13 +5,23 @@
 Download commands.
 """
 
+import fcntl
+import os
+import stat
+import sys
 from contextlib import closing
+from functools import partial
 
 from . import _api
+from . import _io
 from . import _options
 from . import _ovirt
+from . import _parallel
 from . import _ui
 
+# Maximum number of workers for all disks when downloading multiple disks.
+MAX_WORKERS_ALL_DISKS = 32
+
 
 def register(parser):
     cmd = parser.add_sub_command(
@@ -22,8 +32,10 @@ def register(parser):
     cmd.add_argument(
         "-f", "--format",
         choices=("raw", "qcow2"),
-        default="qcow2",
-        help="Download image format (default qcow2).")
+        help="Download image format (default qcow2, or raw when writing to "
+             "standard output).")
+
+    _add_compressed_option(cmd)
 
     cmd.add_argument(
         "disk_id",
@@ -32,32 +44,178 @@ def register(parser):
 
     cmd.add_argument(
         "filename",
-        help="Target filename.")
+        help="Target filename. Use '-' to write raw image data to standard "
+             "output.")
+
+    cmd = parser.add_sub_command(
+        "download-disks",
+        help="Download multiple disks concurrently",
+        func=download_disks,
+        max_workers=MAX_WORKERS_ALL_DISKS)
+
+    cmd.add_argument(
+        "-f", "--format",
+        choices=("raw", "qcow2"),
+        default="qcow2",
+        help="Download image format (default qcow2).")
+
+    _add_compressed_option(cmd)
+
+    cmd.add_argument(
+        "--max-rate",
+        type=_options.Size(minimum=1),
+        help="Maximum download rate in bytes per second for all disks "
+             "(e.g. 100m). If not specified, the rate is not limited.")
+
+    cmd.add_argument(
+        "-d", "--disk",
+        dest="disks",
+        nargs=2,
+        action="append",
+        required=True,
+        metavar=("DISK_ID", "FILENAME"),
+        help="Disk ID to download and target filename. Can be specified "
+             "multiple times. The disks are downloaded concurrently, dividing "
+             "--max-workers workers between the disks when they start. "
+             "Workers of a completed disk are not given to disks that are "
+             "still downloading.")
+
+
+def _add_compressed_option(cmd):
+    cmd.add_argument(
+        "--compressed",
+        action="store_true",
+        help="Write compressed qcow2 image. Data is compressed while "
+             "downloading, without a separate compression step. Requires "
+             "qcow2 format.")
 
 
 def download_disk(args):
-    with _ui.ProgressBar(phase="creating transfer") as pb:
+    stream = args.filename == "-"
+    if args.format is None:
+        args.format = "raw" if stream else "qcow2"
+    elif stream and args.format != "raw":
+        raise RuntimeError(
+            f"Cannot write {args.format} image to standard output")
+
+    if args.compressed and args.format != "qcow2":
+        raise RuntimeError(f"Cannot write compressed {args.format} image")
+
+    # When writing to standard output, the progress must not be mixed with
+    # the image data.
+    output = sys.stderr if stream else sys.stdout
+
+    with _ui.ProgressBar(phase="creating transfer", output=output) as pb:
         con = _ovirt.connect(args)
         with closing(con):
             disk = _ovirt.find_disk(con, args.disk_id)
-            storage_domain = _ovirt.find_storage_domain(con, disk)
-            host = _ovirt.find_host(con, storage_domain.name)
-
-            transfer = _ovirt.create_transfer(
-                con, disk, direction=_ovirt.DOWNLOAD, host=host)
-            try:
-                pb.phase = "downloading image"
-                _api.download(
-                    transfer.transfer_url,
-                    args.filename,
-                    args.cafile,
-                    fmt=args.format,
-                    secure=args.secure,
-                    proxy_url=transfer.proxy_url,
-                    max_workers=args.max_workers,
-                    buffer_size=args.buffer_size,
-                    progress=pb)
-            finally:
-                pb.phase = "finalizing transfer"
-                _ovirt.finalize_transfer(con, transfer, disk)
+            _download_disk(
+                con,
+                args,
+                disk,
+                args.filename,
+                pb,
+                max_workers=args.max_workers)
+        pb.phase = "download completed"
+
+
+def download_disks(args):
+    if args.compressed and args.format != "qcow2":
+        raise RuntimeError(f"Cannot write compressed {args.format} image")
+
+    disks = []
+    for disk_id, filename in args.disks:
+        if filename == "-":
+            raise RuntimeError(
+                "Cannot write multiple disks to standard output")
+        disks.append((_options.UUID(disk_id), filename))
+
+    filenames = [os.path.abspath(filename) for _, filename in disks]
+    if len(set(filenames)) != len(filenames):
+        raise RuntimeError("Cannot download multiple disks to same file")
+
+    limiter = _io.RateLimiter(args.max_rate) if args.max_rate else None
+
+    with _ui.ProgressBar(phase="looking up disks") as pb:
+        # Look up all disks before starting, so a wrong disk id does not
+        # leave some downloads behind.
+        con = _ovirt.connect(args)
+        with closing(con):
+            tasks = []
+            for disk_id, filename in disks:
+                disk = _ovirt.find_disk(con, disk_id)
+                tasks.append(_parallel.Task(
+                    name=filename,
+                    size=disk.provisioned_size,
+                    func=partial(
+                        _download_task, args, disk, filename, limiter)))
+
+        _parallel.run(
+            tasks, args.max_workers, progress=pb, phase="downloading disks")
         pb.phase = "download completed"
+
+
+def _download_task(args, disk, filename, limiter, progress, max_workers):
+    # The engine connection is not thread safe, so every disk uses its own
+    # connection.
+    con = _ovirt.connect(args)
+    with closing(con):
+        _download_disk(
+            con,
+            args,
+            disk,
+            filename,
+            progress,
+            max_workers=max_workers,
+            limiter=limiter)
+
+
+def _download_disk(con, args, disk, filename, progress,
+                   max_workers=_api.MAX_WORKERS, limiter=None):
+    storage_domain = _ovirt.find_storage_domain(con, disk)
+    host = _ovirt.find_host(con, storage_domain.name)
+
+    transfer = _ovirt.create_transfer(
+        con, disk, direction=_ovirt.DOWNLOAD, host=host)
+    try:
+        progress.phase = "downloading image"
+        if filename == "-":
+            _api.download_stream(
+                transfer.transfer_url,
+                sys.stdout.buffer,
+                args.cafile,
+                secure=args.secure,
+                proxy_url=transfer.proxy_url,
+                buffer_size=args.buffer_size,
+                progress=progress,
+                sparse=_is_new_file(sys.stdout.buffer))
+        else:
+            _api.download(
+                transfer.transfer_url,
+                filename,
+                args.cafile,
+                fmt=args.format,
+                secure=args.secure,
+                proxy_url=transfer.proxy_url,
+                max_workers=max_workers,
+                buffer_size=args.buffer_size,
+                progress=progress,
+                limiter=limiter,
+                compressed=args.compressed)
+    finally:
+        progress.phase = "finalizing transfer"
+        _ovirt.finalize_transfer(con, transfer, disk)
+
+
+def _is_new_file(f):
+    """
+    Return True if f is an empty regular file that can be written sparsely,
+    for example when standard output is redirected to a new file.
+    """
+    fd = f.fileno()
+    st = os.fstat(fd)
+    if not stat.S_ISREG(st.st_mode) or st.st_size != 0:
+        return False
+
+    # Seeking does not work when appending to a file.
+    return not fcntl.fcntl(fd, fcntl.F_GETFL) & os.O_APPEND
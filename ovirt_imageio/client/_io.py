@@ -7,14 +7,18 @@ io - I/O operations on backends.
 
 import logging
 import threading
+import time
 
 from collections import deque, namedtuple
 from contextlib import closing
 from functools import partial
 
+from .. _internal import errors
+from .. _internal import measure
 from .. _internal import util
 from .. _internal.backends import Wrapper
-from .. _internal.units import MiB
+from .. _internal.extent import ZeroExtent
+from .. _internal.units import KiB, MiB
 
 from . import _app
 
@@ -23,6 +27,12 @@ from . import _app
 MAX_ZERO_SIZE = 128 * MiB
 MAX_COPY_SIZE = 128 * MiB
 
+# Data extents separated by zero extents up to this size are copied using one
+# request, sending the zeroes inline. Copying a small gap is cheaper than an
+# additional request, and gaps smaller than a qcow2 cluster are likely to be
+# allocated anyway.
+MAX_GAP_SIZE = 64 * KiB
+
 # NBD hard limit.
 MAX_BUFFER_SIZE = 32 * MiB
 
@@ -30,16 +40,78 @@ MAX_BUFFER_SIZE = 32 * MiB
 BUFFER_SIZE = 4 * MiB
 MAX_WORKERS = 4
 
+# When autotuning, measure throughput every AUTOTUNE_INTERVAL seconds, and add
+# another worker if throughput improved by at least AUTOTUNE_GAIN since the
+# last worker was added.
+AUTOTUNE_INTERVAL = 2.0
+AUTOTUNE_GAIN = 0.1
+
+# When scheduling by locality, submitting requests blocks when this number of
+# requests is waiting to be partitioned, limiting memory usage.
+SCHEDULER_WINDOW = 1024
+
 log = logging.getLogger("io")
 
 
 def copy(src, dst, dirty=False, max_workers=MAX_WORKERS,
          buffer_size=BUFFER_SIZE, zero=True, hole=True, progress=None,
-         name="copy"):
+         name="copy", changed=None, max_gap=MAX_GAP_SIZE, autotune=False,
+         journal=None, locality=True, limiter=None, alignment=None):
+    """
+    Copy src backend to dst backend.
 
-    buffer_size = min(buffer_size, MAX_BUFFER_SIZE)
+    If changed is specified, copy only the ranges in changed, assuming that
+    the rest of the image is identical in src and dst.
+
+    Zero extents up to max_gap bytes between data extents are copied with the
+    data extents, using one request. Use max_gap=0 to disable merging.
+
+    If autotune is True, start with one worker, and add workers while the
+    throughput improves, up to max_workers, limited by src max_readers and dst
+    max_writers. The chosen number of workers is logged when the copy
+    completes.
+
+    If journal is specified, record completed requests in the journal. When
+    copying all data, skip ranges recorded in the journal by a previous copy
+    that are reported as written by dst, resuming an interrupted copy.
+
+    If locality is True, assign contiguous regions of the image to each
+    worker, so every connection reads and writes mostly sequentially. See
+    Scheduler for more info.
+
+    If limiter is specified, workers consume the limiter before copying
+    data. Sharing a limiter between multiple copies limits the combined
+    throughput. See RateLimiter for more info.
+
+    If alignment is specified, align requests to alignment, and write full
+    buffers, so every write is aligned. A block containing both data and
+    zeroes is copied as data. This is required when writing compressed qcow2
+    clusters, since every cluster must be written once using one aligned
+    write.
+    """
 
-    with Executor(name=name) as executor:
+    buffer_size = min(buffer_size, MAX_BUFFER_SIZE)
+    if alignment:
+        buffer_size = max(alignment, buffer_size // alignment * alignment)
+
+    # Must be computed before we modify dst.
+    if journal and not dirty and changed is None:
+        completed = _completed_ranges(journal, dst)
+    else:
+        completed = None
+
+    if autotune:
+        max_workers = min(
+            max_workers,
+            getattr(src, "max_readers", max_workers),
+            getattr(dst, "max_writers", max_workers))
+        meter = Meter()
+        workers = 1
+    else:
+        meter = None
+        workers = max_workers
+
+    with Executor(name=name, locality=locality) as executor:
         # This is a bit ugly. We get src and dst backends, to keep same
         # interface as the non-concurrent version. We use src backend here to
         # iterate over image extents. We need to clone src backend max_workers
@@ -48,26 +120,48 @@ def copy(src, dst, dirty=False, max_workers=MAX_WORKERS,
         # The first worker clones src and use a wrapped dst.
         executor.add_worker(
             partial(Handler, src.clone, lambda: Wrapper(dst), buffer_size,
-                    progress))
+                    progress, journal, limiter, alignment, meter))
 
         # The rest of the workers clone both src and dst.
-        for _ in range(max_workers - 1):
+        def add_worker():
             executor.add_worker(
-                partial(Handler, src.clone, dst.clone, buffer_size, progress))
+                partial(Handler, src.clone, dst.clone, buffer_size,
+                        progress, journal, limiter, alignment, meter))
+
+        for _ in range(workers - 1):
+            add_worker()
 
         if progress:
             progress.size = src.size()
 
+        if autotune:
+            tuner = Tuner(
+                meter, add_worker, executor.retire_worker, max_workers,
+                buffer_size, name=name)
+        else:
+            tuner = None
+
         try:
             # Submit requests to executor.
             if dirty:
                 _copy_dirty(executor, src, progress=progress)
+            elif changed is not None:
+                _copy_changed(executor, src, changed, progress=progress)
             else:
                 _copy_data(
-                    executor, src, zero=zero, hole=hole, progress=progress)
+                    executor, src, dst=dst, zero=zero, hole=hole,
+                    progress=progress, max_gap=max_gap, completed=completed,
+                    alignment=alignment)
+
+            # Wait until all requests are processed, so the tuner measures
+            # the entire copy.
+            executor.stop()
         except Closed:
             # Error will be raised when exiting the context.
             log.debug("Executor failed")
+        finally:
+            if tuner:
+                tuner.stop()
 
 
 def _copy_dirty(executor, src, progress=None):
@@ -90,7 +184,9 @@ def _copy_dirty(executor, src, progress=None):
                 progress.update(ext.length)
 
 
-def _copy_data(executor, src, zero=True, hole=True, progress=None):
+def _copy_data(executor, src, dst=None, zero=True, hole=True,
+               progress=None, max_gap=MAX_GAP_SIZE, completed=None,
+               alignment=None):
     """
     Copy data extents and zero zero and hole extents.
 
@@ -104,23 +200,365 @@ def _copy_data(executor, src, zero=True, hole=True, progress=None):
     since zeroed areas will hide data from the backing chain. Use hole=False to
     skip holes and keep them unallocated in the destination image.
 
+    If dst is specified, zero only areas that may contain data in the
+    destination image. Areas reported as zero by dst extents are skipped, so
+    copying to a new empty image does not zero anything. When holes are not
+    zeroed, areas reported as holes by dst extents are zeroed, since they
+    may expose data from the backing chain.
+
     When copying to new empty image without a backing file, we can optimize the
     copy. Use zero=False to skip both zero and hole extents and leave the area
     unallocated.
+
+    Source extents are coalesced before submitting requests, see _coalesce().
+
+    If completed is specified, skip the completed ranges.
+
+    If alignment is specified, extents are aligned before coalescing, see
+    _align_extents().
     """
-    for ext in src.extents("zero"):
+    if zero and dst is not None:
+        zeroed = iter(_zero_ranges(dst, hole=hole))
+    else:
+        zeroed = iter(())
+    current = next(zeroed, None)
+
+    extents = src.extents("zero")
+    if completed:
+        extents = _skip_completed(extents, completed, progress=progress)
+    if alignment:
+        extents = _align_extents(extents, alignment)
+    extents = _coalesce(extents, max_gap=max_gap, hole=hole)
+
+    for ext in extents:
         if ext.data:
             log.debug("Copying %s", ext)
             executor.submit(Request(COPY, ext.start, ext.length))
         elif zero and (not ext.hole or hole):
-            log.debug("Zeroing %s", ext)
-            executor.submit(Request(ZERO, ext.start, ext.length))
+            start = ext.start
+            end = ext.start + ext.length
+
+            while start < end:
+                # Skip destination zero ranges before this extent.
+                while current is not None and current.end <= start:
+                    current = next(zeroed, None)
+
+                if current is None or current.start >= end:
+                    log.debug("Zeroing %s-%s", start, end)
+                    executor.submit(Request(ZERO, start, end - start))
+                    break
+
+                if current.start > start:
+                    log.debug("Zeroing %s-%s", start, current.start)
+                    executor.submit(
+                        Request(ZERO, start, current.start - start))
+                    start = current.start
+
+                stop = min(end, current.end)
+                log.debug("Skipping zero destination %s-%s", start, stop)
+                if progress:
+                    progress.update(stop - start)
+                start = stop
         else:
             log.debug("Skipping %s", ext)
             if progress:
                 progress.update(ext.length)
 
 
+def _coalesce(extents, max_gap=MAX_GAP_SIZE, max_length=MAX_COPY_SIZE,
+              hole=True):
+    """
+    Generate stream of coalesced extents from extents stream, reducing the
+    number of requests when copying fragmented images.
+
+    Consecutive zero extents are merged into a single zero extent. When holes
+    must be kept (hole=False), holes are merged only with other holes.
+
+    Extents:  | zero | zero |  hole  |
+    Result:   |          zero        |
+
+    Data extents separated by a zero extent up to max_gap bytes are merged into
+    a single data extent up to max_length bytes, copying the zeroes with the
+    data. Holes are never merged into data extents when hole=False, since
+    writing zeroes would hide data from the backing chain.
+
+    Extents:  |  data  | zero |  data  |          zero          |
+    Result:   |          data          |          zero          |
+    """
+    return _merge_data(
+        _merge_zero(extents, hole=hole),
+        max_gap=max_gap,
+        max_length=max_length,
+        hole=hole)
+
+
+def _merge_zero(extents, hole=True):
+    partial = None
+
+    for ext in extents:
+        if (partial and ext.zero and _end(partial) == ext.start and
+                (hole or partial.hole == ext.hole)):
+            partial = partial._replace(
+                length=partial.length + ext.length,
+                hole=partial.hole and ext.hole)
+            continue
+
+        if partial:
+            yield partial
+            partial = None
+
+        if ext.zero:
+            partial = ext
+        else:
+            yield ext
+
+    if partial:
+        yield partial
+
+
+def _merge_data(extents, max_gap=MAX_GAP_SIZE, max_length=MAX_COPY_SIZE,
+                hole=True):
+    # Data extent that may be merged with the next data extent.
+    partial = None
+    # Small zero extent following partial.
+    gap = None
+
+    for ext in extents:
+        if ext.data:
+            if partial:
+                merged = _end(ext) - partial.start
+                if (_end(gap or partial) == ext.start and
+                        merged <= max_length):
+                    partial = partial._replace(length=merged)
+                    gap = None
+                    continue
+
+                yield partial
+                if gap:
+                    yield gap
+                    gap = None
+
+            partial = ext
+            continue
+
+        if (partial and gap is None and _end(partial) == ext.start and
+                ext.length <= max_gap and (hole or not ext.hole)):
+            gap = ext
+            continue
+
+        if partial:
+            yield partial
+            partial = None
+        if gap:
+            yield gap
+            gap = None
+
+        yield ext
+
+    if partial:
+        yield partial
+    if gap:
+        yield gap
+
+
+def _align_extents(extents, alignment):
+    """
+    Generate stream of extents aligned to alignment from extents stream.
+
+    A block containing both data and zeroes is reported as data. A block
+    containing only zeroes is reported as a hole only if all the extents in
+    the block are holes. The last extent is not aligned if the image size is
+    not aligned.
+
+    Extents:  |  data  |    zero    |  data  |     zero     |
+    Result:   |    data     | zero |    data     |    zero    |
+    """
+    # Extent starting at aligned offset, that may end at unaligned offset.
+    partial = None
+
+    for ext in extents:
+        if partial is None:
+            partial = ext
+            continue
+
+        boundary = _end(partial)
+        if boundary % alignment == 0:
+            yield partial
+            partial = ext
+            continue
+
+        # The block starting before boundary contains the end of partial and
+        # the start of ext.
+        block_start = boundary // alignment * alignment
+        block_end = min(block_start + alignment, _end(ext))
+
+        if partial.start < block_start:
+            yield partial._replace(length=block_start - partial.start)
+
+        if partial.data or ext.data:
+            block = ZeroExtent(
+                block_start, block_end - block_start, False, False)
+        else:
+            block = ZeroExtent(
+                block_start, block_end - block_start, True,
+                partial.hole and ext.hole)
+
+        if block_end < _end(ext):
+            yield block
+            partial = ext._replace(
+                start=block_end, length=_end(ext) - block_end)
+        else:
+            partial = block
+
+    if partial:
+        yield partial
+
+
+def _end(ext):
+    return ext.start + ext.length
+
+
+def _skip_completed(extents, completed, progress=None):
+    """
+    Generate stream of extents from extents stream, excluding areas in
+    completed ranges.
+
+    completed is an iterable of sorted, non-overlapping measure.Range objects.
+    """
+    completed = iter(completed)
+    current = next(completed, None)
+
+    for ext in extents:
+        start = ext.start
+        end = _end(ext)
+
+        while start < end:
+            # Skip completed ranges before this extent.
+            while current is not None and current.end <= start:
+                current = next(completed, None)
+
+            if current is None or current.start >= end:
+                yield ext._replace(start=start, length=end - start)
+                break
+
+            if current.start > start:
+                yield ext._replace(start=start, length=current.start - start)
+                start = current.start
+
+            stop = min(end, current.end)
+            log.debug("Skipping completed %s-%s", start, stop)
+            if progress:
+                progress.update(stop - start)
+            start = stop
+
+
+def _completed_ranges(journal, dst):
+    """
+    Return list of measure.Range objects completed by a previous transfer.
+
+    A range is completed if it was recorded in the local journal, and
+    reported as written by the destination, so we know that the destination
+    received the data sent by the client.
+    """
+    recorded = list(journal.ranges())
+    if not recorded:
+        return []
+
+    try:
+        written = [
+            measure.Range(ext.start, _end(ext))
+            for ext in dst.extents("written") if ext.written
+        ]
+    except errors.UnsupportedOperation as e:
+        log.info("Cannot resume, destination does not report written "
+                 "extents: %s", e)
+        return []
+
+    completed = []
+    i = j = 0
+
+    while i < len(recorded) and j < len(written):
+        start = max(recorded[i].start, written[j].start)
+        end = min(recorded[i].end, written[j].end)
+        if start < end:
+            completed.append(measure.Range(start, end))
+        if recorded[i].end < written[j].end:
+            i += 1
+        else:
+            j += 1
+
+    log.info("Resuming transfer, skipping %d completed bytes",
+             sum(len(r) for r in completed))
+    return completed
+
+
+def _zero_ranges(dst, hole=True):
+    """
+    Return sorted list of measure.Range objects that read as zeroes in dst.
+
+    If hole is False, holes are not included. A hole reads as zeroes in
+    the destination image, but when the image is used with a backing file,
+    the hole exposes data from the backing file.
+
+    The extents are fetched before copying starts, since the destination
+    backend is used by the first worker.
+    """
+    ranges = measure.RangeList()
+    try:
+        ranges.update(
+            measure.Range(ext.start, ext.start + ext.length)
+            for ext in dst.extents("zero")
+            if ext.zero and (hole or not ext.hole))
+    except errors.UnsupportedOperation as e:
+        log.debug("Cannot get destination extents, zeroing all: %s", e)
+        return []
+
+    ranges = list(ranges)
+    log.debug("Destination has %d zero ranges", len(ranges))
+    return ranges
+
+
+def _copy_changed(executor, src, changed, progress=None):
+    """
+    Copy data extents and zero zero extents in changed ranges, skipping
+    ranges that are identical in the source and destination images.
+
+    Since the destination image contains data, zero and hole extents in
+    changed ranges must be zeroed.
+
+    changed is an iterable of sorted, non-overlapping measure.Range objects.
+    """
+    changed = iter(changed)
+    current = next(changed, None)
+
+    for ext in src.extents("zero"):
+        start = ext.start
+        end = ext.start + ext.length
+
+        while start < end:
+            # Skip changed ranges before this extent.
+            while current is not None and current.end <= start:
+                current = next(changed, None)
+
+            if current is None or current.start >= end:
+                log.debug("Skipping unchanged %s-%s", start, end)
+                if progress:
+                    progress.update(end - start)
+                break
+
+            if current.start > start:
+                log.debug("Skipping unchanged %s-%s", start, current.start)
+                if progress:
+                    progress.update(current.start - start)
+                start = current.start
+
+            stop = min(end, current.end)
+            op = COPY if ext.data else ZERO
+            log.debug("%s changed %s-%s", op, start, stop)
+            executor.submit(Request(op, start, stop - start))
+            start = stop
+
+
 # Request ops.
 ZERO = "zero"
 COPY = "copy"
@@ -135,17 +573,28 @@ class Request(namedtuple("Request", "op,start,length")):
 
 class Executor:
 
-    def __init__(self, name="executor", queue_depth=32):
+    def __init__(self, name="executor", queue_depth=32, locality=False):
         self._name = name
         self._workers = []
-        self._queue = Queue(queue_depth)
+        self._locality = locality
+        if locality:
+            self._queue = Scheduler()
+        else:
+            self._queue = Queue(queue_depth)
         self._errors = []
+        self._retired = 0
+        self._stopped = False
 
     # Public interface.
 
     def add_worker(self, handler_factory):
-        name = "{}/{}".format(self._name, len(self._workers))
-        w = Worker(handler_factory, self._queue, self._errors, name=name)
+        index = len(self._workers)
+        name = "{}/{}".format(self._name, index)
+        if self._locality:
+            queue = self._queue.worker_queue(index)
+        else:
+            queue = self._queue
+        w = Worker(handler_factory, queue, self._errors, name=name)
         self._workers.append(w)
 
     def submit(self, req):
@@ -155,21 +604,47 @@ class Executor:
         for req in self._split(req):
             self._queue.put(req)
 
+    def retire_worker(self):
+        """
+        Stop one worker when pending requests submitted before this call are
+        processed.
+        """
+        if self._locality:
+            self._queue.retire()
+        else:
+            self._queue.put(Request(STOP))
+        self._retired += 1
+
     def stop(self):
         """
         Stop the executor when pending requests are processed. Blocks until all
         workers exit, and report the first executor error.
         """
+        if self._stopped:
+            return
+        self._stopped = True
+
         log.debug("Stopping executor %s", self._name)
-        for _ in self._workers:
-            try:
-                self._queue.put(Request(STOP))
-            except Closed:
-                break
+        if self._locality:
+            self._queue.finish()
+        else:
+            for _ in range(len(self._workers) - self._retired):
+                try:
+                    self._queue.put(Request(STOP))
+                except Closed:
+                    break
         self._join_workers()
         if self._errors:
             raise self._errors[0]
 
+        if self._locality:
+            stats = self._queue.stats()
+            log.info("Scheduled %s: requests=%d sequential=%.1f%% steals=%d "
+                     "tail=%.3f s",
+                     self._name, stats["requests"],
+                     stats["sequential"] * 100, stats["steals"],
+                     stats["tail"])
+
     def abort(self):
         """
         Drops pending requests and terminate all workers. Blocks until all
@@ -215,6 +690,337 @@ class Executor:
         yield Request(req.op, start, length)
 
 
+class Scheduler:
+    """
+    Schedule requests to workers by locality.
+
+    Submitted requests are collected while the workers are busy. When all
+    workers run out of work, the collected requests are sorted and
+    partitioned to contiguous regions of about the same size, one region per
+    worker, so every worker reads and writes mostly sequentially. A worker
+    that completed its region steals the second half of the largest remaining
+    region, so all workers complete at about the same time.
+
+    Submitting requests blocks when window requests are waiting to be
+    partitioned, so requests are processed while they are submitted, and
+    memory usage is bounded.
+
+    The scheduler reports the number of requests, the fraction of requests
+    continuing the previous request of the same worker, the number of steals,
+    and the tail - the time between the first and the last worker running out
+    of work.
+    """
+
+    def __init__(self, window=SCHEDULER_WINDOW):
+        self._cond = threading.Condition(threading.Lock())
+        self._window = window
+        self._pending = []
+        self._workers = []
+        self._regions = {}
+        self._finished = False
+        self._closed = False
+        self._retire = 0
+
+        # Statistics.
+        self._last_end = {}
+        self._requests = 0
+        self._sequential = 0
+        self._steals = 0
+        self._first_done = None
+        self._last_done = None
+
+    @property
+    def closed(self):
+        return self._closed
+
+    def worker_queue(self, index):
+        """
+        Register worker index and return its queue.
+        """
+        with self._cond:
+            self._workers.append(index)
+        return _WorkerQueue(self, index)
+
+    def put(self, req):
+        with self._cond:
+            while len(self._pending) >= self._window and not self._closed:
+                self._cond.wait()
+            if self._closed:
+                raise Closed
+            self._pending.append(req)
+            if len(self._pending) == 1:
+                # Wake up a worker waiting for requests.
+                self._cond.notify()
+
+    def finish(self):
+        """
+        Called when all requests were submitted.
+        """
+        with self._cond:
+            if self._closed or self._finished:
+                return
+            self._finished = True
+            self._cond.notify_all()
+
+    def retire(self):
+        """
+        Stop the next worker asking for a request. Its region will be stolen
+        by other workers.
+        """
+        with self._cond:
+            if self._closed:
+                raise Closed
+            self._retire += 1
+            self._cond.notify_all()
+
+    def get(self, index):
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise Closed
+
+                if self._retire:
+                    self._retire -= 1
+                    self._workers.remove(index)
+                    return Request(STOP)
+
+                region = self._regions.get(index) or self._steal(index)
+                if region:
+                    break
+
+                if self._pending:
+                    # All workers ran out of work.
+                    self._partition()
+                    self._cond.notify_all()
+                    continue
+
+                if self._finished:
+                    now = time.monotonic()
+                    if self._first_done is None:
+                        self._first_done = now
+                    self._last_done = now
+                    return Request(STOP)
+
+                self._cond.wait()
+
+            req = region.popleft()
+            self._requests += 1
+            if self._last_end.get(index) == req.start:
+                self._sequential += 1
+            self._last_end[index] = req.start + req.length
+            return req
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._pending.clear()
+            self._regions.clear()
+            self._cond.notify_all()
+
+    def stats(self):
+        with self._cond:
+            if self._first_done is None:
+                tail = 0.0
+            else:
+                tail = self._last_done - self._first_done
+            return {
+                "requests": self._requests,
+                "sequential": (self._sequential / self._requests
+                               if self._requests else 0.0),
+                "steals": self._steals,
+                "tail": tail,
+            }
+
+    def _partition(self):
+        requests = sorted(self._pending, key=lambda r: r.start)
+        self._pending = []
+
+        # Workers added later start by stealing.
+        workers = self._workers or [None]
+        total = sum(r.length for r in requests)
+        regions = [deque() for _ in workers]
+        done = 0
+        i = 0
+
+        for req in requests:
+            if (i < len(workers) - 1 and
+                    done >= total * (i + 1) // len(workers)):
+                i += 1
+            regions[i].append(req)
+            done += req.length
+
+        self._regions = dict(zip(workers, regions))
+
+    def _steal(self, index):
+        """
+        Move the second half of the largest region to worker index region.
+        """
+        victim = max(self._regions.values(), key=len, default=None)
+        if not victim:
+            return None
+
+        count = max(1, len(victim) // 2)
+        region = deque()
+        for _ in range(count):
+            region.appendleft(victim.pop())
+
+        self._regions[index] = region
+        self._steals += 1
+        return region
+
+
+class _WorkerQueue:
+    """
+    Scheduler queue of a single worker.
+    """
+
+    def __init__(self, scheduler, index):
+        self._scheduler = scheduler
+        self._index = index
+
+    def get(self):
+        return self._scheduler.get(self._index)
+
+    def close(self):
+        self._scheduler.close()
+
+
+class Meter:
+    """
+    Measure the number of bytes copied by workers.
+
+    Only copied bytes are measured. Zeroing is much faster than copying and
+    does not depend on the number of workers, so counting zeroed bytes
+    would hide the effect of adding a worker.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._done = 0
+
+    @property
+    def done(self):
+        with self._lock:
+            return self._done
+
+    def update(self, n):
+        with self._lock:
+            self._done += n
+
+
+class RateLimiter:
+    """
+    Limit the number of bytes transferred per second by multiple threads.
+
+    Every call to consume() reserves the next slot of the rate budget, and
+    waits until the slot starts. Callers get slots in the order they call
+    consume(), so threads sharing a limiter get a fair share of the budget.
+    Unused budget is not accumulated; after an idle period the next call
+    starts immediately.
+    """
+
+    def __init__(self, rate, now=time.monotonic, sleep=time.sleep):
+        """
+        Arguments:
+            rate (int): maximum number of bytes per second.
+            now (callable): callable returning current time for testing.
+            sleep (callable): callable sleeping for testing.
+        """
+        if rate <= 0:
+            raise ValueError("Invalid rate: {}".format(rate))
+        self._rate = rate
+        self._now = now
+        self._sleep = sleep
+        self._lock = threading.Lock()
+        # Time when the next slot starts.
+        self._next = None
+
+    @property
+    def rate(self):
+        return self._rate
+
+    def consume(self, n):
+        """
+        Wait until n bytes can be transferred without exceeding the rate.
+        """
+        with self._lock:
+            now = self._now()
+            if self._next is None or self._next < now:
+                self._next = now
+            start = self._next
+            self._next += n / self._rate
+
+        delay = start - now
+        if delay > 0:
+            self._sleep(delay)
+
+
+class Tuner:
+    """
+    Add workers while adding a worker improves the throughput.
+
+    Every AUTOTUNE_INTERVAL seconds, compare the throughput to the throughput
+    measured before the last worker was added. If the throughput improved
+    enough, add another worker. Otherwise retire the last worker and stop
+    tuning.
+    """
+
+    def __init__(self, meter, add_worker, retire_worker, max_workers,
+                 buffer_size, name="copy"):
+        self._meter = meter
+        self._add_worker = add_worker
+        self._retire_worker = retire_worker
+        self._max_workers = max_workers
+        self._buffer_size = buffer_size
+        self._name = name
+        self._workers = 1
+        self._best = 0.0
+        self._stopped = threading.Event()
+        self._thread = util.start_thread(
+            self._run, name="{}/tuner".format(name))
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+        log.info("Autotuned %s: workers=%d buffer_size=%d rate=%.2f MiB/s",
+                 self._name, self._workers, self._buffer_size,
+                 self._best / MiB)
+
+    def _run(self):
+        start = time.monotonic()
+        done = self._meter.done
+
+        while not self._stopped.wait(AUTOTUNE_INTERVAL):
+            now = time.monotonic()
+            current = self._meter.done
+            if current == done:
+                # No request completed yet, keep measuring.
+                continue
+
+            rate = (current - done) / (now - start)
+            start = now
+            done = current
+
+            log.debug("Measured %s workers=%d rate=%.2f MiB/s",
+                      self._name, self._workers, rate / MiB)
+
+            if rate > self._best * (1 + AUTOTUNE_GAIN):
+                self._best = rate
+                if self._workers == self._max_workers:
+                    break
+                self._add_worker()
+                self._workers += 1
+            else:
+                # The last worker did not help.
+                if self._workers > 1:
+                    try:
+                        self._retire_worker()
+                    except Closed:
+                        break
+                    self._workers -= 1
+                break
+
+
 class Worker:
 
     def __init__(self, handler_factory, queue, errors, name="worker"):
@@ -258,7 +1064,8 @@ class Worker:
 class Handler:
 
     def __init__(self, src_factory, dst_factory, buffer_size=BUFFER_SIZE,
-                 progress=None):
+                 progress=None, journal=None, limiter=None, alignment=None,
+                 meter=None):
         # Connecting to backend server may fail. Don't leave open connections
         # after failures.
         self._src = src_factory()
@@ -268,27 +1075,44 @@ class Handler:
             self._src.close()
             raise
 
-        self._buf = bytearray(buffer_size)
+        # The source or destination may use direct I/O.
+        self._buf = util.aligned_buffer(buffer_size)
         self._progress = progress
+        self._journal = journal
+        self._limiter = limiter
+        self._alignment = alignment
+        self._meter = meter
 
     def zero(self, req):
         # TODO: Assumes complete zero(); not compatible with file backend.
         self._dst.seek(req.start)
         self._dst.zero(req.length)
+        if self._journal:
+            self._journal.add(req.start, req.length)
         if self._progress:
             self._progress.update(req.length)
 
     def copy(self, req):
+        if self._limiter:
+            self._limiter.consume(req.length)
+
         self._src.seek(req.start)
         self._dst.seek(req.start)
 
-        if hasattr(self._dst, "read_from"):
+        if self._alignment:
+            # Streaming may write partial buffers.
+            self._generic_copy(req)
+        elif hasattr(self._dst, "read_from"):
             self._dst.read_from(self._src, req.length, self._buf)
         elif hasattr(self._src, "write_to"):
             self._src.write_to(self._dst, req.length, self._buf)
         else:
             self._generic_copy(req)
 
+        if self._journal:
+            self._journal.add(req.start, req.length)
+        if self._meter:
+            self._meter.update(req.length)
         if self._progress:
             self._progress.update(req.length)
 
@@ -306,6 +1130,8 @@ class Handler:
                 self._src.close()
             except Exception:
                 log.exception("Error closing %s", self._src)
+            finally:
+                self._buf.close()
 
     def _generic_copy(self, req):
         # TODO: Assumes complete readinto() and write(); not compatible with
@@ -0,0 +1,110 @@
+# SPDX-FileCopyrightText: Red Hat, Inc.
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+"""
+journal - local record of ranges completed by a transfer.
+
+When a transfer is interrupted, the journal tells which ranges were completed
+by the client, so the transfer can be resumed without copying these ranges
+again.
+
+The journal is a text file with one completed range per line:
+
+    start length
+
+Lines are appended when a request completes. A line partly written when the
+client was killed is not terminated by a newline, and is ignored when loading
+the journal. When resuming, the partial line is terminated before appending
+new lines.
+"""
+
+import logging
+import os
+import threading
+
+from .. _internal import measure
+
+log = logging.getLogger("journal")
+
+
+class Journal:
+
+    def __init__(self, path):
+        self._path = path
+        self._lock = threading.Lock()
+        self._file = None
+
+    @property
+    def path(self):
+        return self._path
+
+    def ranges(self):
+        """
+        Return measure.RangeList of ranges recorded in the journal. Return
+        empty list if the journal does not exist.
+        """
+        ranges = measure.RangeList()
+        try:
+            with open(self._path) as f:
+                lines = f.readlines()
+        except FileNotFoundError:
+            return ranges
+
+        parsed = []
+        for line in lines:
+            if not line.endswith("\n"):
+                log.warning("Ignoring partial journal line: %r", line)
+                continue
+            try:
+                start, length = (int(v) for v in line.split())
+            except ValueError:
+                log.warning("Ignoring invalid journal line: %r", line)
+                continue
+            if start < 0 or length <= 0:
+                log.warning("Ignoring invalid journal line: %r", line)
+                continue
+            parsed.append(measure.Range(start, start + length))
+
+        ranges.update(parsed)
+        return ranges
+
+    def add(self, start, length):
+        """
+        Record a completed range.
+        """
+        with self._lock:
+            if self._file is None:
+                self._file = self._open()
+            self._file.write(b"%d %d\n" % (start, length))
+            self._file.flush()
+
+    def _open(self):
+        f = open(self._path, "a+b")
+        try:
+            # Terminate partial line written by interrupted transfer. A partial
+            # line describes a prefix of a completed range, so it is safe to
+            # use it when resuming.
+            if f.seek(0, os.SEEK_END) > 0:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    f.write(b"\n")
+        except BaseException:
+            f.close()
+            raise
+        return f
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def remove(self):
+        """
+        Remove the journal when the transfer completed.
+        """
+        self.close()
+        try:
+            os.remove(self._path)
+        except FileNotFoundError:
+            pass
@@ -181,7 +181,8 @@ class Parser:
             version=f'%(prog)s {version.string}')
         self._commands = self._parser.add_subparsers(title="commands")
 
-    def add_sub_command(self, name, help, func, transfer_options=True):
+    def add_sub_command(self, name, help, func, transfer_options=True,
+                        max_workers=8):
         cmd = self._commands.add_parser(name, help=help)
         cmd.set_defaults(command=func)
 
@@ -193,7 +194,7 @@ class Parser:
             cmd.add_argument(*option.args, **option.kwargs)
 
         if transfer_options:
-            size = Size(minimum=1, default=MAX_WORKERS, maximum=8)
+            size = Size(minimum=1, default=MAX_WORKERS, maximum=max_workers)
             cmd.add_argument(
                 "--max-workers",
                 type=size,
@@ -383,5 +384,21 @@ def _validate_file(filename):
     return filename
 
 
+def _validate_file_or_stream(filename):
+    """
+    Validate that the file exists, or is "-" for standard input or output.
+
+    Raises:
+        ValueError
+
+    Returns:
+        str: filename
+    """
+    if filename == "-":
+        return filename
+    return _validate_file(filename)
+
+
 UUID = Type("UUID", _validate_uuid)
 File = Type("File", _validate_file)
+FileOrStream = Type("File", _validate_file_or_stream)
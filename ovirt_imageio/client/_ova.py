@@ -0,0 +1,353 @@
+# SPDX-FileCopyrightText: Red Hat, Inc.
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+"""
+ova - export and import virtual machine disks using an OVA file.
+
+An OVA is a tar file containing an OVF descriptor followed by the disk images.
+Disks are downloaded directly into the OVA, and uploaded directly from the
+OVA, without temporary files.
+"""
+
+import logging
+import os
+import tarfile
+import time
+
+from collections import namedtuple
+from functools import partial
+
+from . import _api
+from . import _io
+from . import _parallel
+from . _api import BUFFER_SIZE, MAX_WORKERS
+
+log = logging.getLogger("ova")
+
+# Tar files are written in blocks of this size.
+BLOCK_SIZE = tarfile.BLOCKSIZE
+
+# Tar files are padded to multiple of this size.
+RECORD_SIZE = tarfile.RECORDSIZE
+
+# Describe location of a member in the OVA. header is the tar header for the
+# member, written at offset. The member data starts at offset + len(header).
+_Member = namedtuple("_Member", "name,offset,header,size")
+
+
+class OvaDisk:
+    """
+    A disk stored in an OVA.
+    """
+
+    def __init__(self, name, url, proxy_url=None):
+        """
+        Arguments:
+            name (str): name of the OVA member, for example "disk1.raw".
+            url (str): transfer url on the host running imageio server,
+                e.g. https://{imageio.server}:{port}/images/{ticket-id}.
+            proxy_url (str): transfer url on the host running imageio as
+                proxy, used if url is not accessible.
+        """
+        self.name = name
+        self.url = url
+        self.proxy_url = proxy_url
+
+    def __repr__(self):
+        return "<OvaDisk name={} url={} at {:#x}>".format(
+            self.name, self.url, id(self))
+
+
+def export_ova(filename, disks, ovf, cafile, ovf_name="vm.ovf",
+               secure=True, progress=None, max_workers=MAX_WORKERS,
+               buffer_size=BUFFER_SIZE, limiter=None):
+    """
+    Download disks into a new OVA file.
+
+    The OVA contains the OVF descriptor followed by the disks in raw format.
+    The disks are downloaded concurrently, every disk directly into its
+    member in the OVA. Areas which are zero in the disks are not written, so
+    the OVA is sparse if the file system supports sparse files.
+
+    Args:
+        filename (str): path to OVA file. An existing file is replaced.
+        disks (list of client.OvaDisk): disks to download. The disks are
+            stored in the OVA in the specified order.
+        ovf (str): OVF descriptor describing the disks.
+        cafile (str): certificate file name, for example "ca.pem".
+        ovf_name (str): name of the OVF member.
+        secure (bool): True for verifying server certificate and hostname.
+        progress (client.ProgressBar): combined progress for all disks.
+        max_workers (int): maximum number of workers for all disks.
+        buffer_size (int): buffer size per worker.
+        limiter (client.RateLimiter): if specified, limit the combined
+            download rate.
+    """
+    if isinstance(ovf, str):
+        ovf = ovf.encode("utf-8")
+
+    # The tar headers must be written before the disks, so we need to know
+    # the size of all disks.
+    entries = [(ovf_name, len(ovf))]
+    for disk in disks:
+        with _api._open_http(
+                disk.url,
+                "r",
+                cafile=cafile,
+                secure=secure,
+                proxy_url=disk.proxy_url) as src:
+            entries.append((disk.name, src.size()))
+
+    members, size = _layout(entries)
+
+    log.info("Creating OVA %s size=%d disks=%d", filename, size, len(disks))
+    with open(filename, "wb") as f:
+        for m in members:
+            f.seek(m.offset)
+            f.write(m.header)
+
+        # The OVF must be the first member.
+        f.seek(members[0].offset + len(members[0].header))
+        f.write(ovf)
+
+        # The rest of the OVA is zero. Extending the file creates a hole, so
+        # zero areas in the disks and the end of archive blocks do not
+        # allocate space.
+        f.truncate(size)
+        f.flush()
+        os.fsync(f.fileno())
+
+    tasks = []
+    for disk, m in zip(disks, members[1:]):
+        task = partial(
+            _download_member,
+            disk,
+            filename,
+            m.offset + len(m.header),
+            m.size,
+            cafile,
+            secure=secure,
+            buffer_size=buffer_size,
+            limiter=limiter)
+        tasks.append(_parallel.Task(disk.name, m.size, task))
+
+    _parallel.run(
+        tasks, max_workers, progress=progress, phase="exporting disks")
+
+
+def import_ova(filename, disks, cafile, secure=True, progress=None,
+               max_workers=MAX_WORKERS, buffer_size=BUFFER_SIZE,
+               disk_is_zero=False, limiter=None):
+    """
+    Upload disks from an OVA file.
+
+    The OVA is scanned once to find the disks members. The disks are
+    uploaded concurrently, every disk directly from its member in the OVA.
+
+    Args:
+        filename (str): path to OVA file.
+        disks (list of client.OvaDisk): disks to upload. The disk name is the
+            name of the member in the OVA, as reported by "tar tf vm.ova".
+        cafile (str): certificate file name, for example "ca.pem".
+        secure (bool): True for verifying server certificate and hostname.
+        progress (client.ProgressBar): combined progress for all disks.
+        max_workers (int): maximum number of workers for all disks.
+        buffer_size (int): buffer size per worker.
+        disk_is_zero (bool): if set, skip zero extents in the images instead
+            of zeroing them in the destination disks. See client.upload() for
+            more info.
+        limiter (client.RateLimiter): if specified, limit the combined
+            upload rate.
+    """
+    index = _index(filename)
+
+    tasks = []
+    for disk in disks:
+        try:
+            offset, size = index[disk.name]
+        except KeyError:
+            raise RuntimeError(
+                "No member {!r} in {}".format(disk.name, filename)) from None
+
+        image_info = _api._member_info(filename, offset, size)
+        task = partial(
+            _upload_member,
+            disk,
+            filename,
+            image_info,
+            cafile,
+            secure=secure,
+            buffer_size=buffer_size,
+            disk_is_zero=disk_is_zero,
+            limiter=limiter)
+        tasks.append(_parallel.Task(
+            disk.name, image_info["virtual-size"], task))
+
+    _parallel.run(
+        tasks, max_workers, progress=progress, phase="importing disks")
+
+
+def _download_member(disk, filename, offset, size, cafile, progress,
+                     max_workers, secure=True, buffer_size=BUFFER_SIZE,
+                     limiter=None):
+    with _api._open_http(
+            disk.url,
+            "r",
+            cafile=cafile,
+            secure=secure,
+            proxy_url=disk.proxy_url) as src:
+
+        max_workers = min(src.max_readers, max_workers)
+
+        with _MemberWriter(filename, offset, size) as dst:
+            _io.copy(
+                src,
+                dst,
+                max_workers=max_workers,
+                buffer_size=buffer_size,
+                # The OVA was created empty, so we can skip zero extents.
+                zero=False,
+                hole=False,
+                progress=progress,
+                name="export",
+                limiter=limiter)
+
+
+def _upload_member(disk, filename, image_info, cafile, progress, max_workers,
+                   secure=True, buffer_size=BUFFER_SIZE, disk_is_zero=False,
+                   limiter=None):
+    _api._upload_image(
+        filename,
+        image_info,
+        disk.url,
+        cafile,
+        buffer_size=buffer_size,
+        secure=secure,
+        progress=progress,
+        proxy_url=disk.proxy_url,
+        max_workers=max_workers,
+        disk_is_zero=disk_is_zero,
+        limiter=limiter)
+
+
+def _index(filename):
+    """
+    Return dict mapping member name to member data offset and size.
+    """
+    with tarfile.open(filename) as tar:
+        return {m.name: (m.offset_data, m.size)
+                for m in tar.getmembers() if m.isfile()}
+
+
+def _layout(entries, mtime=None):
+    """
+    Compute the location of entries in a tar file.
+
+    Arguments:
+        entries (list of (name, size) tuples): members to store in the tar
+            file.
+        mtime (int): modification time of the members.
+
+    Returns:
+        tuple of list of _Member, and the total size of the tar file.
+    """
+    if mtime is None:
+        mtime = int(time.time())
+
+    members = []
+    offset = 0
+    for name, size in entries:
+        info = tarfile.TarInfo(name)
+        info.size = size
+        info.mtime = mtime
+        info.mode = 0o644
+        # The GNU format supports members larger than 8 GiB, and long names.
+        header = info.tobuf(format=tarfile.GNU_FORMAT)
+        members.append(_Member(name, offset, header, size))
+        offset += len(header) + _round_up(size, BLOCK_SIZE)
+
+    # End of archive marker.
+    offset += 2 * BLOCK_SIZE
+
+    return members, _round_up(offset, RECORD_SIZE)
+
+
+def _round_up(n, size):
+    return (n + size - 1) // size * size
+
+
+class _MemberWriter:
+    """
+    Write to the data of a member in an OVA file.
+
+    Every member is written by its own writer, using buffered I/O. The page
+    cache makes it safe to write adjacent members concurrently, even if they
+    share a file system block.
+    """
+
+    def __init__(self, filename, offset, size):
+        self._filename = filename
+        self._offset = offset
+        self._size = size
+        self._position = 0
+        self._fd = os.open(filename, os.O_WRONLY)
+
+    def size(self):
+        return self._size
+
+    def tell(self):
+        return self._position
+
+    def seek(self, pos, how=os.SEEK_SET):
+        if how == os.SEEK_SET:
+            self._position = pos
+        elif how == os.SEEK_CUR:
+            self._position += pos
+        elif how == os.SEEK_END:
+            self._position = self._size + pos
+        return self._position
+
+    def write(self, buf):
+        with memoryview(buf) as view:
+            length = len(view)
+            if self._position + length > self._size:
+                raise RuntimeError(
+                    "Write past end of member: position={} length={} size={}"
+                    .format(self._position, length, self._size))
+
+            pos = 0
+            while pos < length:
+                pos += os.pwrite(
+                    self._fd, view[pos:], self._offset + self._position + pos)
+
+        self._position += length
+        return length
+
+    def zero(self, count):
+        # The OVA is created empty, so zeroing is needed only when
+        # overwriting data written before.
+        buf = bytearray(min(count, BUFFER_SIZE))
+        todo = count
+        while todo:
+            n = min(todo, len(buf))
+            self.write(memoryview(buf)[:n])
+            todo -= n
+        return count
+
+    def flush(self):
+        os.fsync(self._fd)
+
+    def clone(self):
+        return _MemberWriter(self._filename, self._offset, self._size)
+
+    def close(self):
+        if self._fd != -1:
+            fd = self._fd
+            self._fd = -1
+            os.close(fd)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, t, v, tb):
+        self.close()
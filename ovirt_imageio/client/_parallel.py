@@ -0,0 +1,172 @@
+# SPDX-FileCopyrightText: Red Hat, Inc.
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+"""
+parallel - run multiple disk transfers concurrently.
+"""
+
+import logging
+import threading
+
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+log = logging.getLogger("parallel")
+
+# A transfer of one disk. func is called as func(progress, max_workers) and
+# must not use more than max_workers workers.
+Task = namedtuple("Task", "name,size,func")
+
+
+def run(tasks, max_workers, progress=None, phase="transferring"):
+    """
+    Run tasks concurrently, sharing max_workers workers between them.
+
+    Up to max_workers tasks run at the same time. Every running task gets an
+    equal share of the workers, so small disks are not starved by large
+    disks. The largest tasks are started first, so small tasks fill the gaps
+    when the large tasks complete.
+
+    A task share is computed when the task starts and cannot change while
+    the task is running. When a task completes, its workers are used only by
+    the next task, so if there are no more tasks to start, the workers stay
+    idle until all tasks complete. For example, when running 2 tasks with 8
+    workers, each task gets 4 workers, and when the first task completes,
+    the second task continues with 4 workers.
+
+    A failed task does not stop the other tasks. When all tasks are done,
+    raise RuntimeError describing the failed tasks.
+
+    Arguments:
+        tasks (list of Task): tasks to run.
+        max_workers (int): total number of workers for all tasks.
+        progress (client.ProgressBar): combined progress for all tasks.
+            progress.size is set to the total size of all tasks, and
+            progress.phase shows the number of running and completed tasks.
+        phase (str): description of the tasks for the progress phase.
+    """
+    if not tasks:
+        return
+
+    concurrency = min(len(tasks), max_workers)
+    workers = max_workers // concurrency
+    extra = max_workers % concurrency
+
+    if progress:
+        progress.size = sum(t.size for t in tasks)
+
+    tracker = _Tracker(progress, phase, len(tasks))
+
+    # Sort is stable, so tasks of same size start in the given order.
+    ordered = sorted(tasks, key=lambda t: t.size, reverse=True)
+
+    with ThreadPoolExecutor(
+            max_workers=concurrency,
+            thread_name_prefix="task") as executor:
+        futures = []
+        for i, task in enumerate(ordered):
+            # At most concurrency tasks are running, and only the first tasks
+            # get an extra worker, so we never use more than max_workers.
+            task_workers = workers + 1 if i < extra else workers
+            f = executor.submit(_run_task, task, task_workers, tracker)
+            futures.append((task, f))
+
+    failed = []
+    for task, f in futures:
+        e = f.exception()
+        if e is not None:
+            failed.append("{}: {}".format(task.name, e))
+
+    if failed:
+        raise RuntimeError(
+            "{} of {} tasks failed:\n  {}".format(
+                len(failed), len(tasks), "\n  ".join(failed)))
+
+
+def _run_task(task, max_workers, tracker):
+    log.info("Starting %s size=%d max_workers=%d",
+             task.name, task.size, max_workers)
+    tracker.started()
+    try:
+        task.func(_TaskProgress(task.name, tracker.progress), max_workers)
+    except Exception:
+        log.exception("Task %s failed", task.name)
+        tracker.finished(failed=True)
+        raise
+    else:
+        log.info("Task %s completed", task.name)
+        tracker.finished()
+
+
+class _Tracker:
+    """
+    Show the number of running and completed tasks in the progress phase.
+    """
+
+    def __init__(self, progress, phase, total):
+        self.progress = progress
+        self._phase = phase
+        self._total = total
+        self._lock = threading.Lock()
+        self._running = 0
+        self._completed = 0
+        self._failed = 0
+
+    def started(self):
+        with self._lock:
+            self._running += 1
+            self._update()
+
+    def finished(self, failed=False):
+        with self._lock:
+            self._running -= 1
+            if failed:
+                self._failed += 1
+            else:
+                self._completed += 1
+            self._update()
+
+    def _update(self):
+        if self.progress is None:
+            return
+        phase = "{}: {} running, {}/{} completed".format(
+            self._phase, self._running, self._completed, self._total)
+        if self._failed:
+            phase += ", {} failed".format(self._failed)
+        self.progress.phase = phase
+
+
+class _TaskProgress:
+    """
+    Progress wrapper reporting task progress to the combined progress.
+
+    The size of the combined progress is the total size of all tasks, and the
+    phase is managed by the tracker, so only updates are forwarded.
+    """
+
+    def __init__(self, name, progress=None):
+        self._name = name
+        self._progress = progress
+        self._phase = None
+        self._size = None
+
+    @property
+    def phase(self):
+        return self._phase
+
+    @phase.setter
+    def phase(self, s):
+        self._phase = s
+        log.debug("Task %s phase: %s", self._name, s)
+
+    @property
+    def size(self):
+        return self._size
+
+    @size.setter
+    def size(self, n):
+        self._size = n
+
+    def update(self, n):
+        if self._progress:
+            self._progress.update(n)
@@ -0,0 +1,292 @@
+# SPDX-FileCopyrightText: Red Hat, Inc.
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+"""
+session - reuse qemu-nbd servers for multiple operations.
+"""
+
+import logging
+import os
+import shutil
+import signal
+import tempfile
+import threading
+import time
+
+from collections import namedtuple
+from contextlib import contextmanager
+
+from .. _internal import qemu_nbd
+from .. _internal import util
+from .. _internal.backends import nbd
+from .. _internal.nbd import UnixAddress
+
+from . import _app
+
+# Maximum number of idle servers kept by a session.
+MAX_SERVERS = 4
+
+# Idle servers are stopped after this timeout.
+IDLE_TIMEOUT = 60.0
+
+log = logging.getLogger("session")
+
+
+class Session:
+    """
+    Keep qemu-nbd servers serving local images between operations.
+
+    Every operation on a local image starts qemu-nbd and stops it when the
+    operation completes. When running many operations on the same images,
+    starting qemu-nbd may take more time than the operation itself. A session
+    keeps up to max_servers idle servers, and stops servers that were idle for
+    idle_timeout seconds.
+
+    The servers are read-only. The images must not be modified while the
+    session is open, since qemu-nbd may cache image metadata. Replacing an
+    image or changing its size or modification time is detected and starts
+    a new server.
+
+    Example:
+
+        with client.Session() as session:
+            for filename in images:
+                client.checksum(filename, session=session)
+    """
+
+    def __init__(self, max_servers=MAX_SERVERS, idle_timeout=IDLE_TIMEOUT):
+        self._max_servers = max_servers
+        self._idle_timeout = idle_timeout
+        self._cond = threading.Condition(threading.Lock())
+        # Idle servers, least recently used first.
+        self._idle = []
+        self._closed = False
+        self._reaper = util.start_thread(self._reap, name="session/reaper")
+
+    @contextmanager
+    def open(self, filename, fmt, shared=1, bitmap=None, offset=None,
+             size=None, backing_chain=True):
+        """
+        Open read-only nbd backend for image, reusing an idle server if
+        possible.
+
+        Arguments:
+            filename (str): image filename.
+            fmt (str): image format.
+            shared (int): number of connections needed by the caller.
+            bitmap (str): export this dirty bitmap.
+            offset (int): expose a range starting at offset in raw image.
+            size (int): expose a range of size bytes in raw image.
+            backing_chain (bool): open also the qcow2 backing chain.
+        """
+        key = _Key(
+            os.path.abspath(filename), fmt, bitmap, offset, size,
+            backing_chain)
+        server = self._acquire(key, shared)
+        try:
+            backend = nbd.open(
+                server.url, mode="r", dirty=bitmap is not None)
+        except BaseException:
+            server.stop()
+            raise
+
+        try:
+            with backend:
+                yield backend
+        finally:
+            self._release(server)
+
+    def close(self):
+        """
+        Stop all servers. Servers used by running operations are stopped
+        when the operation completes.
+        """
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            idle = self._idle
+            self._idle = []
+            self._cond.notify_all()
+
+        self._reaper.join()
+        _stop_all(idle)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, t, v, tb):
+        try:
+            self.close()
+        except Exception:
+            # Do not hide the original error.
+            if t is None:
+                raise
+            log.exception("Error closing session")
+
+    def _acquire(self, key, shared):
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("Session is closed")
+            server, stale = self._take_idle(key, shared)
+
+        _stop_all(stale)
+
+        if server:
+            log.debug("Reusing %s", server)
+            return server
+
+        server = _Server(key, shared)
+        server.start()
+
+        with self._cond:
+            closed = self._closed
+
+        if closed:
+            server.stop()
+            raise RuntimeError("Session is closed")
+
+        return server
+
+    def _take_idle(self, key, shared):
+        """
+        Remove and return idle server matching key and stale servers for key.
+        Must be called with the lock held.
+        """
+        server = None
+        stale = []
+        for s in self._idle:
+            if s.key != key:
+                continue
+            if s.shared < shared or not s.alive() or s.image_changed():
+                stale.append(s)
+            elif server is None:
+                server = s
+
+        for s in stale:
+            self._idle.remove(s)
+        if server:
+            self._idle.remove(server)
+
+        return server, stale
+
+    def _release(self, server):
+        with self._cond:
+            if self._closed:
+                evicted = [server]
+            else:
+                server.last_used = time.monotonic()
+                self._idle.append(server)
+                count = max(len(self._idle) - self._max_servers, 0)
+                evicted = self._idle[:count]
+                del self._idle[:count]
+                self._cond.notify_all()
+
+        _stop_all(evicted)
+
+    def _reap(self):
+        while True:
+            with self._cond:
+                if self._closed:
+                    return
+
+                now = time.monotonic()
+                expired = [s for s in self._idle
+                           if now - s.last_used >= self._idle_timeout]
+
+                if not expired:
+                    if self._idle:
+                        oldest = min(s.last_used for s in self._idle)
+                        timeout = oldest + self._idle_timeout - now
+                    else:
+                        timeout = None
+                    self._cond.wait(timeout)
+                    continue
+
+                for s in expired:
+                    self._idle.remove(s)
+
+            log.debug("Stopping %d idle servers", len(expired))
+            _stop_all(expired)
+
+
+_Key = namedtuple(
+    "_Key", "filename,fmt,bitmap,offset,size,backing_chain")
+
+
+class _Server:
+    """
+    qemu-nbd server serving image on a private unix socket.
+    """
+
+    def __init__(self, key, shared):
+        self.key = key
+        self.shared = shared
+        self.last_used = None
+        self._stat = None
+        self._dir = None
+        self._server = None
+
+    @property
+    def url(self):
+        return self._server.url
+
+    def start(self):
+        # If the application is handling signals, block SIGINT in qemu-nbd for
+        # clean termination when receiving SIGINT.
+        signals = {signal.SIGINT} if _app.is_handling_signals() else None
+
+        self._stat = _image_stat(self.key.filename)
+        self._dir = tempfile.mkdtemp(prefix="imageio-")
+        try:
+            sock = UnixAddress(os.path.join(self._dir, "sock"))
+            self._server = qemu_nbd.Server(
+                self.key.filename,
+                self.key.fmt,
+                sock,
+                read_only=True,
+                shared=self.shared,
+                bitmap=self.key.bitmap,
+                offset=self.key.offset,
+                size=self.key.size,
+                backing_chain=self.key.backing_chain,
+                block_signals=signals)
+            self._server.start()
+        except BaseException:
+            shutil.rmtree(self._dir)
+            raise
+
+        log.debug("Started %s", self)
+
+    def stop(self):
+        log.debug("Stopping %s", self)
+        try:
+            self._server.stop()
+        finally:
+            shutil.rmtree(self._dir)
+
+    def alive(self):
+        return self._server.wait(0) is None
+
+    def image_changed(self):
+        try:
+            return _image_stat(self.key.filename) != self._stat
+        except FileNotFoundError:
+            return True
+
+    def __repr__(self):
+        return "<Server filename={} fmt={} shared={} at {:#x}>".format(
+            self.key.filename, self.key.fmt, self.shared, id(self))
+
+
+def _image_stat(filename):
+    st = os.stat(filename)
+    return st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns
+
+
+def _stop_all(servers):
+    for server in servers:
+        try:
+            server.stop()
+        except Exception:
+            log.exception("Error stopping %s", server)
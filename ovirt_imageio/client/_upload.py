@@ -6,12 +6,18 @@ Upload commands.
 """
 
 import os
+import sys
 from contextlib import closing
 from collections import namedtuple
+from functools import partial
+
+from .. _internal import qemu_img
 
 from . import _api
+from . import _io
 from . import _options
 from . import _ovirt
+from . import _parallel
 from . import _ui
 
 
@@ -23,6 +29,9 @@ FORMAT_RAW = "raw"
 FORMAT_QCOW2 = "qcow2"
 _DISK_FORMATS = (FORMAT_RAW, FORMAT_QCOW2)
 
+# Maximum number of workers for all disks when uploading multiple disks.
+MAX_WORKERS_ALL_DISKS = 32
+
 
 def register(parser):
     cmd = parser.add_sub_command(
@@ -30,6 +39,60 @@ def register(parser):
         help="Upload disk",
         func=upload_disk)
 
+    _add_disk_options(cmd)
+
+    cmd.add_argument(
+        "--disk-id",
+        type=_options.UUID,
+        help="A UUID for the new disk. If not specified, oVirt will "
+             "create a new UUID.")
+
+    cmd.add_argument(
+        "--name",
+        help="Alias name for the new disk. If not specified, name will "
+             "correspond with the image filename.")
+
+    cmd.add_argument(
+        "--size",
+        type=_options.Size(minimum=1),
+        help="Disk virtual size. Required when uploading from standard "
+             "input.")
+
+    cmd.add_argument(
+        "filename",
+        type=_options.FileOrStream,
+        help="Path to image to upload. Supported formats: raw, qcow2, iso. "
+             "Use '-' to upload raw image data from standard input. When "
+             "reading from standard input, use --password-file.")
+
+    cmd = parser.add_sub_command(
+        "upload-disks",
+        help="Upload multiple disks concurrently",
+        func=upload_disks,
+        max_workers=MAX_WORKERS_ALL_DISKS)
+
+    _add_disk_options(cmd)
+
+    cmd.add_argument(
+        "--max-rate",
+        type=_options.Size(minimum=1),
+        help="Maximum upload rate in bytes per second for all disks "
+             "(e.g. 100m). If not specified, the rate is not limited.")
+
+    cmd.add_argument(
+        "filenames",
+        metavar="filename",
+        nargs="+",
+        type=_options.File,
+        help="Path to image to upload. Supported formats: raw, qcow2, iso. "
+             "A new disk is created for every image, named after the image "
+             "filename. The images are uploaded concurrently, dividing "
+             "--max-workers workers between the images when they start. "
+             "Workers of a completed image are not given to images that are "
+             "still uploading.")
+
+
+def _add_disk_options(cmd):
     cmd.add_argument(
         "-s", "--storage-domain",
         required=True,
@@ -50,70 +113,118 @@ def register(parser):
              "block based storage domain (iSCSI, FC). ISO images are "
              "always uploaded to preallocated disk.")
 
-    cmd.add_argument(
-        "--disk-id",
-        type=_options.UUID,
-        help="A UUID for the new disk. If not specified, oVirt will "
-             "create a new UUID.")
-
-    cmd.add_argument(
-        "--name",
-        help="Alias name for the new disk. If not specified, name will "
-             "correspond with the image filename.")
-
-    cmd.add_argument(
-        "filename",
-        type=_options.File,
-        help="Path to image to upload. Supported formats: raw, qcow2, iso.")
-
 
 def upload_disk(args):
+    stream = args.filename == "-"
     with _ui.ProgressBar(phase="inspecting image") as progress:
-        disk_info = _prepare(args)
+        if stream:
+            disk_info = _prepare_stream(args)
+        else:
+            disk_info = _prepare(
+                args.filename, args.format, args.sparse, name=args.name)
         con = _ovirt.connect(args)
         with closing(con):
-            progress.phase = "creating disk"
-            disk = _ovirt.add_disk(
-                con=con,
-                name=disk_info.name,
-                initial_size=disk_info.initial_size,
-                provisioned_size=disk_info.provisioned_size,
-                sd_name=args.storage_domain,
-                id=args.disk_id,
-                sparse=disk_info.sparse,
-                enable_backup=disk_info.format == _ovirt.COW,
-                content_type=disk_info.content_type,
-                format=disk_info.format,
-                timeout=args.disk_timeout)
-
-            progress.phase = "creating transfer"
-            host = _ovirt.find_host(con, args.storage_domain)
-            transfer = _ovirt.create_transfer(con, disk, host=host)
-            try:
-                progress.phase = "uploading image"
-                _api.upload(
-                    args.filename,
-                    transfer.transfer_url,
-                    args.cafile,
-                    buffer_size=args.buffer_size,
-                    progress=progress,
-                    secure=args.secure,
-                    proxy_url=transfer.proxy_url,
-                    max_workers=args.max_workers,
-                    disk_is_zero=disk_info.is_zero)
-            except Exception:
-                progress.phase = "cancelling transfer"
-                _ovirt.cancel_transfer(con, transfer)
-                raise
-
-            progress.phase = "finalizing transfer"
-            _ovirt.finalize_transfer(con, transfer, disk)
+            _upload_disk(
+                con,
+                args,
+                args.filename,
+                disk_info,
+                progress,
+                disk_id=args.disk_id,
+                max_workers=args.max_workers)
         progress.phase = "upload completed"
 
 
-def _prepare(args):
+def upload_disks(args):
+    limiter = _io.RateLimiter(args.max_rate) if args.max_rate else None
+    with _ui.ProgressBar(phase="inspecting images") as progress:
+        # Inspect all images before creating any disk, so an unsupported
+        # image does not leave some disks behind.
+        tasks = []
+        for filename in args.filenames:
+            disk_info = _prepare(filename, args.format, args.sparse)
+            tasks.append(_parallel.Task(
+                name=filename,
+                size=disk_info.provisioned_size,
+                func=partial(
+                    _upload_task, args, filename, disk_info, limiter)))
+
+        _parallel.run(
+            tasks, args.max_workers, progress=progress,
+            phase="uploading disks")
+        progress.phase = "upload completed"
+
+
+def _upload_task(args, filename, disk_info, limiter, progress, max_workers):
+    # The engine connection is not thread safe, so every disk uses its own
+    # connection.
+    con = _ovirt.connect(args)
+    with closing(con):
+        _upload_disk(
+            con,
+            args,
+            filename,
+            disk_info,
+            progress,
+            max_workers=max_workers,
+            limiter=limiter)
+
+
+def _upload_disk(con, args, filename, disk_info, progress, disk_id=None,
+                 max_workers=_api.MAX_WORKERS, limiter=None):
+    progress.phase = "creating disk"
+    disk = _ovirt.add_disk(
+        con=con,
+        name=disk_info.name,
+        initial_size=disk_info.initial_size,
+        provisioned_size=disk_info.provisioned_size,
+        sd_name=args.storage_domain,
+        id=disk_id,
+        sparse=disk_info.sparse,
+        enable_backup=disk_info.format == _ovirt.COW,
+        content_type=disk_info.content_type,
+        format=disk_info.format,
+        timeout=args.disk_timeout)
+
+    progress.phase = "creating transfer"
+    host = _ovirt.find_host(con, args.storage_domain)
+    transfer = _ovirt.create_transfer(con, disk, host=host)
+    try:
+        progress.phase = "uploading image"
+        if filename == "-":
+            _api.upload_stream(
+                sys.stdin.buffer,
+                transfer.transfer_url,
+                args.cafile,
+                buffer_size=args.buffer_size,
+                progress=progress,
+                secure=args.secure,
+                proxy_url=transfer.proxy_url,
+                disk_is_zero=disk_info.is_zero)
+        else:
+            _api.upload(
+                filename,
+                transfer.transfer_url,
+                args.cafile,
+                buffer_size=args.buffer_size,
+                progress=progress,
+                secure=args.secure,
+                proxy_url=transfer.proxy_url,
+                max_workers=max_workers,
+                disk_is_zero=disk_info.is_zero,
+                limiter=limiter)
+    except Exception:
+        progress.phase = "cancelling transfer"
+        _ovirt.cancel_transfer(con, transfer)
+        raise
+
+    progress.phase = "finalizing transfer"
+    _ovirt.finalize_transfer(con, transfer, disk)
+
+
+def _prepare(filename, fmt, sparse, name=None):
     # Obtain the image info dictionary.
-    img_info = _api.info(args.filename)
+    img_info = _api.info(filename)
     if img_info["format"] not in _DISK_FORMATS:
         raise RuntimeError(f"Unsupported image format {img_info['format']}")
 
@@ -125,14 +236,12 @@ def _prepare(args):
         sparse = False
     else:
         content_type = _ovirt.DATA
-        disk_format = args.format
-        sparse = args.sparse
+        disk_format = fmt
 
     initial_size = None
     if disk_format == FORMAT_QCOW2 and sparse:
-        initial_size = _api.measure(args.filename, disk_format)["required"]
+        initial_size = _api.measure(filename, disk_format)["required"]
 
-    name = args.name
     if name is None:
         name = os.path.splitext(os.path.basename(img_info["filename"]))[0]
 
@@ -151,6 +260,36 @@ def _prepare(args):
         is_zero=is_zero)
 
 
+def _prepare_stream(args):
+    # The stream contains raw image data, and we cannot inspect it before
+    # uploading.
+    if args.size is None:
+        raise RuntimeError(
+            "--size is required when uploading from standard input")
+
+    # We don't know how much data the stream contains, so we must allocate
+    # space for the entire image.
+    initial_size = None
+    if args.format == FORMAT_QCOW2 and args.sparse:
+        initial_size = qemu_img.measure(
+            None, FORMAT_QCOW2, size=args.size)["fully-allocated"]
+
+    name = args.name
+    if name is None:
+        name = "stdin"
+
+    is_zero = (args.format == FORMAT_QCOW2) or args.sparse
+
+    return DiskInfo(
+        name=name,
+        initial_size=initial_size,
+        provisioned_size=args.size,
+        content_type=_ovirt.DATA,
+        format=_ovirt.COW if args.format == FORMAT_QCOW2 else _ovirt.RAW,
+        sparse=args.sparse,
+        is_zero=is_zero)
+
+
 def _is_iso(filename, image_format):
     """
     Detect if disk content type is ISO
@@ -424,6 +424,28 @@ def test_dirty(cfg):
     assert ticket.dirty
 
 
+def test_detect_zeroes_unset(cfg):
+    ticket = Ticket(testutil.create_ticket(), cfg)
+    assert not ticket.detect_zeroes
+    assert "detect_zeroes" not in ticket.info()
+
+
+def test_detect_zeroes(cfg):
+    ticket = Ticket(testutil.create_ticket(detect_zeroes=True), cfg)
+    assert ticket.detect_zeroes
+    assert ticket.info()["detect_zeroes"]
+
+
+def test_detect_zeroes_config(cfg):
+    cfg.daemon.detect_zeroes = True
+    ticket = Ticket(testutil.create_ticket(), cfg)
+    assert ticket.detect_zeroes
+
+    # Ticket value overrides the configuration.
+    ticket = Ticket(testutil.create_ticket(detect_zeroes=False), cfg)
+    assert not ticket.detect_zeroes
+
+
 def test_transfer_id_unset(cfg):
     d = testutil.create_ticket()
     del d["transfer_id"]
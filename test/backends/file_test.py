@@ -644,6 +644,67 @@ def test_extents(user_file):
         ]
 
 
+def test_extents_holes(user_file):
+    size = 4 * 1024**2
+    chunk = 1024**2
+
+    with io.open(user_file.path, "wb") as f:
+        f.write(b"x" * chunk)
+        f.seek(2 * chunk)
+        f.write(b"x" * chunk)
+        f.truncate(size)
+
+    with file.open(user_file.url, "r", holes=True) as f:
+        f.seek(4096)
+        extents = list(f.extents())
+
+        # Detecting extents does not modify the file position.
+        assert f.tell() == 4096
+
+        # Extents are merged since the file system may report data using
+        # smaller extents.
+        assert _merge(extents) == [
+            extent.ZeroExtent(0, chunk, False, False),
+            extent.ZeroExtent(chunk, chunk, True, False),
+            extent.ZeroExtent(2 * chunk, chunk, False, False),
+            extent.ZeroExtent(3 * chunk, chunk, True, False),
+        ]
+
+        # Clone reports the same extents.
+        with f.clone() as c:
+            assert list(c.extents()) == extents
+
+
+def test_extents_holes_range(user_file):
+    size = 4 * 1024**2
+    chunk = 1024**2
+
+    with io.open(user_file.path, "wb") as f:
+        f.write(b"x" * chunk)
+        f.seek(2 * chunk)
+        f.write(b"x" * chunk)
+        f.truncate(size)
+
+    with file.open(user_file.url, "r", holes=True) as f:
+        extents = list(f.extents(offset=chunk // 2, length=2 * chunk))
+        assert _merge(extents) == [
+            extent.ZeroExtent(chunk // 2, chunk // 2, False, False),
+            extent.ZeroExtent(chunk, chunk, True, False),
+            extent.ZeroExtent(2 * chunk, chunk // 2, False, False),
+        ]
+
+
+def _merge(extents):
+    merged = []
+    for ext in extents:
+        if merged and merged[-1].zero == ext.zero:
+            last = merged.pop()
+            ext = extent.ZeroExtent(
+                last.start, last.length + ext.length, ext.zero, ext.hole)
+        merged.append(ext)
+    return merged
+
+
 def test_extents_dirty(user_file):
     with file.open(user_file.url, "r+", dirty=True) as f:
         with pytest.raises(errors.UnsupportedOperation):
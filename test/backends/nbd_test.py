@@ -8,6 +8,7 @@ import pytest
 import userstorage
 
 from ovirt_imageio._internal import errors
+from ovirt_imageio._internal import nbd as nbd_client
 from ovirt_imageio._internal import extent
 from ovirt_imageio._internal import qemu_img
 from ovirt_imageio._internal import util
@@ -176,6 +177,39 @@ def test_zero_sparse(nbd_server, user_file, sparse):
         assert actual_size == 0 if sparse else b.size()
 
 
+class FastZeroClient:
+    """
+    Fake client failing fast zero requests.
+    """
+
+    address = None
+    export_name = ""
+    can_fast_zero = True
+
+    def __init__(self):
+        self.requests = []
+
+    def zero(self, offset, length, punch_hole=True, fast=False):
+        self.requests.append((offset, length, fast))
+        if fast:
+            raise nbd_client.ReplyError(nbd_client.ENOTSUP, "Slow zero")
+
+
+def test_zero_fast_fallback():
+    client = FastZeroClient()
+    b = nbd.Backend(client, "r+")
+
+    b.zero(4096)
+    b.zero(4096)
+
+    # After the server reported slow zero, we zero without the fast flag.
+    assert client.requests == [
+        (0, 4096, True),
+        (0, 4096, False),
+        (4096, 4096, False),
+    ]
+
+
 def test_close(nbd_server):
     nbd_server.start()
     with nbd.open(nbd_server.url, "r+") as b:
@@ -6,8 +6,10 @@ import pytest
 
 from ovirt_imageio._internal import auth
 from ovirt_imageio._internal import backends
+from ovirt_imageio._internal import coalesce
 from ovirt_imageio._internal import config
 from ovirt_imageio._internal import errors
+from ovirt_imageio._internal import groupcommit
 from ovirt_imageio._internal import nbd
 
 from . import testutil
@@ -111,6 +113,44 @@ def test_get_sparse(tmpurl, cfg, sparse):
     assert b.sparse == sparse
 
 
+def test_get_coalesce_writes(tmpurl, cfg):
+    cfg.backend_file.coalesce_size = 1024**2
+    ticket = auth.Ticket(
+        testutil.create_ticket(url=urlunparse(tmpurl)), cfg)
+    req = Request()
+    b = backends.get(req, ticket, cfg).backend
+
+    assert isinstance(b, coalesce.Backend)
+    assert b.name == "file"
+    assert ticket.write_buffer is not None
+
+
+def test_get_coalesce_writes_read_only(tmpurl, cfg):
+    cfg.backend_file.coalesce_size = 1024**2
+    ticket = auth.Ticket(
+        testutil.create_ticket(url=urlunparse(tmpurl), ops=["read"]), cfg)
+    req = Request()
+    b = backends.get(req, ticket, cfg).backend
+
+    assert not isinstance(b, coalesce.Backend)
+    assert ticket.write_buffer is None
+
+
+def test_get_group_flush(tmpurl, cfg):
+    ticket = auth.Ticket(
+        testutil.create_ticket(url=urlunparse(tmpurl)), cfg)
+    req = Request()
+    b = backends.get(req, ticket, cfg).backend
+
+    assert isinstance(b, groupcommit.Backend)
+    b.flush()
+    assert ticket.info()["flushes"] == {
+        "requests": 1,
+        "flushes": 1,
+        "coalesced": 0,
+    }
+
+
 @pytest.mark.parametrize("transport", [
     "unix",
     pytest.param("tcp", marks=flaky_in_ovirt_ci),
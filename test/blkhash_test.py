@@ -2,10 +2,14 @@
 # SPDX-License-Identifier: GPL-2.0-or-later
 
 import hashlib
+import os
 import pytest
 from functools import partial
 
 from ovirt_imageio._internal import blkhash
+from ovirt_imageio._internal import extent
+from ovirt_imageio._internal.backends import memory
+from ovirt_imageio.client import _io
 
 default_hash = partial(hashlib.blake2b, digest_size=32)
 
@@ -91,7 +95,8 @@ def test_hasher_zero():
     (0, "sha1", None,
         "da39a3ee5e6b4b0d3255bfef95601890afd80709"),
 ])
-def test_checksum(tmpdir, size, algorithm, digest_size, checksum):
+@pytest.mark.parametrize("workers", [1, 4])
+def test_checksum(tmpdir, size, algorithm, digest_size, checksum, workers):
     path = str(tmpdir.join("file"))
 
     with open(path, "wb") as f:
@@ -102,10 +107,433 @@ def test_checksum(tmpdir, size, algorithm, digest_size, checksum):
         path,
         block_size=blkhash.BLOCK_SIZE,
         algorithm=algorithm,
-        digest_size=digest_size)
+        digest_size=digest_size,
+        workers=workers)
 
     assert actual == {
         "algorithm": algorithm,
         "block_size": blkhash.BLOCK_SIZE,
         "checksum": checksum,
     }
+
+
+@pytest.mark.parametrize("workers", [1, 2, 8])
+@pytest.mark.parametrize("detect_zeroes", [True, False])
+def test_pipeline(workers, detect_zeroes):
+    block_size = 1024**2
+    blocks = []
+    for i in range(20):
+        if i % 3 == 0:
+            # Zero block reported by extents.
+            blocks.append(None)
+        elif i % 5 == 0:
+            # Zero block that must be detected.
+            blocks.append(b"\0" * block_size)
+        else:
+            blocks.append((b"%02d\n" % i).ljust(block_size, b"\0"))
+    # Short last block.
+    blocks.append(b"last")
+
+    h1 = blkhash.Hash(block_size=block_size)
+    for block in blocks:
+        if block is None:
+            h1.zero(block_size)
+        else:
+            h1.update(block)
+
+    h2 = blkhash.Hash(block_size=block_size)
+    with blkhash.Pipeline(
+            h2, workers=workers, detect_zeroes=detect_zeroes) as p:
+        for block in blocks:
+            if block is None:
+                p.zero(block_size)
+            else:
+                buf = p.buffer()
+                buf[:len(block)] = block
+                p.update(buf, len(block))
+        p.complete()
+
+    assert h1.hexdigest() == h2.hexdigest()
+
+
+def test_pipeline_limits_buffers():
+    h = blkhash.Hash(block_size=4096)
+    with blkhash.Pipeline(h, workers=2) as p:
+        bufs = set()
+        for i in range(20):
+            buf = p.buffer()
+            bufs.add(id(buf))
+            p.update(buf, 4096)
+        p.complete()
+
+    # Buffers are reused after their blocks are hashed.
+    assert len(bufs) <= 4
+
+
+def test_pipeline_shares_buffers_budget(monkeypatch):
+    block_size = 4096
+    budget = blkhash._Budget(3 * block_size)
+    monkeypatch.setattr(blkhash, "_buffers_budget", budget)
+
+    blocks = [(b"%02d\n" % i).ljust(block_size, b"\0") for i in range(20)]
+
+    h1 = blkhash.Hash(block_size=block_size)
+    for block in blocks:
+        h1.update(block)
+
+    h2 = blkhash.Hash(block_size=block_size)
+    h3 = blkhash.Hash(block_size=block_size)
+    bufs = set()
+
+    with blkhash.Pipeline(h2, workers=2) as p2, \
+            blkhash.Pipeline(h3, workers=2) as p3:
+        for block in blocks:
+            for p in (p2, p3):
+                buf = p.buffer()
+                bufs.add(id(buf))
+                buf[:] = block
+                p.update(buf, block_size)
+        p2.complete()
+        p3.complete()
+
+        # Both pipelines reuse their buffers when the budget is exhausted.
+        assert len(bufs) <= 3
+        assert budget.available == 0
+
+    # Closing the pipelines releases the buffers.
+    assert budget.available == 3 * block_size
+
+    assert h2.hexdigest() == h1.hexdigest()
+    assert h3.hexdigest() == h1.hexdigest()
+
+
+def checksum_of(tmpdir, data, block_size):
+    path = str(tmpdir.join("expected"))
+    with open(path, "wb") as f:
+        f.write(data)
+    return blkhash.checksum(path, block_size=block_size)
+
+
+@pytest.mark.parametrize("size", [
+    pytest.param(0, id="empty"),
+    pytest.param(4 * 1024**2, id="aligned"),
+    pytest.param(4 * 1024**2 + 42, id="unaligned"),
+])
+def test_accumulator(tmpdir, size):
+    block_size = 1024**2
+    data = bytearray(b"x" * size)
+    if size:
+        data[block_size:3 * block_size] = b"\0" * 2 * block_size
+    a = blkhash.Accumulator(size, block_size=block_size)
+
+    # Fill blocks in reverse order, using chunks smaller than a block. The
+    # zero blocks are filled using zero ranges.
+    chunk = block_size // 4
+    for index in reversed(range(0, size, block_size)):
+        for offset in range(index, min(index + block_size, size), chunk):
+            length = min(chunk, size - offset)
+            if block_size <= offset < 3 * block_size:
+                a.zero(offset, length)
+            else:
+                a.update(offset, data[offset:offset + length])
+
+    assert a.result() == checksum_of(tmpdir, data, block_size)
+
+
+def test_accumulator_zero_spanning_blocks(tmpdir):
+    block_size = 1024**2
+    size = 4 * block_size
+    a = blkhash.Accumulator(size, block_size=block_size)
+
+    a.update(0, b"x" * 100)
+    a.zero(100, size - 100)
+
+    data = b"x" * 100 + b"\0" * (size - 100)
+    assert a.result() == checksum_of(tmpdir, data, block_size)
+
+
+def test_accumulator_incomplete():
+    a = blkhash.Accumulator(2 * 1024**2, block_size=1024**2)
+    a.update(0, b"x" * 1024**2)
+    assert a.result() is None
+
+
+def test_accumulator_out_of_order(tmpdir):
+    block_size = 1024**2
+    size = 2 * block_size + 42
+    data = bytearray(b"x" * size)
+    data[100:200] = b"\0" * 100
+    a = blkhash.Accumulator(size, block_size=block_size)
+
+    # Ranges crossing block boundaries, filled in reverse order.
+    a.update(block_size + 100, data[block_size + 100:])
+    a.update(1000, data[1000:block_size + 100])
+    a.update(200, data[200:1000])
+    a.zero(100, 100)
+    assert a.result() is None
+
+    a.update(0, data[:100])
+    assert a.result() == checksum_of(tmpdir, data, block_size)
+
+
+def test_accumulator_fill_again(tmpdir):
+    block_size = 1024**2
+    size = 2 * block_size
+    a = blkhash.Accumulator(size, block_size=block_size)
+
+    # Filling an incomplete block again replaces the previous data.
+    a.update(0, b"y" * 100)
+    a.update(0, b"x" * 200)
+    a.zero(200, block_size - 200)
+
+    # Zeroing a complete zero block again does not change it.
+    a.zero(block_size, block_size)
+    a.zero(block_size, 100)
+
+    data = b"x" * 200 + b"\0" * (size - 200)
+    assert a.result() == checksum_of(tmpdir, data, block_size)
+
+
+@pytest.mark.parametrize("ranges", [
+    # Block filled again after it was completed.
+    [(0, 1024**2), (0, 100)],
+    # Range after end of image.
+    [(2 * 1024**2 - 100, 200)],
+])
+def test_accumulator_failed(ranges):
+    block_size = 1024**2
+    size = 2 * block_size
+    a = blkhash.Accumulator(size, block_size=block_size)
+
+    for offset, length in ranges:
+        a.update(offset, b"x" * length)
+
+    # Filling the rest of the image does not help.
+    a.zero(0, size)
+    assert a.result() is None
+
+
+def test_accumulator_fill_zeroes(tmpdir):
+    block_size = 1024**2
+    size = 4 * block_size + 42
+    data = bytearray(size)
+    data[block_size - 100:block_size + 100] = b"x" * 200
+    data[3 * block_size:3 * block_size + 100] = b"y" * 100
+    a = blkhash.Accumulator(size, block_size=block_size)
+
+    # Upload only the data extents.
+    a.update(block_size - 100, data[block_size - 100:block_size + 100])
+    a.update(3 * block_size, data[3 * block_size:3 * block_size + 100])
+    assert a.result() is None
+
+    # Areas not uploaded are zero in the image.
+    a.fill_zeroes([
+        extent.ZeroExtent(0, block_size - 100, True, False),
+        extent.ZeroExtent(block_size - 100, 200, False, False),
+        extent.ZeroExtent(block_size + 100, 2 * block_size - 100, True, True),
+        extent.ZeroExtent(3 * block_size, 100, False, False),
+        extent.ZeroExtent(3 * block_size + 100, block_size - 58, True, True),
+    ])
+    assert a.result() == checksum_of(tmpdir, data, block_size)
+
+
+def test_accumulator_fill_zeroes_then_data(tmpdir):
+    block_size = 1024**2
+    size = 4 * block_size
+    data = bytearray(size)
+    data[:100] = b"x" * 100
+    a = blkhash.Accumulator(size, block_size=block_size)
+
+    # Flushing in the middle of the upload, when the rest of the image is
+    # zero.
+    a.update(0, data[:100])
+    a.fill_zeroes([
+        extent.ZeroExtent(0, 100, False, False),
+        extent.ZeroExtent(100, size - 100, True, True),
+    ])
+    assert a.result() == checksum_of(tmpdir, data, block_size)
+
+    # Uploading the rest of the image, into blocks completed by the zero
+    # extents.
+    data[2 * block_size:3 * block_size] = b"y" * block_size
+    a.update(2 * block_size, data[2 * block_size:3 * block_size])
+    data[block_size + 100:block_size + 200] = b"z" * 100
+    a.update(block_size + 100, data[block_size + 100:block_size + 200])
+
+    # The rest of the partly written block is filled by the next flush.
+    assert a.result() is None
+    a.fill_zeroes([
+        extent.ZeroExtent(0, 100, False, False),
+        extent.ZeroExtent(100, block_size, True, True),
+        extent.ZeroExtent(block_size + 100, 100, False, False),
+        extent.ZeroExtent(block_size + 200, block_size - 200, True, True),
+        extent.ZeroExtent(2 * block_size, block_size, False, False),
+        extent.ZeroExtent(3 * block_size, block_size, True, True),
+    ])
+    assert a.result() == checksum_of(tmpdir, data, block_size)
+
+
+def test_accumulator_max_partial_size():
+    block_size = 1024**2
+    size = 4 * block_size
+    a = blkhash.Accumulator(
+        size, block_size=block_size, max_partial_size=block_size)
+
+    # The buffer of the first incomplete block is released when the block is
+    # completed.
+    a.update(0, b"x" * 100)
+    a.zero(100, block_size - 100)
+    a.update(block_size, b"x" * 100)
+
+    # The second incomplete block exceeds the limit.
+    a.update(2 * block_size, b"x" * 100)
+
+    a.zero(block_size + 100, size - block_size - 100)
+    assert a.result() is None
+
+
+class AccumulatingBackend:
+    """
+    Backend adding written data to an accumulator, like the daemon write and
+    zero operations.
+    """
+
+    def __init__(self, backend, accumulator):
+        self._backend = backend
+        self._accumulator = accumulator
+
+    def size(self):
+        return self._backend.size()
+
+    def seek(self, n, how=os.SEEK_SET):
+        return self._backend.seek(n, how)
+
+    def tell(self):
+        return self._backend.tell()
+
+    def write(self, buf):
+        self._accumulator.update(self._backend.tell(), buf)
+        return self._backend.write(buf)
+
+    def zero(self, count):
+        self._accumulator.zero(self._backend.tell(), count)
+        return self._backend.zero(count)
+
+    def extents(self, context="zero"):
+        return self._backend.extents(context)
+
+    def flush(self):
+        self._backend.flush()
+
+    def clone(self):
+        return AccumulatingBackend(self._backend.clone(), self._accumulator)
+
+    def close(self):
+        self._backend.close()
+
+
+@pytest.mark.parametrize("locality", [True, False])
+def test_accumulator_copy(tmpdir, locality):
+    block_size = 1024**2
+    size = 8 * block_size + 4096
+    chunk = 64 * 1024
+
+    # Data and zero extents not aligned to blocks.
+    data = bytearray(size)
+    src_extents = []
+    start = 0
+    for i, length in enumerate([300, 200, 700, 500, 900, 1000]):
+        length *= 4096
+        length = min(length, size - start)
+        zero = i % 2 == 1
+        if not zero:
+            data[start:start + length] = b"%d" % i * length
+        src_extents.append(extent.ZeroExtent(start, length, zero, False))
+        start += length
+    assert start == size
+
+    src = memory.Backend("r", data=data, extents={"zero": src_extents})
+    a = blkhash.Accumulator(size, block_size=block_size)
+    dst = AccumulatingBackend(memory.Backend("r+", data=bytearray(size)), a)
+
+    # Many small requests handled by multiple workers.
+    _io.copy(
+        src, dst,
+        max_workers=4,
+        buffer_size=chunk,
+        max_gap=0,
+        locality=locality)
+
+    assert a.result() == checksum_of(tmpdir, data, block_size)
+
+
+class Extent:
+
+    def __init__(self, start, length, zero):
+        self.start = start
+        self.length = length
+        self.zero = zero
+
+
+@pytest.mark.parametrize("start,end,expected", [
+    # Entire image.
+    (0, 300, [(0, 100, False), (100, 100, True), (200, 100, False)]),
+    # Inside one extent.
+    (110, 190, [(110, 80, True)]),
+    # Spanning extents.
+    (50, 250, [(50, 50, False), (100, 100, True), (200, 50, False)]),
+    # Aligned to extents.
+    (100, 200, [(100, 100, True)]),
+    # Empty range.
+    (100, 100, []),
+])
+def test_clip(start, end, expected):
+    extents = [
+        Extent(0, 100, False),
+        Extent(100, 100, True),
+        Extent(200, 100, False),
+    ]
+    blocks = blkhash.clip(extents, start, end)
+    assert [(b.start, b.length, b.zero) for b in blocks] == expected
+
+
+@pytest.mark.parametrize("size", [
+    3 * blkhash.BLOCK_SIZE,
+    3 * blkhash.BLOCK_SIZE + 42,
+])
+def test_block_map(size):
+    blocks = []
+    for start in range(0, size, blkhash.BLOCK_SIZE):
+        length = min(blkhash.BLOCK_SIZE, size - start)
+        blocks.append((b"%d" % start).ljust(length, b"\0"))
+    blocks[1] = bytes(len(blocks[1]))
+
+    h = blkhash.Hash()
+    m = blkhash.BlockMap()
+    for block in blocks:
+        h.update(block)
+        if block == bytes(len(block)):
+            m.zero(len(block))
+        else:
+            m.update(block)
+
+    assert m.hexdigest() == h.hexdigest()
+    assert m.block_map() == b"".join(
+        default_hash(block).digest() for block in blocks)
+
+
+def test_changed_blocks():
+    a = b"".join(bytes([i]) * 4 for i in range(4))
+    b = bytearray(a)
+    b[4:8] = b"xxxx"
+    b[12:16] = b"yyyy"
+    assert list(blkhash.changed_blocks(a, b, 4)) == [1, 3]
+
+    # Missing blocks are changed.
+    assert list(blkhash.changed_blocks(a, a[:8], 4)) == [2, 3]
+    assert list(blkhash.changed_blocks(a, a, 4)) == []
+
+
+def test_changed_blocks_invalid():
+    with pytest.raises(ValueError):
+        list(blkhash.changed_blocks(b"x" * 8, b"x" * 7, 4))
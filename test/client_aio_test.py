@@ -0,0 +1,200 @@
+# SPDX-FileCopyrightText: Red Hat, Inc.
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import asyncio
+
+import pytest
+
+from ovirt_imageio import client
+from ovirt_imageio._internal import config
+from ovirt_imageio._internal import http
+from ovirt_imageio._internal import ipv6
+from ovirt_imageio._internal import server
+from ovirt_imageio._internal.extent import ZeroExtent
+
+from . import testutil
+
+SIZE = 1024**2
+
+
+@pytest.fixture(scope="module")
+def srv():
+    cfg = config.load(["test/conf/daemon.conf"])
+    s = server.Server(cfg)
+    s.start()
+    yield s
+    s.stop()
+
+
+@pytest.fixture
+def image(tmpdir):
+    path = tmpdir.join("image.raw")
+    with open(str(path), "wb") as f:
+        f.truncate(SIZE)
+    return path
+
+
+def prepare_transfer(srv, image, ops=("read", "write")):
+    ticket = testutil.create_ticket(
+        url="file://{}".format(image), size=SIZE, ops=list(ops))
+    srv.auth.add(ticket)
+
+    host, port = srv.remote_service.address
+    host = ipv6.quote_address(host)
+    return "https://{}:{}/images/{}".format(host, port, ticket["uuid"])
+
+
+def run(coro):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
+def test_read_write(srv, image):
+    url = prepare_transfer(srv, image)
+
+    async def test():
+        async with client.AsyncImageioClient(
+                url, cafile=srv.config.tls.ca_file) as c:
+            assert c.size() == SIZE
+
+            # Local server is accessed using unix socket.
+            assert c._unix_socket
+
+            # Concurrent writes and reads.
+            chunk = SIZE // 8
+            await asyncio.gather(*(
+                c.write(i * chunk, bytes([i + 1]) * chunk)
+                for i in range(8)))
+            await c.flush()
+
+            bufs = [bytearray(chunk) for i in range(8)]
+            await asyncio.gather(*(
+                c.read(i * chunk, bufs[i]) for i in range(8)))
+
+            for i, buf in enumerate(bufs):
+                assert buf == bytes([i + 1]) * chunk
+
+    run(test())
+
+    assert image.read_binary() == b"".join(
+        bytes([i + 1]) * (SIZE // 8) for i in range(8))
+
+
+def test_zero(srv, image):
+    image.write(b"x" * SIZE, mode="wb")
+    url = prepare_transfer(srv, image)
+
+    async def test():
+        async with client.AsyncImageioClient(
+                url, cafile=srv.config.tls.ca_file) as c:
+            await c.zero(4096, 8192)
+            await c.flush()
+
+    run(test())
+
+    data = image.read_binary()
+    assert data[:4096] == b"x" * 4096
+    assert data[4096:12288] == b"\0" * 8192
+    assert data[12288:] == b"x" * (SIZE - 12288)
+
+
+def test_flush_all_connections(srv, image):
+    url = prepare_transfer(srv, image)
+
+    async def test():
+        async with client.AsyncImageioClient(
+                url, cafile=srv.config.tls.ca_file) as c:
+            # The file backend publishes a single writer. Allow concurrent
+            # writes to write data using multiple connections.
+            c._writers = asyncio.Semaphore(8)
+
+            chunk = SIZE // 8
+            await asyncio.gather(*(
+                c.write(i * chunk, bytes([i + 1]) * chunk)
+                for i in range(8)))
+
+            # Data was written using multiple connections.
+            assert sum(con.dirty for con in c._idle) > 1
+
+            flushes = []
+            patch = c._patch
+
+            async def record_patch(msg, con=None, dirty=None):
+                flushes.append(con)
+                await patch(msg, con=con, dirty=dirty)
+
+            c._patch = record_patch
+            await c.flush()
+
+            # Every connection was flushed.
+            assert len(flushes) > 1
+            assert not any(con.dirty for con in c._idle)
+
+    run(test())
+
+    assert image.read_binary() == b"".join(
+        bytes([i + 1]) * (SIZE // 8) for i in range(8))
+
+
+def test_extents(srv, image):
+    url = prepare_transfer(srv, image)
+
+    async def test():
+        async with client.AsyncImageioClient(
+                url, cafile=srv.config.tls.ca_file) as c:
+            return await c.extents()
+
+    # File backend reports entire file as data.
+    assert run(test()) == [ZeroExtent(0, SIZE, False, False)]
+
+
+def test_out_of_bounds(srv, image):
+    url = prepare_transfer(srv, image)
+
+    async def test():
+        async with client.AsyncImageioClient(
+                url, cafile=srv.config.tls.ca_file) as c:
+            with pytest.raises(RuntimeError):
+                await c.read(SIZE - 10, bytearray(20))
+            with pytest.raises(RuntimeError):
+                await c.write(SIZE - 10, bytearray(20))
+
+    run(test())
+
+
+def test_server_error(srv, image):
+    url = prepare_transfer(srv, image, ops=["read"])
+
+    async def test():
+        async with client.AsyncImageioClient(
+                url, cafile=srv.config.tls.ca_file) as c:
+            with pytest.raises(http.Error) as e:
+                await c.write(0, b"x" * 4096)
+            assert e.value.code == http.FORBIDDEN
+
+            # The client can be used after an error.
+            buf = bytearray(4096)
+            await c.read(0, buf)
+            assert buf == b"\0" * 4096
+
+    run(test())
+
+
+def test_max_connections(srv, image):
+    url = prepare_transfer(srv, image)
+
+    async def test():
+        async with client.AsyncImageioClient(
+                url, cafile=srv.config.tls.ca_file, max_connections=2) as c:
+            chunk = SIZE // 16
+            bufs = [bytearray(chunk) for i in range(16)]
+            await asyncio.gather(*(
+                c.read(i * chunk, bufs[i]) for i in range(16)))
+
+            # Connections were reused.
+            assert len(c._idle) <= 2
+
+    run(test())
@@ -1,18 +1,21 @@
 # SPDX-FileCopyrightText: Red Hat, Inc.
 # SPDX-License-Identifier: GPL-2.0-or-later
 
+import threading
 import time
 import pytest
 
 from urllib.parse import urlparse
 
 from ovirt_imageio._internal import extent
+from ovirt_imageio._internal import measure
 from ovirt_imageio._internal import qemu_img
 from ovirt_imageio._internal import qemu_nbd
 from ovirt_imageio._internal.backends import nbd, memory
 from ovirt_imageio._internal.nbd import UnixAddress
 
 from ovirt_imageio.client import _io
+from ovirt_imageio.client import _journal
 
 ZERO_PARAMS = [
     # Copying to image with unknown content.
@@ -205,7 +208,9 @@ def test_copy_data_progress(zero, hole):
     dst = memory.Backend("r+", data=dst_backing)
 
     p = FakeProgress()
-    _io.copy(src, dst, max_workers=1, zero=zero, hole=hole, progress=p)
+    # Disable coalescing to get one request per extent.
+    _io.copy(src, dst, max_workers=1, zero=zero, hole=hole, progress=p,
+             max_gap=0)
 
     # Report at least every extent.
     assert len(p.updates) >= 4
@@ -233,6 +238,449 @@ def test_copy_dirty_progress():
     assert sum(p.updates) == len(dst_backing)
 
 
+@pytest.mark.parametrize("progress", [None, FakeProgress()])
+def test_copy_changed(progress):
+    src = memory.Backend(
+        mode="r",
+        data=create_backing("AB0-EF"),
+        extents={"zero": create_zero_extents("AB0-EF")},
+    )
+    dst_backing = create_backing("AXYZEX")
+    dst = memory.Backend("r+", data=dst_backing)
+
+    # Ranges starting and ending inside extents.
+    changed = [
+        measure.Range(CHUNK_SIZE + 10, 4 * CHUNK_SIZE - 10),
+        measure.Range(5 * CHUNK_SIZE, 6 * CHUNK_SIZE),
+    ]
+    _io.copy(src, dst, max_workers=1, changed=changed, progress=progress)
+
+    # Copy data and zero zero extents in changed ranges, skip the rest.
+    expected = create_backing("AB0-EF")
+    expected[CHUNK_SIZE:CHUNK_SIZE + 10] = b"X" * 10
+    expected[4 * CHUNK_SIZE - 10:4 * CHUNK_SIZE] = b"Z" * 10
+    assert dst_backing == expected
+
+    if progress:
+        assert sum(progress.updates) == len(dst_backing)
+        progress.updates.clear()
+
+
+@pytest.mark.parametrize("extents,hole,max_gap,expected", [
+    # Nothing to merge.
+    ("A0B", True, 0,
+     [(0, 1, False, False), (1, 1, True, False), (2, 1, False, False)]),
+    # Zero and hole are merged when holes are zeroed.
+    ("A0-", True, 0, [(0, 1, False, False), (1, 2, True, False)]),
+    # Holes are kept when holes are not zeroed.
+    ("A0-", False, 0,
+     [(0, 1, False, False), (1, 1, True, False), (2, 1, True, True)]),
+    # Small zero gap is merged into data.
+    ("A0B", True, 1, [(0, 3, False, False)]),
+    # Gap too large.
+    ("A00B", True, 1,
+     [(0, 1, False, False), (1, 2, True, False), (3, 1, False, False)]),
+    # Trailing gap is not merged.
+    ("A0", True, 1, [(0, 1, False, False), (1, 1, True, False)]),
+    # Hole is not merged into data when holes are not zeroed.
+    ("A-B", False, 1,
+     [(0, 1, False, False), (1, 1, True, True), (2, 1, False, False)]),
+    # Multiple gaps.
+    ("A0B-C0", True, 1, [(0, 5, False, False), (5, 1, True, False)]),
+])
+def test_coalesce(extents, hole, max_gap, expected):
+    result = _io._coalesce(
+        create_zero_extents(extents),
+        max_gap=max_gap * CHUNK_SIZE,
+        hole=hole)
+    assert list(result) == [
+        extent.ZeroExtent(
+            start * CHUNK_SIZE, length * CHUNK_SIZE, is_zero, is_hole)
+        for start, length, is_zero, is_hole in expected
+    ]
+
+
+def test_coalesce_max_length():
+    result = _io._coalesce(
+        create_zero_extents("A0B0C"),
+        max_gap=CHUNK_SIZE,
+        max_length=3 * CHUNK_SIZE)
+    assert list(result) == [
+        extent.ZeroExtent(0, 3 * CHUNK_SIZE, False, False),
+        extent.ZeroExtent(3 * CHUNK_SIZE, CHUNK_SIZE, True, False),
+        extent.ZeroExtent(4 * CHUNK_SIZE, CHUNK_SIZE, False, False),
+    ]
+
+
+@pytest.mark.parametrize("zero,hole", ZERO_PARAMS)
+def test_copy_data_coalesce(zero, hole):
+    src = memory.Backend(
+        mode="r",
+        data=create_backing("A0B-C00D"),
+        extents={"zero": create_zero_extents("A0B-C00D")},
+    )
+    dst_backing = create_backing(
+        "XXXXXXXX" if zero and hole else "XXX-XXXX" if zero else "00000000")
+    dst = memory.Backend("r+", data=dst_backing)
+
+    p = FakeProgress()
+    _io.copy(src, dst, max_workers=1, zero=zero, hole=hole, progress=p,
+             max_gap=CHUNK_SIZE)
+
+    assert dst_backing == create_backing("A0B-C00D")
+    assert sum(p.updates) == len(dst_backing)
+
+    # Fewer requests than extents.
+    assert len(p.updates) < 8
+
+
+class ZeroRecorder(memory.Backend):
+    """
+    Memory backend recording zero requests.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.zeroed = []
+
+    def zero(self, length):
+        self.zeroed.append((self.tell(), length))
+        return super().zero(length)
+
+
+@pytest.mark.parametrize("progress", [None, FakeProgress()])
+def test_copy_data_dst_zero(progress):
+    src = memory.Backend(
+        mode="r",
+        data=create_backing("A00-0"),
+        extents={"zero": create_zero_extents("A00-0")},
+    )
+    dst_backing = create_backing("XX0-Y")
+    dst = ZeroRecorder(
+        "r+", data=dst_backing, extents={"zero": create_zero_extents("XX0-Y")})
+
+    _io.copy(src, dst, max_workers=1, progress=progress)
+
+    assert dst_backing == create_backing("A00-0")
+
+    # Zero only areas that may contain data in the destination.
+    assert dst.zeroed == [(1 * CHUNK_SIZE, CHUNK_SIZE),
+                          (4 * CHUNK_SIZE, CHUNK_SIZE)]
+
+    if progress:
+        assert sum(progress.updates) == len(dst_backing)
+        progress.updates.clear()
+
+
+def test_copy_data_dst_holes():
+    # Source top layer with data, zero, and hole exposing data from the
+    # backing file.
+    src = memory.Backend(
+        mode="r",
+        data=create_backing("A0-"),
+        extents={"zero": create_zero_extents("A0-")},
+    )
+    # Empty destination top layer, exposed without its backing file, which
+    # holds data. The entire layer is a hole.
+    dst_backing = create_backing("---")
+    dst = ZeroRecorder(
+        "r+", data=dst_backing, extents={"zero": create_zero_extents("---")})
+
+    _io.copy(src, dst, max_workers=1, hole=False)
+
+    assert dst_backing == create_backing("A0-")
+
+    # The zero extent must be zeroed to hide the data in the backing file,
+    # and the hole must be kept.
+    assert dst.zeroed == [(CHUNK_SIZE, CHUNK_SIZE)]
+
+
+def test_copy_data_dst_extents_unsupported():
+    src = memory.Backend(
+        mode="r",
+        data=create_backing("A0"),
+        extents={"zero": create_zero_extents("A0")},
+    )
+    dst_backing = create_backing("XY")
+    # Destination reporting only dirty extents cannot report zero extents.
+    dst = ZeroRecorder(
+        "r+", data=dst_backing, extents={"dirty": create_dirty_extents("XY")})
+
+    _io.copy(src, dst, max_workers=1)
+
+    assert dst_backing == create_backing("A0")
+    assert dst.zeroed == [(CHUNK_SIZE, CHUNK_SIZE)]
+
+
+def create_written_extents(fmt):
+    """
+    Create written extents from format string.
+
+    "W-" -> [
+        WrittenExtent(0 * CHUNK_SIZE, CHUNK_SIZE, True),
+        WrittenExtent(1 * CHUNK_SIZE, CHUNK_SIZE, False),
+    ]
+    """
+    return [
+        extent.WrittenExtent(i * CHUNK_SIZE, CHUNK_SIZE, c == "W")
+        for i, c in enumerate(fmt)
+    ]
+
+
+@pytest.mark.parametrize("progress", [None, FakeProgress()])
+def test_copy_resume(tmpdir, progress):
+    src = memory.Backend(
+        mode="r",
+        data=create_backing("ABCDE"),
+        extents={"zero": create_zero_extents("ABCDE")},
+    )
+
+    # Previous copy completed the first 3 chunks, but the server received
+    # only the first 2 chunks, and the last chunk was written by someone else.
+    dst_backing = create_backing("XYZZX")
+    dst = memory.Backend(
+        "r+",
+        data=dst_backing,
+        extents={"written": create_written_extents("WW--W")})
+
+    journal = _journal.Journal(str(tmpdir.join("journal")))
+    journal.add(0, 3 * CHUNK_SIZE)
+
+    _io.copy(src, dst, max_workers=1, progress=progress, journal=journal)
+    journal.close()
+
+    # Skip ranges completed on both sides.
+    assert dst_backing == create_backing("XYCDE")
+
+    # Copied ranges were recorded.
+    assert list(journal.ranges()) == [measure.Range(0, 5 * CHUNK_SIZE)]
+
+    if progress:
+        assert sum(progress.updates) == len(dst_backing)
+        progress.updates.clear()
+
+
+def test_copy_resume_unsupported(tmpdir):
+    src = memory.Backend(
+        mode="r",
+        data=create_backing("AB"),
+        extents={"zero": create_zero_extents("AB")},
+    )
+    # Destination cannot report written extents.
+    dst_backing = create_backing("XY")
+    dst = memory.Backend("r+", data=dst_backing)
+
+    journal = _journal.Journal(str(tmpdir.join("journal")))
+    journal.add(0, 2 * CHUNK_SIZE)
+
+    _io.copy(src, dst, max_workers=1, journal=journal)
+    journal.close()
+
+    # Nothing can be skipped.
+    assert dst_backing == create_backing("AB")
+
+
+class SlowBackend(memory.Backend):
+    """
+    Memory backend with slow reads, so throughput grows with the number of
+    workers.
+    """
+
+    def __init__(self, *args, clones=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.clones = clones if clones is not None else []
+
+    def clone(self):
+        b = SlowBackend(
+            self._mode, data=self._buf, extents=self._extents,
+            clones=self.clones)
+        self.clones.append(b)
+        return b
+
+    @property
+    def max_writers(self):
+        return self._max_connections
+
+    def readinto(self, buf):
+        time.sleep(0.01)
+        return super().readinto(buf)
+
+
+def test_copy_autotune(monkeypatch):
+    monkeypatch.setattr(_io, "AUTOTUNE_INTERVAL", 0.1)
+    monkeypatch.setattr(_io, "MAX_COPY_SIZE", 64 * 1024)
+
+    size = 8 * 1024**2
+    src = SlowBackend("r", data=bytearray(b"x" * size))
+    dst_backing = bytearray(size)
+    dst = SlowBackend("r+", data=dst_backing)
+
+    p = FakeProgress()
+    _io.copy(src, dst, max_workers=4, buffer_size=64 * 1024, progress=p,
+             autotune=True)
+
+    assert dst_backing == src.data()
+    assert sum(p.updates) == size
+
+    # Started with one worker, and added more workers.
+    assert len(src.clones) > 1
+
+
+def test_handler_meter():
+    size = 2 * CHUNK_SIZE
+    src = memory.Backend("r", data=bytearray(b"x" * size))
+    dst = memory.Backend("r+", data=bytearray(size))
+    meter = _io.Meter()
+    p = FakeProgress()
+
+    h = _io.Handler(src.clone, dst.clone, progress=p, meter=meter)
+    try:
+        h.zero(_io.Request(_io.ZERO, 0, CHUNK_SIZE))
+        h.copy(_io.Request(_io.COPY, CHUNK_SIZE, CHUNK_SIZE))
+    finally:
+        h.close()
+
+    # Zeroed bytes are reported but not measured for autotuning.
+    assert p.updates == [CHUNK_SIZE, CHUNK_SIZE]
+    assert meter.done == CHUNK_SIZE
+
+
+def test_scheduler_regions():
+    s = _io.Scheduler()
+    q0 = s.worker_queue(0)
+    q1 = s.worker_queue(1)
+
+    # Requests may be submitted in any order.
+    for i in reversed(range(8)):
+        s.put(_io.Request(_io.COPY, i * CHUNK_SIZE, CHUNK_SIZE))
+    s.finish()
+
+    # Every worker gets a contiguous region.
+    assert [q0.get().start for _ in range(4)] == [
+        i * CHUNK_SIZE for i in range(4)]
+    assert [q1.get().start for _ in range(4)] == [
+        i * CHUNK_SIZE for i in range(4, 8)]
+
+    assert q0.get().op == _io.STOP
+    assert q1.get().op == _io.STOP
+
+    stats = s.stats()
+    assert stats["requests"] == 8
+    assert stats["sequential"] == 6 / 8
+    assert stats["steals"] == 0
+
+
+def test_scheduler_steal():
+    s = _io.Scheduler()
+    q0 = s.worker_queue(0)
+    q1 = s.worker_queue(1)
+
+    for i in range(8):
+        s.put(_io.Request(_io.COPY, i * CHUNK_SIZE, CHUNK_SIZE))
+    s.finish()
+
+    # Worker 1 is slow, processing only 2 requests.
+    assert q1.get().start == 4 * CHUNK_SIZE
+    assert q1.get().start == 5 * CHUNK_SIZE
+
+    # Worker 0 completes its region, and steals the second half of worker 1
+    # remaining region.
+    starts = [q0.get().start for _ in range(4)]
+    assert starts == [i * CHUNK_SIZE for i in range(4)]
+    assert q0.get().start == 7 * CHUNK_SIZE
+
+    assert q1.get().start == 6 * CHUNK_SIZE
+
+    # No more work.
+    assert q0.get().op == _io.STOP
+    assert q1.get().op == _io.STOP
+    assert s.stats()["steals"] == 1
+
+
+def test_scheduler_new_worker_steals():
+    s = _io.Scheduler()
+    q0 = s.worker_queue(0)
+    for i in range(4):
+        s.put(_io.Request(_io.COPY, i * CHUNK_SIZE, CHUNK_SIZE))
+    s.finish()
+
+    # Worker added after requests were partitioned.
+    q1 = s.worker_queue(1)
+    assert q1.get().start == 2 * CHUNK_SIZE
+    assert q0.get().start == 0
+
+
+def test_scheduler_retire():
+    s = _io.Scheduler()
+    q0 = s.worker_queue(0)
+    q1 = s.worker_queue(1)
+    for i in range(4):
+        s.put(_io.Request(_io.COPY, i * CHUNK_SIZE, CHUNK_SIZE))
+    s.finish()
+
+    s.retire()
+    assert q1.get().op == _io.STOP
+
+    # Region of the retired worker is processed by other workers.
+    starts = [q0.get().start for _ in range(4)]
+    assert sorted(starts) == [i * CHUNK_SIZE for i in range(4)]
+    assert q0.get().op == _io.STOP
+
+
+def test_scheduler_window():
+    s = _io.Scheduler(window=2)
+    q0 = s.worker_queue(0)
+    for i in range(2):
+        s.put(_io.Request(_io.COPY, i * CHUNK_SIZE, CHUNK_SIZE))
+
+    # Submitting blocks while the window is full.
+    req = _io.Request(_io.COPY, 2 * CHUNK_SIZE, CHUNK_SIZE)
+    t = threading.Thread(target=s.put, args=(req,))
+    t.start()
+    t.join(0.1)
+    assert t.is_alive()
+
+    # Requests are processed before all requests were submitted.
+    assert q0.get().start == 0
+    t.join(1)
+    assert not t.is_alive()
+
+    assert q0.get().start == CHUNK_SIZE
+    s.finish()
+    assert q0.get().start == 2 * CHUNK_SIZE
+    assert q0.get().op == _io.STOP
+
+
+def test_scheduler_close():
+    s = _io.Scheduler()
+    q0 = s.worker_queue(0)
+    s.put(_io.Request(_io.COPY, 0, CHUNK_SIZE))
+    s.close()
+
+    with pytest.raises(_io.Closed):
+        q0.get()
+    with pytest.raises(_io.Closed):
+        s.put(_io.Request(_io.COPY, 0, CHUNK_SIZE))
+
+
+@pytest.mark.parametrize("locality", [True, False])
+def test_copy_locality(monkeypatch, locality):
+    monkeypatch.setattr(_io, "MAX_COPY_SIZE", 64 * 1024)
+
+    size = 4 * 1024**2
+    data = bytearray(size)
+    for i in range(0, size, 4096):
+        data[i:i + 4096] = bytes([i // 4096 % 256]) * 4096
+
+    src = memory.Backend("r", data=data)
+    dst = memory.Backend("r+", data=bytearray(size))
+
+    _io.copy(src, dst, max_workers=4, buffer_size=64 * 1024,
+             locality=locality)
+
+    assert dst.data() == src.data()
+
+
 class BackendError(Exception):
     pass
 
@@ -371,3 +819,119 @@ def create_backing(fmt):
             b += c.encode("ascii") * CHUNK_SIZE
 
     return b
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+
+
+def test_rate_limiter():
+    clock = FakeClock()
+    limiter = _io.RateLimiter(1000, now=clock.time, sleep=clock.sleep)
+
+    # The first request starts immediately, and the next requests wait
+    # until the previous requests could be transferred.
+    for _ in range(3):
+        limiter.consume(500)
+    assert clock.sleeps == [0.5, 1.0]
+
+
+def test_rate_limiter_idle():
+    clock = FakeClock()
+    limiter = _io.RateLimiter(1000, now=clock.time, sleep=clock.sleep)
+
+    limiter.consume(500)
+    clock.now = 10.0
+
+    # Unused budget is not accumulated.
+    limiter.consume(1000)
+    limiter.consume(1000)
+    assert clock.sleeps == [1.0]
+
+
+def test_rate_limiter_invalid():
+    with pytest.raises(ValueError):
+        _io.RateLimiter(0)
+
+
+def test_copy_rate_limit(monkeypatch):
+    monkeypatch.setattr(_io, "MAX_COPY_SIZE", 64 * 1024)
+
+    size = 1024**2
+    src = memory.Backend("r", data=bytearray(b"x" * size))
+    dst = memory.Backend("r+", data=bytearray(size))
+
+    limiter = _io.RateLimiter(10 * size)
+    start = time.monotonic()
+    _io.copy(src, dst, max_workers=2, buffer_size=64 * 1024,
+             limiter=limiter)
+    elapsed = time.monotonic() - start
+
+    assert dst.data() == src.data()
+    # The first request is not delayed.
+    assert elapsed >= 0.9 * (size - _io.MAX_COPY_SIZE) / (10 * size)
+
+
+@pytest.mark.parametrize("extents,aligned", [
+    # Aligned extents are not modified.
+    ("AAAA0000----", "AAAA0000----"),
+    # Block containing data and zeroes is data.
+    ("AA00000000AA", "AAAA0000AAAA"),
+    ("0AAA0000000A", "AAAA0000AAAA"),
+    # Block containing zeroes and holes is zero.
+    ("--00------00", "0000----0000"),
+    # Unaligned image size.
+    ("AAAA0000A", "AAAA0000A"),
+    ("AAAA00A", "AAAAAAA"),
+])
+def test_align_extents(extents, aligned):
+    actual = _io._align_extents(
+        create_zero_extents(extents), 4 * CHUNK_SIZE)
+    assert merge_extents(actual) == merge_extents(
+        create_zero_extents(aligned))
+
+
+def merge_extents(extents):
+    # Merge adjacent extents of same type.
+    return list(_io._coalesce(extents, max_gap=0, hole=False))
+
+
+class AlignedBackend(memory.Backend):
+
+    alignment = 4 * CHUNK_SIZE
+
+    def write(self, buf):
+        end = self.tell() + len(buf)
+        assert self.tell() % self.alignment == 0
+        assert end % self.alignment == 0 or end == self.size()
+        return super().write(buf)
+
+    def zero(self, count):
+        end = self.tell() + count
+        assert self.tell() % self.alignment == 0
+        assert end % self.alignment == 0 or end == self.size()
+        return super().zero(count)
+
+
+def test_copy_alignment():
+    src_extents = create_zero_extents("A0AA-0A00-AAA0A")
+    size = len(src_extents) * CHUNK_SIZE
+    src_backing = create_backing("A0AA-0A00-AAA0A")
+
+    src = memory.Backend(
+        mode="r", data=src_backing, extents={"zero": src_extents})
+    dst = AlignedBackend(mode="r+", data=bytearray(b"x" * size))
+
+    _io.copy(src, dst, max_workers=2, buffer_size=4 * CHUNK_SIZE,
+             max_gap=0, alignment=AlignedBackend.alignment)
+
+    assert dst.data() == src_backing
@@ -0,0 +1,71 @@
+# SPDX-FileCopyrightText: Red Hat, Inc.
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+from ovirt_imageio._internal.measure import Range
+from ovirt_imageio.client import _journal
+
+
+def test_missing(tmpdir):
+    j = _journal.Journal(str(tmpdir.join("journal")))
+    assert list(j.ranges()) == []
+
+
+def test_add(tmpdir):
+    j = _journal.Journal(str(tmpdir.join("journal")))
+    j.add(0, 100)
+    j.add(200, 100)
+    j.add(100, 50)
+    j.close()
+
+    assert list(j.ranges()) == [Range(0, 150), Range(200, 300)]
+
+
+def test_append(tmpdir):
+    path = str(tmpdir.join("journal"))
+    j = _journal.Journal(path)
+    j.add(0, 100)
+    j.close()
+
+    # Resuming appends to the existing journal.
+    j = _journal.Journal(path)
+    j.add(100, 100)
+    j.close()
+
+    assert list(j.ranges()) == [Range(0, 200)]
+
+
+def test_partial_line(tmpdir):
+    path = tmpdir.join("journal")
+    # Client killed while writing the second line.
+    path.write("0 100\n1000 1")
+
+    j = _journal.Journal(str(path))
+    assert list(j.ranges()) == [Range(0, 100)]
+
+    # New line is not merged with the partial line. The partial line is
+    # terminated, describing a prefix of the completed range.
+    j.add(200, 100)
+    j.close()
+
+    assert list(j.ranges()) == [
+        Range(0, 100), Range(200, 300), Range(1000, 1001)]
+
+
+def test_invalid_lines(tmpdir):
+    path = tmpdir.join("journal")
+    path.write("0 100\ninvalid\n1 2 3\n-1 10\n10 0\n200 100\n")
+
+    j = _journal.Journal(str(path))
+    assert list(j.ranges()) == [Range(0, 100), Range(200, 300)]
+
+
+def test_remove(tmpdir):
+    path = tmpdir.join("journal")
+    j = _journal.Journal(str(path))
+    j.add(0, 100)
+    j.remove()
+
+    assert not path.exists()
+
+    # Removing missing journal is ok.
+    j.remove()
@@ -0,0 +1,137 @@
+# SPDX-FileCopyrightText: Red Hat, Inc.
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import os
+import tarfile
+
+import pytest
+
+from ovirt_imageio import client
+from ovirt_imageio._internal import config
+from ovirt_imageio._internal import ipv6
+from ovirt_imageio._internal import qemu_img
+from ovirt_imageio._internal import server
+from ovirt_imageio.client import _ova
+
+from . import testutil
+
+SIZE = 1024**2
+
+OVF = "<Envelope>fake ovf</Envelope>"
+
+
+@pytest.fixture(scope="module")
+def srv():
+    cfg = config.load(["test/conf/daemon.conf"])
+    s = server.Server(cfg)
+    s.start()
+    yield s
+    s.stop()
+
+
+def prepare_transfer(srv, path, ops=("read", "write")):
+    ticket = testutil.create_ticket(
+        url="file://{}".format(path), size=os.path.getsize(path),
+        ops=list(ops))
+    srv.auth.add(ticket)
+
+    host, port = srv.remote_service.address
+    host = ipv6.quote_address(host)
+    return "https://{}:{}/images/{}".format(host, port, ticket["uuid"])
+
+
+def create_disk(tmpdir, name, size, data):
+    path = str(tmpdir.join(name))
+    with open(path, "wb") as f:
+        f.truncate(size)
+        for offset, chunk in data:
+            f.seek(offset)
+            f.write(chunk)
+    return path
+
+
+def test_layout(tmpdir):
+    entries = [
+        ("vm.ovf", 100),
+        ("disk1.raw", 3 * 512 + 1),
+        ("a" * 120 + ".raw", 4096),
+    ]
+    members, size = _ova._layout(entries, mtime=0)
+    assert size % _ova.RECORD_SIZE == 0
+
+    # Create a tar file using the layout and verify that tarfile agrees.
+    path = str(tmpdir.join("vm.ova"))
+    with open(path, "wb") as f:
+        for m in members:
+            f.seek(m.offset)
+            f.write(m.header)
+        f.truncate(size)
+
+    with tarfile.open(path) as tar:
+        found = [(m.name, m.offset, m.offset_data, m.size)
+                 for m in tar.getmembers()]
+
+    assert found == [
+        (m.name, m.offset, m.offset + len(m.header), m.size)
+        for m in members
+    ]
+
+
+def test_export(srv, tmpdir):
+    disk1 = create_disk(
+        tmpdir, "disk1.raw", SIZE, [(0, b"a" * 4096), (SIZE // 2, b"b" * 512)])
+    disk2 = create_disk(
+        tmpdir, "disk2.raw", 2 * SIZE, [(SIZE, b"c" * 65536)])
+
+    disks = [
+        client.OvaDisk("disk1.raw", prepare_transfer(srv, disk1)),
+        client.OvaDisk("disk2.raw", prepare_transfer(srv, disk2)),
+    ]
+
+    ova = str(tmpdir.join("vm.ova"))
+    client.export_ova(
+        ova, disks, OVF, srv.config.tls.ca_file, max_workers=4)
+
+    with tarfile.open(ova) as tar:
+        assert tar.getnames() == ["vm.ovf", "disk1.raw", "disk2.raw"]
+        assert tar.extractfile("vm.ovf").read() == OVF.encode("utf-8")
+        for name, path in ("disk1.raw", disk1), ("disk2.raw", disk2):
+            with open(path, "rb") as f:
+                assert tar.extractfile(name).read() == f.read()
+
+
+def test_import(srv, tmpdir):
+    src1 = str(tmpdir.join("src1.raw"))
+    create_disk(tmpdir, "src1.raw", SIZE, [(0, b"a" * 4096)])
+    src2 = str(tmpdir.join("src2.qcow2"))
+    qemu_img.create(src2, "qcow2", size=SIZE)
+
+    ova = str(tmpdir.join("vm.ova"))
+    with tarfile.open(ova, "w") as tar:
+        tar.add(src1, arcname="disk1.raw")
+        tar.add(src2, arcname="disk2.qcow2")
+
+    dst1 = create_disk(tmpdir, "dst1.raw", SIZE, [(0, b"x" * SIZE)])
+    dst2 = create_disk(tmpdir, "dst2.raw", SIZE, [(0, b"x" * SIZE)])
+
+    disks = [
+        client.OvaDisk("disk1.raw", prepare_transfer(srv, dst1)),
+        client.OvaDisk("disk2.qcow2", prepare_transfer(srv, dst2)),
+    ]
+    client.import_ova(ova, disks, srv.config.tls.ca_file, max_workers=4)
+
+    with open(src1, "rb") as a, open(dst1, "rb") as b:
+        assert a.read() == b.read()
+    with open(dst2, "rb") as f:
+        assert f.read() == b"\0" * SIZE
+
+
+def test_import_missing_member(srv, tmpdir):
+    src = create_disk(tmpdir, "src.raw", SIZE, [])
+    ova = str(tmpdir.join("vm.ova"))
+    with tarfile.open(ova, "w") as tar:
+        tar.add(src, arcname="disk1.raw")
+
+    disks = [client.OvaDisk("missing.raw", "https://localhost:54322/x")]
+    with pytest.raises(RuntimeError):
+        client.import_ova(ova, disks, srv.config.tls.ca_file)
@@ -0,0 +1,95 @@
+# SPDX-FileCopyrightText: Red Hat, Inc.
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import threading
+
+import pytest
+
+from ovirt_imageio.client import _parallel
+
+
+class FakeProgress:
+
+    def __init__(self):
+        self.size = None
+        self.phase = None
+        self.done = 0
+        self._lock = threading.Lock()
+
+    def update(self, n):
+        with self._lock:
+            self.done += n
+
+
+class Recorder:
+
+    def __init__(self):
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def task(self, name, size, fail=False):
+        def func(progress, max_workers):
+            with self._lock:
+                self.calls.append((name, max_workers))
+            # Transfer functions set the size of their own transfer.
+            progress.size = size
+            progress.phase = "transferring"
+            progress.update(size)
+            if fail:
+                raise RuntimeError("{} failed".format(name))
+
+        return _parallel.Task(name, size, func)
+
+
+def test_run():
+    r = Recorder()
+    tasks = [r.task("small", 100), r.task("large", 300)]
+    progress = FakeProgress()
+
+    _parallel.run(tasks, 4, progress=progress, phase="testing")
+
+    # Workers are shared by both tasks.
+    assert sorted(r.calls) == [("large", 2), ("small", 2)]
+
+    # Combined progress.
+    assert progress.size == 400
+    assert progress.done == 400
+    assert progress.phase == "testing: 0 running, 2/2 completed"
+
+
+def test_run_more_tasks_than_workers():
+    r = Recorder()
+    tasks = [r.task("task{}".format(i), 100 * (i + 1)) for i in range(5)]
+
+    _parallel.run(tasks, 2)
+
+    assert sorted(r.calls) == [("task{}".format(i), 1) for i in range(5)]
+
+
+def test_run_uneven_workers():
+    r = Recorder()
+    tasks = [r.task("a", 100), r.task("b", 300), r.task("c", 200)]
+
+    _parallel.run(tasks, 4)
+
+    # The largest task gets the extra worker.
+    assert sorted(r.calls) == [("a", 1), ("b", 2), ("c", 1)]
+
+
+def test_run_failure():
+    r = Recorder()
+    tasks = [r.task("a", 100, fail=True), r.task("b", 100)]
+    progress = FakeProgress()
+
+    with pytest.raises(RuntimeError) as e:
+        _parallel.run(tasks, 2, progress=progress, phase="testing")
+
+    # Other tasks are not affected by the failed task.
+    assert sorted(name for name, _ in r.calls) == ["a", "b"]
+    assert "1 of 2 tasks failed" in str(e.value)
+    assert "a: a failed" in str(e.value)
+    assert progress.phase == "testing: 0 running, 1/2 completed, 1 failed"
+
+
+def test_run_no_tasks():
+    _parallel.run([], 4)
@@ -0,0 +1,131 @@
+# SPDX-FileCopyrightText: Red Hat, Inc.
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import time
+
+import pytest
+
+from ovirt_imageio import client
+from ovirt_imageio._internal import blkhash
+from ovirt_imageio._internal import qemu_img
+from ovirt_imageio._internal import qemu_nbd
+
+SIZE = 1024**2
+
+
+def create_image(tmpdir, name="image.qcow2"):
+    path = str(tmpdir.join(name))
+    qemu_img.create(path, "qcow2", size=SIZE)
+    with qemu_nbd.open(path, "qcow2") as c:
+        c.write(0, b"x" * 65536)
+        c.flush()
+    return path
+
+
+def test_reuse_server(tmpdir):
+    image = create_image(tmpdir)
+
+    with client.Session() as session:
+        with session.open(image, "qcow2") as b:
+            first = list(b.extents())
+        server = session._idle[0]
+
+        with session.open(image, "qcow2") as b:
+            assert list(b.extents()) == first
+
+        # The idle server was reused.
+        assert session._idle == [server]
+
+
+def test_shared_mismatch(tmpdir):
+    image = create_image(tmpdir)
+
+    with client.Session() as session:
+        with session.open(image, "qcow2", shared=1):
+            pass
+        small = session._idle[0]
+
+        # Server allowing less connections cannot be used.
+        with session.open(image, "qcow2", shared=4) as b:
+            with b.clone(), b.clone(), b.clone():
+                pass
+
+        assert session._idle != [small]
+        assert session._idle[0].shared == 4
+
+
+def test_image_changed(tmpdir):
+    image = create_image(tmpdir)
+
+    with client.Session() as session:
+        with session.open(image, "qcow2"):
+            pass
+        server = session._idle[0]
+
+        with qemu_nbd.open(image, "qcow2") as c:
+            c.write(65536, b"y" * 65536)
+            c.flush()
+
+        # Modified image is served by a new server.
+        with session.open(image, "qcow2") as b:
+            buf = bytearray(65536)
+            b.seek(65536)
+            b.readinto(buf)
+            assert buf == b"y" * 65536
+
+        assert session._idle != [server]
+
+
+def test_max_servers(tmpdir):
+    images = [create_image(tmpdir, "image{}.qcow2".format(i))
+              for i in range(3)]
+
+    with client.Session(max_servers=2) as session:
+        for image in images:
+            with session.open(image, "qcow2"):
+                pass
+
+        # Least recently used server was stopped.
+        assert [s.key.filename for s in session._idle] == images[1:]
+
+
+def test_idle_timeout(tmpdir):
+    image = create_image(tmpdir)
+
+    with client.Session(idle_timeout=0.1) as session:
+        with session.open(image, "qcow2"):
+            pass
+        assert len(session._idle) == 1
+
+        deadline = time.monotonic() + 5
+        while session._idle:
+            assert time.monotonic() < deadline
+            time.sleep(0.05)
+
+
+def test_closed(tmpdir):
+    image = create_image(tmpdir)
+
+    session = client.Session()
+    with session.open(image, "qcow2"):
+        pass
+    session.close()
+
+    assert session._idle == []
+    with pytest.raises(RuntimeError):
+        with session.open(image, "qcow2"):
+            pass
+
+
+def test_checksum(tmpdir):
+    image = create_image(tmpdir)
+    expected = client.checksum(image)
+
+    with client.Session() as session:
+        for _ in range(2):
+            assert client.checksum(image, session=session) == expected
+        assert len(session._idle) == 1
+
+    raw = str(tmpdir.join("image.raw"))
+    qemu_img.convert(image, raw, "qcow2", "raw")
+    assert blkhash.checksum(raw) == expected
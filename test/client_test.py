@@ -1,6 +1,7 @@
 # SPDX-FileCopyrightText: Red Hat, Inc.
 # SPDX-License-Identifier: GPL-2.0-or-later
 
+import io
 import os
 import tarfile
 import logging
@@ -10,6 +11,7 @@ from concurrent.futures import ThreadPoolExecutor, as_completed
 import pytest
 
 from ovirt_imageio import client
+from ovirt_imageio.client import _api
 from ovirt_imageio._internal import blkhash
 from ovirt_imageio._internal import config
 from ovirt_imageio._internal import ipv6
@@ -18,6 +20,7 @@ from ovirt_imageio._internal import nbdutil
 from ovirt_imageio._internal import qemu_img
 from ovirt_imageio._internal import qemu_nbd
 from ovirt_imageio._internal import server
+from ovirt_imageio._internal import util
 
 from ovirt_imageio._internal.extent import ZeroExtent, DirtyExtent
 
@@ -205,6 +208,36 @@ def test_upload_preallocated(tmpdir, srv, fmt):
     assert os.stat(dst).st_blocks * 512 == IMAGE_SIZE
 
 
+@pytest.mark.parametrize("fmt", ["raw", "qcow2"])
+def test_upload_delta(tmpdir, srv, fmt):
+    size = 3 * _api.DELTA_BLOCK_SIZE
+
+    # Older version of the image in the destination disk.
+    dst = str(tmpdir.join("dst"))
+    with open(dst, "wb") as f:
+        f.write(b"a" * size)
+
+    # Modify the first and last blocks.
+    tmp = str(tmpdir.join("tmp"))
+    with open(tmp, "wb") as f:
+        f.write(b"a" * size)
+        f.seek(100)
+        f.write(b"b" * 100)
+        f.seek(size - _api.DELTA_BLOCK_SIZE)
+        f.write(b"\0" * _api.DELTA_BLOCK_SIZE)
+
+    src = str(tmpdir.join("src"))
+    qemu_img.convert(tmp, src, "raw", fmt)
+
+    url = prepare_transfer(srv, "file://" + dst, size=size)
+    progress = FakeProgress()
+    client.upload(
+        src, url, srv.config.tls.ca_file, delta=True, progress=progress)
+
+    qemu_img.compare(src, dst, format1=fmt, format2="raw")
+    assert sum(progress.updates) == size
+
+
 @pytest.mark.parametrize("fmt,compressed", [
     ("raw", False),
     ("qcow2", False),
@@ -413,6 +446,77 @@ def test_download_raw(tmpdir, srv, fmt):
     qemu_img.compare(src, dst, format1="raw", format2=fmt)
 
 
+@pytest.mark.parametrize("fmt", ["raw", "qcow2"])
+def test_download_delta(tmpdir, srv, fmt):
+    size = 3 * _api.DELTA_BLOCK_SIZE
+
+    src = str(tmpdir.join("src"))
+    with open(src, "wb") as f:
+        f.write(b"a" * size)
+        f.seek(_api.DELTA_BLOCK_SIZE + 100)
+        f.write(b"b" * 100)
+
+    # Older version of the image in the local image.
+    tmp = str(tmpdir.join("tmp"))
+    with open(tmp, "wb") as f:
+        f.write(b"a" * size)
+
+    dst = str(tmpdir.join("dst"))
+    qemu_img.convert(tmp, dst, "raw", fmt)
+
+    url = prepare_transfer(srv, "file://" + src, size=size)
+    client.download(url, dst, srv.config.tls.ca_file, delta=True)
+
+    qemu_img.compare(src, dst, format1="raw", format2=fmt)
+
+
+def test_download_compressed(tmpdir, srv):
+    src = str(tmpdir.join("src"))
+    with open(src, "wb") as f:
+        f.write(b"a" * CLUSTER_SIZE)
+        # Data not aligned to cluster size.
+        f.seek(IMAGE_SIZE // 2 + 4096)
+        f.write(b"b" * 8192)
+        f.truncate(IMAGE_SIZE)
+
+    url = prepare_transfer(srv, "file://" + src)
+    dst = str(tmpdir.join("dst.qcow2"))
+
+    client.download(
+        url, dst, srv.config.tls.ca_file, max_workers=4, compressed=True)
+
+    qemu_img.compare(src, dst, format1="raw", format2="qcow2")
+
+    # Data clusters were compressed.
+    assert os.path.getsize(dst) < IMAGE_SIZE // 4
+
+
+@pytest.mark.parametrize("kwargs", [
+    {"fmt": "raw"},
+    {"incremental": True},
+    {"delta": True},
+])
+def test_download_compressed_invalid(tmpdir, kwargs):
+    dst = str(tmpdir.join("dst"))
+    with pytest.raises(ValueError):
+        client.download(
+            "https://localhost:54322/images/ticket-id", dst, "ca.pem",
+            compressed=True, **kwargs)
+
+
+def test_download_delta_size_mismatch(tmpdir, srv):
+    src = str(tmpdir.join("src"))
+    with open(src, "wb") as f:
+        f.truncate(IMAGE_SIZE)
+
+    dst = str(tmpdir.join("dst"))
+    qemu_img.create(dst, "raw", size=2 * IMAGE_SIZE)
+
+    url = prepare_transfer(srv, "file://" + src)
+    with pytest.raises(RuntimeError):
+        client.download(url, dst, srv.config.tls.ca_file, delta=True)
+
+
 def test_download_qcow2_as_raw(tmpdir, srv):
     src = str(tmpdir.join("src.qcow2"))
     qemu_img.create(src, "qcow2", size=IMAGE_SIZE)
@@ -606,6 +710,164 @@ def test_download_proxy_url_unused(tmpdir, srv):
     qemu_img.compare(src, dst, format1="raw", format2="raw")
 
 
+def test_upload_stream(tmpdir, srv):
+    # Stream shorter than the disk, with zero block in the middle.
+    data = b"a" * CLUSTER_SIZE + b"\0" * CLUSTER_SIZE + b"b" * 4096
+
+    dst = str(tmpdir.join("dst"))
+    with open(dst, "wb") as f:
+        f.write(b"x" * IMAGE_SIZE)
+
+    url = prepare_transfer(srv, "file://" + dst)
+
+    # Pipe returns partial reads.
+    rfd, wfd = os.pipe()
+
+    def write():
+        with open(wfd, "wb") as w:
+            w.write(data)
+
+    t = util.start_thread(write)
+    try:
+        with open(rfd, "rb") as r:
+            p = FakeProgress()
+            n = client.upload_stream(
+                r, url, srv.config.tls.ca_file, buffer_size=CLUSTER_SIZE,
+                progress=p)
+    finally:
+        t.join()
+
+    assert n == len(data)
+    assert p.size == IMAGE_SIZE
+    assert sum(p.updates) == IMAGE_SIZE
+
+    # The rest of the disk was zeroed.
+    with open(dst, "rb") as f:
+        assert f.read() == data + b"\0" * (IMAGE_SIZE - len(data))
+
+
+def test_upload_stream_too_large(tmpdir, srv):
+    dst = str(tmpdir.join("dst"))
+    with open(dst, "wb") as f:
+        f.truncate(IMAGE_SIZE)
+
+    url = prepare_transfer(srv, "file://" + dst)
+    reader = io.BytesIO(b"a" * (IMAGE_SIZE + 1))
+
+    with pytest.raises(RuntimeError):
+        client.upload_stream(reader, url, srv.config.tls.ca_file)
+
+
+@pytest.mark.parametrize("sparse", [True, False])
+def test_download_stream(tmpdir, srv, sparse):
+    src = str(tmpdir.join("src"))
+    with open(src, "wb") as f:
+        f.write(b"a" * 4096)
+        f.seek(2 * CLUSTER_SIZE)
+        f.write(b"b" * 4096)
+        f.truncate(IMAGE_SIZE)
+
+    url = prepare_transfer(srv, "file://" + src)
+
+    dst = str(tmpdir.join("dst"))
+    with open(dst, "wb") as f:
+        p = FakeProgress()
+        n = client.download_stream(
+            url, f, srv.config.tls.ca_file, progress=p, sparse=sparse)
+
+    assert n == IMAGE_SIZE
+    assert sum(p.updates) == IMAGE_SIZE
+
+    with open(src, "rb") as a, open(dst, "rb") as b:
+        assert a.read() == b.read()
+
+
+@pytest.mark.parametrize("max_workers", [1, 4])
+def test_imageio_client_write_to(tmpdir, srv, max_workers):
+    size = 1024**2
+    src = str(tmpdir.join("src"))
+    data = b"".join(bytes([i]) * 4096 for i in range(size // 4096))
+    with open(src, "wb") as f:
+        f.write(data)
+
+    url = prepare_transfer(srv, "file://" + src, size=size)
+    out = io.BytesIO()
+
+    with client.ImageioClient(
+            url,
+            cafile=srv.config.tls.ca_file,
+            buffer_size=64 * 1024,
+            max_workers=max_workers) as c:
+        # Unaligned range spanning many buffers.
+        c.write_to(out, 1000, size - 2000)
+
+        # Additional connections are created only when needed.
+        assert len(c._clones) == max_workers - 1
+
+    assert out.getvalue() == data[1000:size - 1000]
+
+
+def test_imageio_client_flush_all_connections(tmpdir, srv):
+    size = 1024**2
+    src = str(tmpdir.join("src"))
+    with open(src, "wb") as f:
+        f.truncate(size)
+
+    url = prepare_transfer(srv, "file://" + src, size=size)
+
+    with client.ImageioClient(
+            url,
+            cafile=srv.config.tls.ca_file,
+            buffer_size=64 * 1024,
+            max_workers=4) as c:
+        # Create additional connections.
+        c.write_to(io.BytesIO(), 0, size)
+
+        flushed = []
+        for backend in [c._backend] + c._clones:
+            backend.flush = lambda b=backend: flushed.append(b)
+
+        c.flush()
+
+        # Every connection was flushed.
+        assert flushed == [c._backend] + c._clones
+        assert len(flushed) == 4
+
+
+@pytest.mark.parametrize("max_workers", [1, 4])
+def test_imageio_client_read_from(srv, nbd_server, max_workers):
+    size = 1024**2
+    data = b"".join(bytes([i]) * 4096 for i in range(size // 4096))
+
+    nbd_server.start()
+    url = prepare_transfer(srv, nbd_server.sock.url(), size=size)
+
+    with client.ImageioClient(
+            url,
+            cafile=srv.config.tls.ca_file,
+            buffer_size=64 * 1024,
+            max_workers=max_workers) as c:
+        c.read_from(io.BytesIO(data[1000:]), 1000, size - 1000)
+        c.flush()
+
+        buf = bytearray(size - 1000)
+        c.read(1000, buf)
+        assert buf == data[1000:]
+
+
+def test_imageio_client_read_from_short_reader(srv, nbd_server):
+    nbd_server.start()
+    url = prepare_transfer(srv, nbd_server.sock.url(), size=1024**2)
+
+    with client.ImageioClient(
+            url,
+            cafile=srv.config.tls.ca_file,
+            buffer_size=64 * 1024,
+            max_workers=4) as c:
+        with pytest.raises(RuntimeError):
+            c.read_from(io.BytesIO(b"x" * 100000), 0, 200000)
+
+
 def test_progress(tmpdir, srv):
     src = str(tmpdir.join("src"))
     with open(src, "wb") as f:
@@ -840,6 +1102,31 @@ def test_checksum_from_ova(tmpdir, fmt, compressed):
     assert actual == expected
 
 
+@pytest.mark.parametrize("offset,length", [
+    (0, 1024**2),
+    (1024**2, 1024**2),
+    (CLUSTER_SIZE // 2, 1024**2 + 4096),
+])
+def test_checksum_range(tmpdir, offset, length):
+    size = 2 * 1024**2
+    data = b"".join(b"%04d\n" % i for i in range(size // 5))
+    data = data.ljust(size, b"\0")
+
+    img = str(tmpdir.join("img"))
+    with open(img, "wb") as f:
+        f.write(data)
+
+    # Checksum of the range is the checksum of an image with the same data.
+    tmp = str(tmpdir.join("tmp"))
+    with open(tmp, "wb") as f:
+        f.write(data[offset:offset + length])
+
+    expected = blkhash.checksum(tmp, block_size=1024**2)
+    actual = client.checksum(
+        img, block_size=1024**2, offset=offset, length=length)
+    assert actual == expected
+
+
 @pytest.mark.parametrize("algorithm,digest_size", [
     ("blake2b", 32),
     ("sha1", None),
@@ -854,6 +1141,76 @@ def test_checksum_algorithm(tmpdir, algorithm, digest_size):
     assert actual == expected
 
 
+def test_open_source_raw(tmpdir):
+    size = 4 * 1024**2
+    image = str(tmpdir.join("image.raw"))
+    with open(image, "wb") as f:
+        f.write(b"x" * CLUSTER_SIZE)
+        f.truncate(size)
+
+    # Raw image is read directly without qemu-nbd.
+    with _api._open_source(image, {"format": "raw"}, shared=4) as backend:
+        assert backend.name == "file"
+        assert backend.max_readers == 4
+        assert list(backend.extents()) == [
+            ZeroExtent(0, CLUSTER_SIZE, False, False),
+            ZeroExtent(CLUSTER_SIZE, size - CLUSTER_SIZE, True, False),
+        ]
+
+        with util.aligned_buffer(CLUSTER_SIZE) as buf:
+            backend.seek(0)
+            backend.readinto(buf)
+            assert buf[:] == b"x" * CLUSTER_SIZE
+
+
+def test_open_file_unaligned(tmpdir):
+    image = str(tmpdir.join("image.raw"))
+    with open(image, "wb") as f:
+        f.write(b"x" * 1000)
+
+    # Direct I/O cannot read the last block, so qemu-nbd must be used.
+    assert _api._open_file(image) is None
+
+
+def test_checksum_raw_without_qemu_img(tmpdir, monkeypatch):
+    def fail(*a, **kw):
+        raise AssertionError("qemu-img called")
+
+    monkeypatch.setattr(qemu_img, "info", fail)
+
+    size = 2 * 1024**2
+    image = str(tmpdir.join("image.raw"))
+    with open(image, "wb") as f:
+        f.write(b"x" * CLUSTER_SIZE)
+        f.truncate(size)
+
+    assert _api._source_info(image) == {
+        "filename": image,
+        "format": "raw",
+        "virtual-size": size,
+    }
+
+    expected = blkhash.checksum(image, block_size=1024**2)
+    actual = client.checksum(image, block_size=1024**2)
+    assert actual == expected
+
+
+@pytest.mark.parametrize("header", [
+    pytest.param(b"QFI\xfb\0\0\0\3", id="qcow2"),
+    pytest.param(b"conectix", id="vpc"),
+    pytest.param(b"x" * 64 + b"\x7f\x10\xda\xbe", id="vdi"),
+    pytest.param(b"# comment\nversion=1\n", id="vmdk-descriptor"),
+])
+def test_raw_info_other_format(tmpdir, header):
+    image = str(tmpdir.join("image"))
+    with open(image, "wb") as f:
+        f.write(header)
+        f.truncate(1024**2)
+
+    # qemu-img may detect another format.
+    assert _api._raw_info(image) is None
+
+
 def test_zero_extents_raw(tmpdir):
     size = 10 * 1024**2
 
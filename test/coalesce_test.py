@@ -0,0 +1,296 @@
+# SPDX-FileCopyrightText: Red Hat, Inc.
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+
+import pytest
+
+from ovirt_imageio._internal import coalesce
+from ovirt_imageio._internal import util
+from ovirt_imageio._internal.backends import file
+from ovirt_imageio._internal.backends import memory
+
+
+class Backend(memory.Backend):
+    """
+    Memory backend recording write calls.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.writes = []
+
+    def write(self, buf):
+        self.writes.append((self.tell(), len(buf)))
+        return super().write(buf)
+
+
+def test_merge_adjacent_writes():
+    buf = coalesce.Buffer(1024, 60)
+    backend = Backend("r+", bytearray(b"x" * 1024))
+    b = coalesce.Backend(backend, buf)
+
+    b.seek(100)
+    for i in range(10):
+        assert b.write(b"%d" % i * 10) == 10
+    assert b.tell() == 200
+
+    # Nothing written yet.
+    assert backend.writes == []
+    assert buf.pending == 100
+    assert b.dirty
+
+    # Flushing writes all data in one call.
+    b.flush()
+    assert backend.writes == [(100, 100)]
+    assert buf.pending == 0
+    assert not b.dirty
+
+    expected = b"x" * 100 + b"".join(b"%d" % i * 10 for i in range(10))
+    assert backend.data()[:200] == expected
+
+
+def test_non_adjacent_write():
+    buf = coalesce.Buffer(1024, 60)
+    backend = Backend("r+", bytearray(1024))
+    b = coalesce.Backend(backend, buf)
+
+    b.seek(0)
+    b.write(b"a" * 10)
+    b.seek(100)
+    b.write(b"b" * 10)
+
+    # The first write was drained before buffering the second one.
+    assert backend.writes == [(0, 10)]
+    assert buf.pending == 10
+
+    b.close()
+    assert backend.writes == [(0, 10), (100, 10)]
+    assert backend.data()[100:110] == b"b" * 10
+
+
+def test_large_write_not_buffered():
+    buf = coalesce.Buffer(100, 60)
+    backend = Backend("r+", bytearray(1024))
+    b = coalesce.Backend(backend, buf)
+
+    b.seek(0)
+    b.write(b"a" * 10)
+    assert b.write(b"b" * 100) == 100
+    assert b.tell() == 110
+
+    # The large write does not overlap buffered data, so it is written
+    # without draining the buffer.
+    assert backend.writes == [(10, 100)]
+    assert buf.pending == 10
+
+
+def test_large_write_overlapping():
+    buf = coalesce.Buffer(100, 60)
+    backend = Backend("r+", bytearray(1024))
+    b = coalesce.Backend(backend, buf)
+
+    b.seek(50)
+    b.write(b"a" * 10)
+    b.seek(0)
+    assert b.write(b"b" * 100) == 100
+
+    # Buffered data is written before the large write overwriting it.
+    assert backend.writes == [(50, 10), (0, 100)]
+    assert buf.pending == 0
+    assert backend.data()[:100] == b"b" * 100
+
+
+def test_buffer_full():
+    buf = coalesce.Buffer(100, 60)
+    backend = Backend("r+", bytearray(1024))
+    b = coalesce.Backend(backend, buf)
+
+    b.seek(0)
+    for _ in range(9):
+        b.write(b"a" * 10)
+    assert backend.writes == []
+
+    b.write(b"a" * 10)
+    assert backend.writes == [(0, 100)]
+    assert buf.pending == 0
+
+
+def test_timeout(fake_time):
+    buf = coalesce.Buffer(1024, 1.0)
+    backend = Backend("r+", bytearray(1024))
+    b = coalesce.Backend(backend, buf)
+
+    b.seek(0)
+    b.write(b"a" * 10)
+    fake_time.now += 0.5
+    b.write(b"a" * 10)
+    assert backend.writes == []
+
+    fake_time.now += 0.5
+    b.write(b"a" * 10)
+    assert backend.writes == [(0, 30)]
+
+
+def test_read_your_writes():
+    buf = coalesce.Buffer(1024, 60)
+    backend = Backend("r+", bytearray(1024))
+    writer = coalesce.Backend(backend, buf)
+    reader = coalesce.Backend(backend.clone(), buf)
+
+    writer.seek(10)
+    writer.write(b"a" * 10)
+
+    data = bytearray(30)
+    reader.seek(0)
+    assert reader.readinto(data) == 30
+    assert data == b"\0" * 10 + b"a" * 10 + b"\0" * 10
+    assert reader.tell() == 30
+
+
+@pytest.mark.parametrize("op", ["zero", "extents", "size"])
+def test_drain_before(op):
+    buf = coalesce.Buffer(1024, 60)
+    backend = Backend("r+", bytearray(1024))
+    b = coalesce.Backend(backend, buf)
+
+    b.seek(0)
+    b.write(b"a" * 10)
+
+    if op == "zero":
+        b.zero(10)
+    elif op == "extents":
+        list(b.extents())
+    else:
+        b.size()
+
+    assert backend.writes[0] == (0, 10)
+    assert buf.pending == 0
+
+
+def test_drain_error_keeps_data():
+
+    class Failing(Backend):
+        fail = True
+
+        def write(self, buf):
+            if self.fail:
+                raise OSError("No space left on device")
+            return super().write(buf)
+
+    buf = coalesce.Buffer(1024, 60)
+    backend = Failing("r+", bytearray(1024))
+    b = coalesce.Backend(backend, buf)
+
+    b.seek(0)
+    b.write(b"a" * 10)
+
+    with pytest.raises(OSError):
+        b.flush()
+    assert buf.pending == 10
+
+    backend.fail = False
+    b.flush()
+    assert buf.pending == 0
+    assert backend.data()[:10] == b"a" * 10
+
+
+class Blocking(Backend):
+    """
+    Backend blocking writes at offset 0 until released.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.blocked = kwargs.pop("blocked", threading.Event())
+        self.release = kwargs.pop("release", threading.Event())
+        super().__init__(*args, **kwargs)
+
+    def clone(self):
+        return Blocking(
+            self._mode, data=self._buf, blocked=self.blocked,
+            release=self.release)
+
+    def write(self, buf):
+        if self.tell() == 0:
+            self.blocked.set()
+            assert self.release.wait(5)
+        return super().write(buf)
+
+
+def test_concurrent_large_writes():
+    buf = coalesce.Buffer(100, 60)
+    backend = Blocking("r+", bytearray(1024))
+    b1 = coalesce.Backend(backend, buf)
+    b2 = coalesce.Backend(backend.clone(), buf)
+
+    b1.seek(0)
+    with ThreadPoolExecutor(1) as executor:
+        f = executor.submit(b1.write, b"a" * 100)
+        assert backend.blocked.wait(5)
+
+        # The second writer is not blocked by the first writer.
+        b2.seek(100)
+        assert b2.write(b"b" * 100) == 100
+
+        backend.release.set()
+        assert f.result() == 100
+
+    assert backend.data()[:200] == b"a" * 100 + b"b" * 100
+
+
+def test_buffer_while_draining():
+    buf = coalesce.Buffer(100, 60)
+    backend = Blocking("r+", bytearray(1024))
+    b1 = coalesce.Backend(backend, buf)
+    b2 = coalesce.Backend(backend.clone(), buf)
+
+    b1.seek(0)
+    b1.write(b"a" * 10)
+
+    with ThreadPoolExecutor(1) as executor:
+        f = executor.submit(b1.flush)
+        assert backend.blocked.wait(5)
+
+        # Small writes are buffered while the buffer is drained.
+        b2.seek(100)
+        assert b2.write(b"b" * 10) == 10
+        assert buf.pending == 20
+
+        backend.release.set()
+        f.result()
+
+    assert buf.pending == 10
+    b2.close()
+    assert buf.pending == 0
+    assert backend.data()[:10] == b"a" * 10
+    assert backend.data()[100:110] == b"b" * 10
+
+
+@pytest.mark.parametrize("offset", [0, 42, 4096 - 10])
+def test_file_unaligned_writes(tmpurl, offset):
+    size = 3 * 4096
+    with open(tmpurl.path, "wb") as f:
+        f.write(b"x" * size)
+
+    buf = coalesce.Buffer(1024**2, 60)
+    with file.open(tmpurl, "r+") as backend:
+        b = coalesce.Backend(backend, buf)
+        with closing(b):
+            data = util.aligned_buffer(100)
+            with closing(data):
+                b.seek(offset)
+                for i in range(50):
+                    data[:] = b"%02d" % i * 50
+                    b.write(data)
+
+    with open(tmpurl.path, "rb") as f:
+        content = f.read()
+
+    expected = b"".join(b"%02d" % i * 50 for i in range(50))
+    assert content[:offset] == b"x" * offset
+    assert content[offset:offset + len(expected)] == expected
+    assert content[offset + len(expected):] == (
+        b"x" * (size - offset - len(expected)))
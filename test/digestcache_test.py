@@ -0,0 +1,222 @@
+# SPDX-FileCopyrightText: Red Hat, Inc.
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import os
+import urllib.parse as urllib_parse
+
+import pytest
+
+from ovirt_imageio._internal import digestcache
+
+BLOCK_SIZE = 4096
+
+
+@pytest.fixture(autouse=True)
+def clean_state(monkeypatch):
+    # Inodes of removed test images may be reused.
+    monkeypatch.setattr(digestcache, "_modified", {})
+    monkeypatch.setattr(digestcache, "_generations", {})
+
+
+@pytest.fixture
+def image(tmpdir):
+    path = str(tmpdir.join("image"))
+    with open(path, "wb") as f:
+        f.truncate(4 * BLOCK_SIZE)
+    return urllib_parse.urlparse("file://" + path)
+
+
+@pytest.fixture
+def cache_dir(tmpdir):
+    return str(tmpdir.mkdir("cache"))
+
+
+def load(cache_dir, url, size=4 * BLOCK_SIZE, algorithm="blake2b",
+         digest_size=4):
+    return digestcache.Cache.load(
+        cache_dir, url, size, BLOCK_SIZE, algorithm, digest_size)
+
+
+def fill(cache_dir, url):
+    cache = load(cache_dir, url)
+    for i in range(4):
+        cache.set(i, b"%d" % i * 4)
+    cache.save()
+
+
+def write(url, offset, data):
+    digestcache.start_write(url)
+    with open(url.path, "r+b") as f:
+        f.seek(offset)
+        f.write(data)
+    digestcache.end_write(url, offset, len(data))
+
+
+def cached(cache_dir, url):
+    cache = load(cache_dir, url)
+    return [i for i in range(4) if cache.get(i)]
+
+
+def test_empty(cache_dir, image):
+    cache = load(cache_dir, image)
+    for i in range(4):
+        assert cache.get(i) is None
+
+    # Nothing to save.
+    cache.save()
+    assert os.listdir(cache_dir) == []
+
+
+def test_save_load(cache_dir, image):
+    cache = load(cache_dir, image)
+    cache.set(0, b"0000")
+    cache.set(3, b"3333")
+    cache.save()
+
+    cache = load(cache_dir, image)
+    assert cache.get(0) == b"0000"
+    assert cache.get(1) is None
+    assert cache.get(2) is None
+    assert cache.get(3) == b"3333"
+
+
+def test_no_stable_identity(cache_dir):
+    url = urllib_parse.urlparse("nbd:unix:/run/vdsm/nbd/1.sock")
+    assert load(cache_dir, url) is None
+
+
+def test_not_regular_file(cache_dir):
+    # Like block devices, the modification time of a device node does not
+    # change when the device is modified.
+    url = urllib_parse.urlparse("file:///dev/null")
+    assert digestcache.image(url) is None
+    assert load(cache_dir, url) is None
+
+
+def test_invalid_digest_size(cache_dir, image):
+    cache = load(cache_dir, image)
+    with pytest.raises(ValueError):
+        cache.set(0, b"000")
+
+
+@pytest.mark.parametrize("start,length,valid", [
+    (0, 0, [0, 1, 2, 3]),
+    (0, 1, [1, 2, 3]),
+    (BLOCK_SIZE - 1, 2, [2, 3]),
+    (BLOCK_SIZE, BLOCK_SIZE, [0, 2, 3]),
+    (0, 4 * BLOCK_SIZE, []),
+    (3 * BLOCK_SIZE, 10 * BLOCK_SIZE, [0, 1, 2]),
+    (4 * BLOCK_SIZE, BLOCK_SIZE, [0, 1, 2, 3]),
+])
+def test_invalidate(cache_dir, image, start, length, valid):
+    cache = load(cache_dir, image)
+    for i in range(4):
+        cache.set(i, b"%d" % i * 4)
+
+    cache.invalidate(start, length)
+
+    assert [i for i in range(4) if cache.get(i)] == valid
+
+
+@pytest.mark.parametrize("params", [
+    {"size": 8 * BLOCK_SIZE},
+    {"algorithm": "blake2s"},
+    {"digest_size": 8},
+])
+def test_different_image(cache_dir, image, params):
+    cache = load(cache_dir, image)
+    cache.set(0, b"0000")
+    cache.save()
+
+    kwargs = {"size": 4 * BLOCK_SIZE, "algorithm": "blake2b",
+              "digest_size": 4}
+    kwargs.update(params)
+    cache = load(cache_dir, image, **kwargs)
+    assert cache.get(0) is None
+
+
+def test_invalid_file(cache_dir, image):
+    cache = load(cache_dir, image)
+    cache.set(0, b"0000")
+    cache.save()
+
+    path = os.path.join(cache_dir, os.listdir(cache_dir)[0])
+    with open(path, "r+b") as f:
+        f.truncate(os.path.getsize(path) - 1)
+
+    cache = load(cache_dir, image)
+    assert cache.get(0) is None
+
+
+def test_write(cache_dir, image, tmpdir):
+    fill(cache_dir, image)
+
+    # Cache of another image is not modified.
+    other = urllib_parse.urlparse("file://" + str(tmpdir.join("other")))
+    with open(other.path, "wb") as f:
+        f.truncate(4 * BLOCK_SIZE)
+    fill(cache_dir, other)
+
+    write(image, BLOCK_SIZE, b"x")
+
+    assert cached(cache_dir, image) == [0, 2, 3]
+    assert cached(cache_dir, other) == [0, 1, 2, 3]
+
+
+def test_write_sync(cache_dir, image):
+    fill(cache_dir, image)
+    write(image, BLOCK_SIZE, b"x")
+
+    # Syncing applies the modifications to the cache files.
+    digestcache.sync(cache_dir, image)
+    assert digestcache._modified == {}
+
+    assert cached(cache_dir, image) == [0, 2, 3]
+
+
+def test_write_same_image_other_url(cache_dir, image, tmpdir):
+    fill(cache_dir, image)
+
+    # The cache is keyed by the image identity, not by the url.
+    link = str(tmpdir.join("link"))
+    os.symlink(image.path, link)
+    write(urllib_parse.urlparse("file://" + link), 0, b"x")
+
+    assert cached(cache_dir, image) == [1, 2, 3]
+
+
+def test_write_while_computing(cache_dir, image):
+    cache = load(cache_dir, image)
+
+    # The image was modified while computing the checksum.
+    write(image, 0, b"x")
+    cache.set(0, b"0000")
+    cache.save()
+
+    # Digests computed before the image was modified are not saved.
+    assert cached(cache_dir, image) == []
+
+
+def test_modified_outside(cache_dir, image):
+    fill(cache_dir, image)
+
+    with open(image.path, "r+b") as f:
+        f.write(b"x")
+    st = os.stat(image.path)
+    os.utime(image.path, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+
+    # The image mtime does not match the cache.
+    assert cached(cache_dir, image) == []
+
+
+def test_modified_outside_before_write(cache_dir, image):
+    fill(cache_dir, image)
+
+    with open(image.path, "r+b") as f:
+        f.write(b"x")
+    st = os.stat(image.path)
+    os.utime(image.path, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+
+    # Writing using imageio must not hide the previous change.
+    write(image, 3 * BLOCK_SIZE, b"x")
+    assert cached(cache_dir, image) == []
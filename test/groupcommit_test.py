@@ -0,0 +1,164 @@
+# SPDX-FileCopyrightText: Red Hat, Inc.
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import threading
+import time
+
+import pytest
+
+from ovirt_imageio._internal import groupcommit
+from ovirt_imageio._internal import util
+from ovirt_imageio._internal.backends import memory
+
+
+class Backend(memory.Backend):
+    """
+    Memory backend counting flush calls. If hold is True, flush blocks until
+    release is set.
+    """
+
+    def __init__(self, *args, hold=False, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.flushes = 0
+        self.fail = False
+        self.entered = threading.Event()
+        self.release = threading.Event()
+        if not hold:
+            self.release.set()
+
+    def flush(self):
+        self.flushes += 1
+        self.entered.set()
+        if not self.release.wait(10):
+            raise RuntimeError("Timeout waiting for release")
+        if self.fail:
+            raise OSError("Flush failed")
+        super().flush()
+
+
+def wait_for_requests(coordinator, count):
+    """
+    Wait until count requests arrived. A request waiting for a flush in
+    flight is counted before it starts waiting.
+    """
+    deadline = time.monotonic() + 10
+    while coordinator.stats()["requests"] < count:
+        if time.monotonic() > deadline:
+            raise RuntimeError("Timeout waiting for requests")
+        time.sleep(0.005)
+
+
+def test_single_flush():
+    coordinator = groupcommit.Coordinator()
+    backend = Backend("r+")
+    b = groupcommit.Backend(backend, coordinator)
+
+    b.flush()
+    b.flush()
+
+    # Sequential flushes are never merged.
+    assert backend.flushes == 2
+    assert coordinator.stats() == {
+        "requests": 2,
+        "flushes": 2,
+        "coalesced": 0,
+    }
+
+
+def test_concurrent_flushes():
+    coordinator = groupcommit.Coordinator()
+    backends = [Backend("r+") for _ in range(8)]
+    backends[0] = Backend("r+", hold=True)
+
+    # Start the first flush, and hold it in flight until the rest of the
+    # requests are waiting.
+    first = util.start_thread(coordinator.flush, args=(backends[0],))
+    assert backends[0].entered.wait(10)
+
+    threads = [util.start_thread(coordinator.flush, args=(b,))
+               for b in backends[1:]]
+    wait_for_requests(coordinator, 8)
+
+    backends[0].release.set()
+    for t in [first] + threads:
+        t.join()
+
+    # The first flush was in flight when other requests arrived. All other
+    # requests were completed by the next flush.
+    flushes = sum(b.flushes for b in backends)
+    assert flushes == 2
+    assert coordinator.stats() == {
+        "requests": 8,
+        "flushes": 2,
+        "coalesced": 6,
+    }
+
+
+def test_failed_flush_retried():
+    coordinator = groupcommit.Coordinator()
+    failing = Backend("r+", hold=True)
+    failing.fail = True
+    good = [Backend("r+") for _ in range(3)]
+    errors = []
+
+    def flush(backend):
+        try:
+            coordinator.flush(backend)
+        except OSError as e:
+            errors.append(e)
+
+    t1 = util.start_thread(flush, args=(failing,))
+    assert failing.entered.wait(10)
+
+    threads = [util.start_thread(flush, args=(b,)) for b in good]
+    wait_for_requests(coordinator, 4)
+
+    failing.release.set()
+    for t in [t1] + threads:
+        t.join()
+
+    # The waiting requests were not completed by the failed flush. One of
+    # them flushed again, completing the others.
+    assert len(errors) == 1
+    assert sum(b.flushes for b in good) == 1
+    assert coordinator.stats() == {
+        "requests": 4,
+        "flushes": 1,
+        "coalesced": 2,
+    }
+
+
+def test_flush_error():
+    coordinator = groupcommit.Coordinator()
+    backend = Backend("r+")
+    backend.fail = True
+    b = groupcommit.Backend(backend, coordinator)
+
+    with pytest.raises(OSError):
+        b.flush()
+
+    # Next flush is not blocked by the failed flush.
+    backend.fail = False
+    b.flush()
+    assert backend.flushes == 2
+
+
+def test_wait_for_flush_started_after_request():
+    coordinator = groupcommit.Coordinator()
+    backend = Backend("r+", hold=True)
+
+    # A flush in flight before the request arrived must not complete the
+    # request, since it may not include changes written before the request.
+    t1 = util.start_thread(coordinator.flush, args=(backend,))
+    assert backend.entered.wait(10)
+
+    other = Backend("r+")
+    t2 = util.start_thread(coordinator.flush, args=(other,))
+    wait_for_requests(coordinator, 2)
+
+    backend.release.set()
+    t1.join()
+    t2.join()
+
+    assert backend.flushes == 1
+    assert other.flushes == 1
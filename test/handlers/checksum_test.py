@@ -4,15 +4,20 @@
 import hashlib
 import json
 import os
+import time
+import urllib.parse as urllib_parse
 
 import userstorage
 import pytest
 
 from ovirt_imageio._internal import blkhash
 from ovirt_imageio._internal import config
+from ovirt_imageio._internal import ipv6
 from ovirt_imageio._internal import qemu_img
 from ovirt_imageio._internal import qemu_nbd
 from ovirt_imageio._internal import server
+from ovirt_imageio._internal.backends import file
+from ovirt_imageio._internal.backends import http as http_backend
 
 from .. import testutil
 from .. import http
@@ -148,6 +153,72 @@ def test_user_block_size_invalid(srv, client, block_size):
     assert res.status == 400
 
 
+@pytest.mark.parametrize("offset,length", [
+    (0, None),
+    (0, 3 * blkhash.BLOCK_SIZE // 4),
+    (blkhash.BLOCK_SIZE // 4, blkhash.BLOCK_SIZE // 4),
+    (4096, blkhash.BLOCK_SIZE // 2 + 42),
+    (blkhash.BLOCK_SIZE // 2 + 100, None),
+])
+def test_range(srv, client, tmpdir, offset, length):
+    block_size = blkhash.BLOCK_SIZE // 4
+    size = blkhash.BLOCK_SIZE
+
+    image = str(tmpdir.join("image"))
+    with open(image, "wb") as f:
+        # Data block, hole, data block, hole.
+        f.write(b"a" * block_size)
+        f.seek(2 * block_size)
+        f.write(b"b" * block_size)
+        f.truncate(size)
+
+    with open(image, "rb") as f:
+        f.seek(offset)
+        data = f.read(length)
+
+    expected_file = str(tmpdir.join("expected"))
+    with open(expected_file, "wb") as f:
+        f.write(data)
+
+    expected = blkhash.checksum(expected_file, block_size=block_size)
+    expected["offset"] = offset
+    expected["length"] = len(data)
+
+    ticket = testutil.create_ticket(url="file://" + image, size=size)
+    srv.auth.add(ticket)
+
+    uri = "/images/{}/checksum?block_size={}&offset={}".format(
+        ticket["uuid"], block_size, offset)
+    if length is not None:
+        uri += "&length={}".format(length)
+
+    res = client.request("GET", uri)
+    data = res.read()
+    assert res.status == 200
+    assert json.loads(data) == expected
+
+
+@pytest.mark.parametrize("query,status", [
+    ("offset=invalid", 400),
+    ("offset=-1", 400),
+    ("length=invalid", 400),
+    ("length=-1", 400),
+    ("offset=8192&length=4096", 416),
+    ("offset=8193", 416),
+])
+def test_range_invalid(srv, client, tmpdir, query, status):
+    image = str(tmpdir.join("image"))
+    with open(image, "wb") as f:
+        f.truncate(8192)
+
+    ticket = testutil.create_ticket(url="file://" + image, size=8192)
+    srv.auth.add(ticket)
+    res = client.request("GET", "/images/{}/checksum?{}".format(
+        ticket["uuid"], query))
+    res.read()
+    assert res.status == status
+
+
 @pytest.mark.parametrize("fmt,compressed", [
     ("raw", False),
     ("qcow2", False),
@@ -234,3 +305,195 @@ def test_checksum_algorithms(srv, client, tmpdir):
 
     res = json.loads(data)
     assert res == {"algorithms": sorted(ALGORITHMS)}
+
+
+def test_cache(srv, client, tmpdir, monkeypatch):
+    cache_dir = tmpdir.mkdir("cache")
+    monkeypatch.setattr(
+        srv.config.daemon, "checksum_cache_dir", str(cache_dir))
+    block_size = blkhash.BLOCK_SIZE // 4
+    size = 4 * block_size
+
+    image = str(tmpdir.join("image"))
+    with open(image, "wb") as f:
+        for i in range(4):
+            f.write((b"%d" % i).ljust(block_size, b"\0"))
+
+    ticket = testutil.create_ticket(url="file://" + image, size=size)
+    srv.auth.add(ticket)
+    uri = "/images/{}/checksum?block_size={}".format(
+        ticket["uuid"], block_size)
+
+    def checksum():
+        res = client.request("GET", uri)
+        data = res.read()
+        assert res.status == 200
+        return json.loads(data)
+
+    # Computing the checksum fills the cache.
+    expected = blkhash.checksum(image, block_size=block_size)
+    assert checksum() == expected
+    assert len(cache_dir.listdir()) == 1
+
+    # Blocks modified using the ticket are computed again.
+    crange = "bytes %d-%d/*" % (block_size, block_size + 7)
+    res = client.put(
+        "/images/" + ticket["uuid"], b"modified",
+        headers={"Content-Range": crange})
+    res.read()
+    assert res.status == 200
+
+    expected = blkhash.checksum(image, block_size=block_size)
+    assert checksum() == expected
+
+    # Changes keeping the image modification time are not detected,
+    # proving that cached digests are used.
+    st = os.stat(image)
+    with open(image, "r+b") as f:
+        f.seek(2 * block_size)
+        f.write(b"external")
+    os.utime(image, ns=(st.st_atime_ns, st.st_mtime_ns))
+
+    assert checksum() == expected
+
+    # Restore the image, keeping the modification time.
+    with open(image, "r+b") as f:
+        f.seek(2 * block_size)
+        f.write(b"2".ljust(8, b"\0"))
+    os.utime(image, ns=(st.st_atime_ns, st.st_mtime_ns))
+
+    # Blocks modified using another ticket are computed again, while the
+    # other ticket is still used.
+    writer = testutil.create_ticket(url="file://" + image, size=size)
+    srv.auth.add(writer)
+    res = client.put("/images/" + writer["uuid"], b"first")
+    res.read()
+    assert res.status == 200
+
+    expected = blkhash.checksum(image, block_size=block_size)
+    assert checksum() == expected
+
+    srv.auth.remove(writer["uuid"])
+
+    # Changes outside of imageio modifying the image modification time are
+    # detected.
+    with open(image, "r+b") as f:
+        f.seek(2 * block_size)
+        f.write(b"external")
+    st = os.stat(image)
+    os.utime(image, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+
+    expected = blkhash.checksum(image, block_size=block_size)
+    assert checksum() == expected
+
+
+def test_cache_range(srv, client, tmpdir, monkeypatch):
+    cache_dir = tmpdir.mkdir("cache")
+    monkeypatch.setattr(
+        srv.config.daemon, "checksum_cache_dir", str(cache_dir))
+    block_size = blkhash.BLOCK_SIZE // 4
+    size = 4 * block_size
+
+    image = str(tmpdir.join("image"))
+    with open(image, "wb") as f:
+        for i in range(4):
+            f.write((b"%d" % i).ljust(block_size, b"\0"))
+
+    ticket = testutil.create_ticket(url="file://" + image, size=size)
+    srv.auth.add(ticket)
+
+    # Unaligned blocks and the short last block must not be cached as
+    # image blocks.
+    for offset, length in [(4096, 2 * block_size), (0, block_size + 4096)]:
+        uri = "/images/{}/checksum?block_size={}&offset={}&length={}".format(
+            ticket["uuid"], block_size, offset, length)
+        res = client.request("GET", uri)
+        res.read()
+        assert res.status == 200
+
+    uri = "/images/{}/checksum?block_size={}".format(
+        ticket["uuid"], block_size)
+    res = client.request("GET", uri)
+    data = res.read()
+    assert res.status == 200
+
+    expected = blkhash.checksum(image, block_size=block_size)
+    assert json.loads(data) == expected
+
+
+@pytest.mark.parametrize("query", ["", "&offset=4096&length=1048576"])
+def test_blockmap(srv, client, tmpdir, query):
+    block_size = blkhash.BLOCK_SIZE // 4
+    size = 3 * block_size + 4096
+
+    image = str(tmpdir.join("image"))
+    with open(image, "wb") as f:
+        f.write(b"a" * block_size)
+        f.seek(2 * block_size)
+        f.write(b"b" * block_size)
+        f.truncate(size)
+
+    ticket = testutil.create_ticket(url="file://" + image, size=size)
+    srv.auth.add(ticket)
+
+    uri = "/images/{}/blockmap?block_size={}{}".format(
+        ticket["uuid"], block_size, query)
+    res = client.request("GET", uri)
+    data = res.read()
+    assert res.status == 200
+    assert res.getheader("content-type") == "application/octet-stream"
+    assert res.getheader("x-algorithm") == blkhash.ALGORITHM
+    assert int(res.getheader("x-block-size")) == block_size
+    assert int(res.getheader("x-digest-size")) == blkhash.DIGEST_SIZE
+
+    offset = 4096 if query else 0
+    length = block_size if query else size
+
+    with open(image, "rb") as f:
+        f.seek(offset)
+        content = f.read(length)
+
+    h = hashlib.blake2b
+    expected = b"".join(
+        h(content[i:i + block_size], digest_size=blkhash.DIGEST_SIZE).digest()
+        for i in range(0, length, block_size))
+    assert data == expected
+
+
+def test_blockmap_slow_backend(srv, tmpdir, monkeypatch):
+    block_size = blkhash.BLOCK_SIZE // 4
+    size = 8 * block_size
+
+    image = str(tmpdir.join("image"))
+    with open(image, "wb") as f:
+        for i in range(8):
+            f.write((b"%d" % i).ljust(block_size, b"\0"))
+
+    ticket = testutil.create_ticket(url="file://" + image, size=size)
+    srv.auth.add(ticket)
+
+    # Computing the block map takes more time than the client read timeout,
+    # but the block digests are sent while computing the block map.
+    readinto = file.Backend.readinto
+
+    def slow_readinto(self, buf):
+        time.sleep(0.1)
+        return readinto(self, buf)
+
+    monkeypatch.setattr(file.Backend, "readinto", slow_readinto)
+    monkeypatch.setattr(blkhash.BlockMap, "WRITE_INTERVAL", 0.05)
+
+    host, port = srv.remote_service.address
+    url = urllib_parse.urlparse("https://{}:{}/images/{}".format(
+        ipv6.quote_address(host), port, ticket["uuid"]))
+
+    with http_backend.open(
+            url, cafile=srv.config.tls.ca_file, read_timeout=0.5) as b:
+        block_map = b.block_map(block_size, blkhash.ALGORITHM)
+
+    m = blkhash.BlockMap(block_size=block_size)
+    with open(image, "rb") as f:
+        for i in range(8):
+            m.update(f.read(block_size))
+
+    assert block_map == m.block_map()
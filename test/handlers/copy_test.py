@@ -0,0 +1,168 @@
+# SPDX-FileCopyrightText: Red Hat, Inc.
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import json
+import time
+
+import pytest
+
+from ovirt_imageio._internal import config
+from ovirt_imageio._internal import server
+from ovirt_imageio._internal import util
+
+from .. import testutil
+from .. import http
+
+
+@pytest.fixture(scope="module")
+def srv():
+    cfg = config.load(["test/conf/daemon.conf"])
+    s = server.Server(cfg)
+    s.start()
+    yield s
+    s.stop()
+
+
+def copy(srv, src_id, dst_id):
+    body = json.dumps({"src": src_id})
+    with http.ControlClient(srv.config) as c:
+        res = c.request("POST", "/tickets/{}/copy".format(dst_id), body=body)
+        data = res.read()
+    return res.status, data
+
+
+def test_copy(srv, tmpdir):
+    size = 1024**2
+    src = tmpdir.join("src")
+    with open(str(src), "wb") as f:
+        f.write(b"a" * 4096)
+        f.seek(size // 2)
+        f.write(b"b" * 4096)
+        f.truncate(size)
+
+    dst = tmpdir.join("dst")
+    with open(str(dst), "wb") as f:
+        f.write(b"x" * size)
+
+    src_ticket = testutil.create_ticket(
+        url="file://" + str(src), size=size, ops=["read"])
+    srv.auth.add(src_ticket)
+
+    dst_ticket = testutil.create_ticket(
+        url="file://" + str(dst), size=size, ops=["write"])
+    srv.auth.add(dst_ticket)
+
+    status, _ = copy(srv, src_ticket["uuid"], dst_ticket["uuid"])
+    assert status == 200
+
+    assert dst.read_binary() == src.read_binary()
+
+    # Progress is reported in both tickets.
+    for ticket in (src_ticket, dst_ticket):
+        info = srv.auth.get(ticket["uuid"]).info()
+        assert info["transferred"] == size
+        assert not info["active"]
+        assert info["connections"] == 0
+
+
+def test_copy_no_src(srv):
+    dst_ticket = testutil.create_ticket(ops=["write"])
+    srv.auth.add(dst_ticket)
+
+    status, _ = copy(srv, "no-such-ticket", dst_ticket["uuid"])
+    assert status == 403
+
+
+def test_copy_read_only_dst(srv, tmpdir):
+    src_ticket = testutil.create_ticket(ops=["read"])
+    srv.auth.add(src_ticket)
+    dst_ticket = testutil.create_ticket(ops=["read"])
+    srv.auth.add(dst_ticket)
+
+    status, _ = copy(srv, src_ticket["uuid"], dst_ticket["uuid"])
+    assert status == 403
+
+
+@pytest.mark.parametrize("body", [
+    "not json",
+    json.dumps([]),
+    json.dumps({}),
+    json.dumps({"src": 42}),
+])
+def test_copy_invalid_request(srv, body):
+    dst_ticket = testutil.create_ticket(ops=["write"])
+    srv.auth.add(dst_ticket)
+    with http.ControlClient(srv.config) as c:
+        res = c.request(
+            "POST", "/tickets/{}/copy".format(dst_ticket["uuid"]), body=body)
+        res.read()
+    assert res.status == 400
+
+
+def test_copy_to_self(srv):
+    ticket = testutil.create_ticket(ops=["read", "write"])
+    srv.auth.add(ticket)
+
+    status, _ = copy(srv, ticket["uuid"], ticket["uuid"])
+    assert status == 400
+
+
+def test_copy_dst_too_small(srv, tmpdir):
+    src = tmpdir.join("src")
+    src.write(b"a" * 8192, mode="wb")
+    dst = tmpdir.join("dst")
+    dst.write(b"x" * 4096, mode="wb")
+
+    src_ticket = testutil.create_ticket(
+        url="file://" + str(src), size=8192, ops=["read"])
+    srv.auth.add(src_ticket)
+    dst_ticket = testutil.create_ticket(
+        url="file://" + str(dst), size=8192, ops=["write"])
+    srv.auth.add(dst_ticket)
+
+    status, _ = copy(srv, src_ticket["uuid"], dst_ticket["uuid"])
+    assert status == 400
+
+
+@pytest.mark.parametrize("cancel", ["src", "dst"])
+def test_copy_cancel(srv, tmpdir, monkeypatch, cancel):
+    # Use small buffer to make the copy slow enough.
+    monkeypatch.setattr(srv.config.backend_file, "buffer_size", 4096)
+    size = 100 * 1024**2
+
+    src = tmpdir.join("src")
+    with open(str(src), "wb") as f:
+        f.write(b"a" * size)
+
+    dst = tmpdir.join("dst")
+    with open(str(dst), "wb") as f:
+        f.truncate(size)
+
+    src_ticket = testutil.create_ticket(
+        url="file://" + str(src), size=size, ops=["read"])
+    srv.auth.add(src_ticket)
+    dst_ticket = testutil.create_ticket(
+        url="file://" + str(dst), size=size, ops=["write"])
+    srv.auth.add(dst_ticket)
+
+    result = {}
+
+    def run():
+        result["status"], _ = copy(
+            srv, src_ticket["uuid"], dst_ticket["uuid"])
+
+    t = util.start_thread(run)
+    try:
+        # Wait until the copy is started.
+        ticket = srv.auth.get(dst_ticket["uuid"])
+        deadline = time.monotonic() + 10
+        while not ticket.active():
+            assert time.monotonic() < deadline
+            time.sleep(0.01)
+
+        canceled = src_ticket if cancel == "src" else dst_ticket
+        srv.auth.remove(canceled["uuid"])
+    finally:
+        t.join()
+
+    assert result["status"] == 403
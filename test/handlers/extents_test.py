@@ -127,3 +127,51 @@ def test_file_does_not_support_dirty(srv, client, tmpfile):
         "GET", "/images/%(uuid)s/extents?context=dirty" % ticket)
     res.read()
     assert res.status == 404
+
+
+def test_file_written(srv, client, tmpfile):
+    with open(str(tmpfile), "wb") as f:
+        f.truncate(65536)
+
+    ticket = testutil.create_ticket(
+        url="file://{}".format(tmpfile), size=65536, ops=["write"])
+    srv.auth.add(ticket)
+
+    res = client.request(
+        "GET", "/images/%(uuid)s/extents?context=written" % ticket)
+    data = res.read()
+    assert res.status == 200
+    assert json.loads(data) == [
+        {"start": 0, "length": 65536, "written": False},
+    ]
+
+    res = client.request(
+        "PUT", "/images/%(uuid)s" % ticket,
+        body=b"x" * 4096,
+        headers={"content-range": "bytes 8192-12287/*"})
+    res.read()
+    assert res.status == 200
+
+    res = client.request(
+        "GET", "/images/%(uuid)s/extents?context=written" % ticket)
+    data = res.read()
+    assert res.status == 200
+    assert json.loads(data) == [
+        {"start": 0, "length": 8192, "written": False},
+        {"start": 8192, "length": 4096, "written": True},
+        {"start": 12288, "length": 53248, "written": False},
+    ]
+
+
+def test_file_read_only_not_written(srv, client, tmpfile):
+    with open(str(tmpfile), "wb") as f:
+        f.truncate(65536)
+
+    ticket = testutil.create_ticket(
+        url="file://{}".format(tmpfile), size=65536, ops=["read"])
+    srv.auth.add(ticket)
+
+    res = client.request(
+        "GET", "/images/%(uuid)s/extents?context=written" % ticket)
+    res.read()
+    assert res.status == 404
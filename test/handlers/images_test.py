@@ -4,12 +4,17 @@
 import http.client as http_client
 import io
 import json
+import os
 import time
 
+from functools import partial
+
 import pytest
 
+from ovirt_imageio._internal import blkhash
 from ovirt_imageio._internal import config
 from ovirt_imageio._internal import server
+from ovirt_imageio._internal.backends import file
 
 from .. import testutil
 from .. import http
@@ -22,7 +27,7 @@ CONNECTION_CLOSED = (
 )
 
 
-BASE_FEATURES = {"checksum", "extents"}
+BASE_FEATURES = {"blockmap", "checksum", "extents"}
 ALL_FEATURES = BASE_FEATURES | {"zero", "flush"}
 
 
@@ -141,6 +146,147 @@ def test_upload(tmpdir, srv, client, flush):
     assert res.getheader("content-length") == "0"
 
 
+def test_upload_coalesce_writes(tmpdir, srv, client, monkeypatch):
+    monkeypatch.setattr(srv.config.backend_file, "coalesce_size", 1024**2)
+    image = testutil.create_tempfile(tmpdir, "image", size=8192)
+    ticket = testutil.create_ticket(url="file://" + str(image), size=8192)
+    srv.auth.add(ticket)
+    uri = "/images/" + ticket["uuid"]
+
+    # Small unaligned writes are kept in the ticket write buffer.
+    chunks = [b"%02d" % i * 50 for i in range(20)]
+    offset = 42
+    for chunk in chunks:
+        end = offset + len(chunk) - 1
+        res = client.put(
+            uri + "?flush=n", chunk,
+            headers={"Content-Range": "bytes %d-%d/*" % (offset, end)})
+        res.read()
+        assert res.status == 200
+        offset += len(chunk)
+
+    # Reading on the same ticket returns the buffered data.
+    expected = b"".join(chunks)
+    res = client.get(
+        uri, headers={"Range": "bytes=42-%d" % (42 + len(expected) - 1)})
+    assert res.status == 206
+    assert res.read() == expected
+
+    with io.open(str(image), "rb") as f:
+        assert f.read() == b"\0" * 42 + expected + b"\0" * (
+            8192 - 42 - len(expected))
+
+
+def test_upload_detect_zeroes(tmpdir, srv, client):
+    size = 1024**2
+    image = testutil.create_tempfile(tmpdir, "image", data=b"x" * size)
+    ticket = testutil.create_ticket(
+        url="file://" + str(image), size=size, sparse=True,
+        detect_zeroes=True)
+    srv.auth.add(ticket)
+
+    data = b"y" * 4096 + b"\0" * (size - 8192) + b"y" * 4096
+    res = client.put("/images/" + ticket["uuid"], data)
+    res.read()
+    assert res.status == 200
+
+    with io.open(str(image), "rb") as f:
+        assert f.read() == data
+
+    # Zeroed blocks were deallocated.
+    assert os.stat(str(image)).st_blocks * 512 < size
+
+
+def test_upload_inline_checksum(tmpdir, srv, client):
+    block_size = blkhash.BLOCK_SIZE
+    size = 2 * block_size + 4096
+    image = testutil.create_tempfile(tmpdir, "image", size=size)
+    ticket = testutil.create_ticket(url="file://" + str(image), size=size)
+    ticket["inline_checksum"] = True
+    srv.auth.add(ticket)
+    uri = "/images/" + ticket["uuid"]
+
+    data = b"x" * block_size + b"y" * 4096
+    res = client.put(
+        uri, data,
+        headers={"Content-Range": "bytes 0-%d/*" % (len(data) - 1)})
+    res.read()
+    assert res.status == 200
+
+    # Image not transferred yet.
+    assert "checksum" not in srv.auth.get(ticket["uuid"]).info()
+
+    # Zero the rest of the image.
+    body = json.dumps({
+        "op": "zero",
+        "offset": len(data),
+        "size": size - len(data),
+    })
+    res = client.patch(uri, body)
+    res.read()
+    assert res.status == 200
+
+    info = srv.auth.get(ticket["uuid"]).info()
+    assert info["checksum"] == blkhash.checksum(str(image))
+
+
+def test_upload_inline_checksum_flush(tmpdir, srv, client, monkeypatch):
+    # Report holes in the image as zero extents.
+    monkeypatch.setattr(file, "open", partial(file.open, holes=True))
+
+    block_size = blkhash.BLOCK_SIZE
+    size = 3 * block_size
+    image = testutil.create_tempfile(tmpdir, "image", size=size)
+    ticket = testutil.create_ticket(url="file://" + str(image), size=size)
+    ticket["inline_checksum"] = True
+    srv.auth.add(ticket)
+    uri = "/images/" + ticket["uuid"]
+
+    def put(offset, data):
+        res = client.put(
+            uri, data,
+            headers={"Content-Range": "bytes %d-%d/*" % (
+                offset, offset + len(data) - 1)})
+        res.read()
+        assert res.status == 200
+
+    def flush():
+        res = client.patch(uri, json.dumps({"op": "flush"}))
+        res.read()
+        assert res.status == 200
+
+    # Upload only data areas, flushing in the middle of the upload.
+    put(0, b"x" * 4096)
+    flush()
+
+    # Write into blocks reading as zero during the previous flush.
+    put(block_size + 4096, b"y" * 4096)
+    put(2 * block_size, b"z" * block_size)
+    flush()
+
+    info = srv.auth.get(ticket["uuid"]).info()
+    assert info["checksum"] == blkhash.checksum(str(image))
+
+
+def test_download_inline_checksum(tmpdir, srv, client):
+    size = blkhash.BLOCK_SIZE + 4096
+    image = testutil.create_tempfile(
+        tmpdir, "image", data=b"x" * 8192, size=size)
+    ticket = testutil.create_ticket(url="file://" + str(image), size=size)
+    ticket["inline_checksum"] = True
+    srv.auth.add(ticket)
+
+    res = client.get("/images/" + ticket["uuid"])
+    res.read()
+    assert res.status == 200
+
+    # Yield to server thread - will complete the operation.
+    time.sleep(0.1)
+
+    info = srv.auth.get(ticket["uuid"]).info()
+    assert info["checksum"] == blkhash.checksum(str(image))
+
+
 def test_upload_invalid_flush(tmpdir, srv, client):
     ticket = testutil.create_ticket(url="file:///no/such/image")
     srv.auth.add(ticket)
@@ -338,6 +484,59 @@ def test_download_no_range(tmpdir, srv, client):
     assert received == b"\0" * size
 
 
+def test_download_sparse(tmpdir, srv, client):
+    size = 1024**2
+    image = testutil.create_tempfile(tmpdir, "image", size=size)
+    with io.open(str(image), "r+b") as f:
+        f.seek(size // 2)
+        f.write(b"x" * 4096)
+    ticket = testutil.create_ticket(url="file://" + str(image), size=size)
+    srv.auth.add(ticket)
+    uri = "/images/" + ticket["uuid"]
+
+    res = client.get(uri)
+    assert res.status == 200
+    data = res.read()
+    assert data == (b"\0" * (size // 2) +
+                    b"x" * 4096 +
+                    b"\0" * (size // 2 - 4096))
+
+    # Upload data into a hole; the next download must see the new data.
+    res = client.put(uri, b"y" * 4096)
+    res.read()
+    assert res.status == 200
+
+    res = client.get(uri, headers={"Range": "bytes=0-8191"})
+    assert res.status == 206
+    assert res.read() == b"y" * 4096 + b"\0" * 4096
+
+
+def test_download_sparse_modified_by_other_ticket(tmpdir, srv, client):
+    size = 1024**2
+    image = testutil.create_tempfile(tmpdir, "image", size=size)
+
+    reader = testutil.create_ticket(
+        url="file://" + str(image), size=size, ops=["read"])
+    srv.auth.add(reader)
+    writer = testutil.create_ticket(
+        url="file://" + str(image), size=size, ops=["write"])
+    srv.auth.add(writer)
+
+    res = client.get("/images/" + reader["uuid"])
+    assert res.status == 200
+    assert res.read() == b"\0" * size
+
+    # Modify the image using another ticket.
+    res = client.put("/images/" + writer["uuid"], b"y" * 4096)
+    res.read()
+    assert res.status == 200
+
+    res = client.get(
+        "/images/" + reader["uuid"], headers={"Range": "bytes=0-8191"})
+    assert res.status == 206
+    assert res.read() == b"y" * 4096 + b"\0" * 4096
+
+
 def test_download_extends_ticket(tmpdir, srv, client, fake_time):
     size = 1024
     image = testutil.create_tempfile(tmpdir, "image", size=size)
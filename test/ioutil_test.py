@@ -4,6 +4,8 @@
 import errno
 import os
 import subprocess
+import threading
+import time
 
 from contextlib import closing
 
@@ -192,6 +194,83 @@ def test_is_not_zero_mmap(aligned_buffer):
     assert not ioutil.is_zero(aligned_buffer)
 
 
+def test_is_zero_large():
+    # Large buffers are checked without holding the GIL.
+    buf = bytearray(4 * 1024**2)
+    assert ioutil.is_zero(buf)
+    buf[-1] = 1
+    assert not ioutil.is_zero(buf)
+
+
+@pytest.mark.benchmark
+def test_is_zero_threads():
+    buf = bytearray(256 * 1024**2)
+    ticks = 0
+    done = threading.Event()
+
+    def check():
+        for i in range(10):
+            ioutil.is_zero(buf)
+        done.set()
+
+    t = util.start_thread(check)
+    while not done.is_set():
+        ticks += 1
+        time.sleep(0.0001)
+    t.join()
+
+    # If is_zero holds the GIL, this thread cannot run while checking.
+    print("ticks", ticks)
+    assert ticks > 10
+
+
+# zero_blocks
+
+@pytest.mark.parametrize("buf,block_size,bitmap", [
+    # Empty buffer.
+    (b"", 4, b""),
+    # All zeros.
+    (b"\0" * 8, 4, b"\1\1"),
+    # All data.
+    (b"x" * 8, 4, b"\0\0"),
+    # Mixed.
+    (b"\0" * 4 + b"x" + b"\0" * 3 + b"\0" * 4, 4, b"\1\0\1"),
+    # Short last block.
+    (b"\0" * 4 + b"\0" * 2, 4, b"\1\1"),
+    (b"\0" * 4 + b"\0x", 4, b"\1\0"),
+    # Block larger than buffer.
+    (b"\0" * 3, 4, b"\1"),
+    # Non-zero byte after the first 16 bytes of a block.
+    (b"\0" * 32 + b"\0" * 31 + b"x", 32, b"\1\0"),
+])
+def test_zero_blocks(buf, block_size, bitmap):
+    assert ioutil.zero_blocks(buf, block_size) == bitmap
+
+
+def test_zero_blocks_large():
+    block_size = 64 * 1024
+    buf = bytearray(4 * 1024**2)
+    buf[block_size * 3] = 1
+    buf[-1] = 1
+
+    bitmap = ioutil.zero_blocks(buf, block_size)
+
+    assert len(bitmap) == 64
+    assert [i for i, zero in enumerate(bitmap) if not zero] == [3, 63]
+
+
+def test_zero_blocks_memoryview(aligned_buffer):
+    aligned_buffer[1024:1025] = b"x"
+    with memoryview(aligned_buffer)[512:] as view:
+        assert ioutil.zero_blocks(view, 512) == b"\1\0" + b"\1" * 5
+
+
+@pytest.mark.parametrize("block_size", [0, -1])
+def test_zero_blocks_invalid_block_size(block_size):
+    with pytest.raises(ValueError):
+        ioutil.zero_blocks(b"\0" * 8, block_size)
+
+
 # fallocate
 
 fallocate_mode = pytest.mark.parametrize("mode", [
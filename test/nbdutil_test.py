@@ -490,3 +490,114 @@ def test_merge_clip():
 
     merged2 = list(nbdutil.merged(b, a))
     assert merged2 == merged1
+
+
+# Testing copy
+
+
+class MemoryClient(FakeClient):
+    """
+    Fake client keeping export data in memory, shared with its clones.
+    """
+
+    def __init__(self, alloc, data=None, multi_conn=True, fail_write=False):
+        super().__init__(alloc)
+        self.data = data if data is not None else bytearray(self.export_size)
+        self.maximum_block_size = 32 * MiB
+        self.can_multi_conn = multi_conn
+        self.fail_write = fail_write
+        self.clones = []
+        self.flushes = 0
+        self.writes = 0
+        self.zeroes = 0
+        self.closed = False
+
+    def clone(self):
+        c = MemoryClient(
+            self.alloc,
+            data=self.data,
+            multi_conn=self.can_multi_conn,
+            fail_write=self.fail_write)
+        self.clones.append(c)
+        return c
+
+    def readinto(self, offset, buf):
+        buf[:] = self.data[offset:offset + len(buf)]
+
+    def write(self, offset, buf):
+        if self.fail_write:
+            raise OSError("Write failed")
+        self.data[offset:offset + len(buf)] = buf
+        self.writes += 1
+
+    def zero(self, offset, length):
+        self.data[offset:offset + length] = bytes(length)
+        self.zeroes += 1
+
+    def flush(self):
+        self.flushes += 1
+
+    def close(self):
+        self.closed = True
+
+
+class Progress:
+
+    def __init__(self):
+        self.updates = []
+
+    def update(self, n):
+        self.updates.append(n)
+
+
+def copy_clients(n):
+    alloc = [
+        nbd.Extent(2 * n, 0),
+        nbd.Extent(3 * n, STATE_ZERO),
+        nbd.Extent(3 * n, 0),
+    ]
+    size = extents_length(alloc)
+    data = bytearray(b"".join(b"%07d\n" % i for i in range(size // 8)))
+    data[2 * n:5 * n] = bytes(3 * n)
+    src = MemoryClient(alloc, data=data)
+    dst = MemoryClient([nbd.Extent(size, 0)], data=bytearray(b"x" * size))
+    return src, dst
+
+
+@pytest.mark.parametrize("workers", [1, 2, 3, 8])
+@pytest.mark.parametrize("multi_conn", [True, False])
+def test_copy(workers, multi_conn):
+    n = 64 * 1024
+    src, dst = copy_clients(n)
+    dst.can_multi_conn = multi_conn
+    progress = Progress()
+
+    nbdutil.copy(
+        src, dst, block_size=n, workers=workers, progress=progress)
+
+    assert dst.data == src.data
+    assert sum(progress.updates) == src.export_size
+
+    # Every shard uses its own connections, closed after the copy.
+    shards = min(workers, 8)
+    assert len(src.clones) == shards - 1
+    assert len(dst.clones) == shards - 1
+    assert all(c.closed for c in src.clones + dst.clones)
+    assert not src.closed and not dst.closed
+
+    # Flush all connections unless the server supports multiple connections.
+    flushes = dst.flushes + sum(c.flushes for c in dst.clones)
+    assert flushes == 1 if multi_conn else shards
+
+
+def test_copy_error():
+    n = 64 * 1024
+    src, dst = copy_clients(n)
+    dst.fail_write = True
+
+    with pytest.raises(OSError):
+        nbdutil.copy(src, dst, block_size=n, workers=4)
+
+    # Nothing was flushed, and all clones were closed.
+    assert dst.flushes == 0
+    assert all(c.closed for c in src.clones + dst.clones)
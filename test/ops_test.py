@@ -8,6 +8,7 @@ import pytest
 import userstorage
 
 from ovirt_imageio._internal import errors
+from ovirt_imageio._internal import extent
 from ovirt_imageio._internal import ops
 from ovirt_imageio._internal import stats
 from ovirt_imageio._internal import util
@@ -154,6 +155,76 @@ def test_read_seek():
     assert dst.getvalue() == b"01234"
 
 
+class ReadBackend(memory.Backend):
+    """
+    Memory backend recording read calls.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.reads = []
+
+    def readinto(self, buf):
+        self.reads.append((self.tell(), len(buf)))
+        return super().readinto(buf)
+
+
+@pytest.mark.parametrize("offset,size,data,reads", [
+    # Full image.
+    (0, 400, b"a" * 100 + b"\0" * 200 + b"b" * 100, [(0, 100), (300, 100)]),
+    # Starting and ending in zero extents.
+    (150, 100, b"\0" * 100, []),
+    # Starting in data extent, ending in zero extent.
+    (50, 100, b"a" * 50 + b"\0" * 50, [(50, 50)]),
+    # Starting in zero extent, ending in data extent.
+    (250, 100, b"\0" * 50 + b"b" * 50, [(300, 50)]),
+])
+def test_read_extents(offset, size, data, reads):
+    # Zero extents are not read from the backend, so we use non-zero data to
+    # detect reads.
+    image = bytearray(b"a" * 100 + b"x" * 200 + b"b" * 100)
+    src = ReadBackend("r", image)
+    extents = [
+        extent.ZeroExtent(0, 100, False, False),
+        extent.ZeroExtent(100, 100, True, False),
+        extent.ZeroExtent(200, 100, True, True),
+        extent.ZeroExtent(300, 100, False, False),
+    ]
+    dst = io.BytesIO()
+    clock = stats.Clock()
+
+    with util.aligned_buffer(32) as buf:
+        op = ops.Read(
+            src, dst, buf, size, offset=offset, extents=extents, clock=clock)
+        op.run()
+
+    assert dst.getvalue() == data
+    assert op.done == size
+
+    # Reads are split to buffer size chunks.
+    merged = []
+    for start, length in src.reads:
+        if merged and merged[-1][0] + merged[-1][1] == start:
+            merged[-1] = (merged[-1][0], merged[-1][1] + length)
+        else:
+            merged.append((start, length))
+    assert merged == reads
+
+
+def test_read_extents_gap():
+    # Areas not covered by extents are read.
+    src = ReadBackend("r", bytearray(b"a" * 100 + b"x" * 100 + b"b" * 100))
+    extents = [extent.ZeroExtent(100, 100, True, False)]
+    dst = io.BytesIO()
+
+    with util.aligned_buffer(128) as buf:
+        op = ops.Read(src, dst, buf, 300, extents=extents)
+        op.run()
+
+    assert dst.getvalue() == b"a" * 100 + b"\0" * 100 + b"b" * 100
+    assert src.reads == [(0, 100), (200, 100)]
+
+
 def test_read_repr():
     op = ops.Read(None, None, None, 200, offset=24)
     rep = repr(op)
@@ -320,6 +391,100 @@ def test_write_no_size(user_file, offset, size):
         assert f.read() == b"\0" * trailer
 
 
+class ZeroBackend(memory.Backend):
+    """
+    Memory backend recording write and zero calls.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.calls = []
+
+    def write(self, buf):
+        self.calls.append(("write", self.tell(), len(buf)))
+        return super().write(buf)
+
+    def zero(self, count):
+        self.calls.append(("zero", self.tell(), count))
+        # Memory backend zeroes by writing zeroes.
+        return super().write(b"\0" * count)
+
+
+def test_write_detect_zeroes():
+    block = ops.Write.ZERO_BLOCK_SIZE
+    data = (b"x" * block +
+            b"\0" * 2 * block +
+            b"x" * block +
+            b"\0" * block)
+    dst = ZeroBackend("r+", bytearray(b"y" * len(data)))
+    src = io.BytesIO(data)
+    clock = stats.Clock()
+
+    with util.aligned_buffer(1024**2) as buf:
+        op = ops.Write(
+            dst, src, buf, len(data), detect_zeroes=True, clock=clock)
+        op.run()
+
+    assert dst.calls == [
+        ("write", 0, block),
+        ("zero", block, 2 * block),
+        ("write", 3 * block, block),
+        ("zero", 4 * block, block),
+    ]
+    assert dst.data() == data
+    assert "[write.zero 2 ops," in str(clock)
+
+
+def test_write_detect_zeroes_unaligned():
+    # Zeroes not covering complete aligned blocks are written.
+    block = ops.Write.ZERO_BLOCK_SIZE
+    offset = block // 2
+    size = 2 * block
+    dst = ZeroBackend("r+", bytearray(b"y" * (offset + size)))
+    src = io.BytesIO(b"\0" * size)
+
+    with util.aligned_buffer(1024**2) as buf:
+        op = ops.Write(
+            dst, src, buf, size, offset=offset, detect_zeroes=True)
+        op.run()
+
+    assert dst.calls == [
+        ("write", offset, block // 2),
+        ("zero", block, block),
+        ("write", 2 * block, block // 2),
+    ]
+    assert dst.data() == b"y" * offset + b"\0" * size
+
+
+def test_write_detect_zeroes_disabled():
+    size = ops.Write.ZERO_BLOCK_SIZE
+    dst = ZeroBackend("r+", bytearray(b"y" * size))
+    src = io.BytesIO(b"\0" * size)
+
+    with util.aligned_buffer(1024**2) as buf:
+        op = ops.Write(dst, src, buf, size)
+        op.run()
+
+    assert dst.calls == [("write", 0, size)]
+
+
+@pytest.mark.parametrize("sparse", [True, False])
+def test_write_detect_zeroes_file(user_file, sparse):
+    block = ops.Write.ZERO_BLOCK_SIZE
+    data = b"x" * block + b"\0" * 4 * block + b"x" * block
+    with io.open(user_file.path, "wb") as f:
+        f.write(b"y" * len(data))
+
+    src = io.BytesIO(data)
+    with file.open(user_file.url, "r+", sparse=sparse) as dst, \
+            util.aligned_buffer(1024**2) as buf:
+        op = ops.Write(dst, src, buf, len(data), detect_zeroes=True)
+        op.run()
+
+    with io.open(user_file.path, "rb") as f:
+        assert f.read() == data
+
+
 @pytest.mark.parametrize("sparse", [
     pytest.param(True, id="sparse"),
     pytest.param(False, id="preallocated"),
@@ -420,3 +585,55 @@ def test_flush_repr():
     rep = repr(op)
     assert "Flush" in rep
     assert "done=0" in rep
+
+
+def test_copy_extents():
+    # Zero extents are not read from the source, so we use non-zero data to
+    # detect reads.
+    src = ReadBackend("r", bytearray(b"a" * 100 + b"x" * 200 + b"b" * 100))
+    extents = [
+        extent.ZeroExtent(0, 100, False, False),
+        extent.ZeroExtent(100, 100, True, False),
+        extent.ZeroExtent(200, 100, True, True),
+        extent.ZeroExtent(300, 100, False, False),
+    ]
+    dst = ZeroBackend("r+", bytearray(b"y" * 400))
+
+    with util.aligned_buffer(128) as buf:
+        op = ops.Copy(src, dst, buf, 400, extents=extents)
+        op.run()
+
+    assert dst.data() == b"a" * 100 + b"\0" * 200 + b"b" * 100
+    assert op.done == 400
+    assert src.reads == [(0, 100), (300, 100)]
+    assert dst.calls == [
+        ("write", 0, 100),
+        ("zero", 100, 200),
+        ("write", 300, 100),
+    ]
+
+
+def test_copy_no_extents():
+    src = memory.Backend("r", bytearray(b"a" * 100 + b"b" * 100))
+    dst = memory.Backend("r+", bytearray(300))
+
+    with util.aligned_buffer(64) as buf:
+        op = ops.Copy(src, dst, buf, 150, offset=50)
+        op.run()
+
+    assert dst.data() == b"\0" * 50 + b"a" * 50 + b"b" * 100 + b"\0" * 100
+    assert op.done == 150
+
+
+def test_copy_canceled():
+    src = memory.Backend("r", bytearray(b"a" * 1024))
+    dst = memory.Backend("r+", bytearray(1024))
+
+    with util.aligned_buffer(128) as buf:
+        op = ops.Copy(src, dst, buf, 1024)
+        op.cancel()
+        with pytest.raises(ops.Canceled):
+            op.run()
+
+    # The first chunk was copied before checking cancellation.
+    assert op.done == 128
@@ -34,7 +34,8 @@ def random_tcp_port():
 
 def create_ticket(uuid=None, ops=None, timeout=300, size=2**64,
                   url="file:///tmp/foo.img", transfer_id=None, filename=None,
-                  sparse=None, dirty=None, inactivity_timeout=120):
+                  sparse=None, dirty=None, inactivity_timeout=120,
+                  detect_zeroes=None):
     d = {
         "uuid": uuid or str(uuid4()),
         "timeout": timeout,
@@ -51,6 +52,8 @@ def create_ticket(uuid=None, ops=None, timeout=300, size=2**64,
         d["dirty"] = dirty
     if inactivity_timeout is not None:
         d["inactivity_timeout"] = inactivity_timeout
+    if detect_zeroes is not None:
+        d["detect_zeroes"] = detect_zeroes
     return d
 
 